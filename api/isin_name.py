@@ -1,11 +1,28 @@
 from http.server import BaseHTTPRequestHandler
+import contextvars
+import gzip
+import hashlib
+import io
 import json
 import os
 import re
+import sqlite3
+import ssl
+import tempfile
+import threading
+import time
+import zlib
+from bisect import bisect_right
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from html import unescape
-from urllib.parse import quote_plus, parse_qs, urlparse, unquote
+from urllib.error import HTTPError
+from urllib.parse import quote_plus, parse_qs, urlparse, unquote, urljoin
 from datetime import datetime, timezone, timedelta
-from urllib.request import Request, urlopen, build_opener, HTTPCookieProcessor
+from email.utils import parsedate_to_datetime
+from urllib.request import Request
+import http.client
 import http.cookiejar
 
 UA = (
@@ -21,33 +38,510 @@ YAHOO_SEARCH_URL = "https://query1.finance.yahoo.com/v1/finance/search"
 EODHD_SEARCH_BASE = "https://eodhd.com/api/search/"
 EODHD_EOD_BASE = "https://eodhd.com/api/eod/"
 EODHD_EXCHANGE_PRIORITY = ["XETRA", "F", "PA", "AS", "BR", "SW", "MI", "LSE", "US", "EUFUND"]
+EODHD_PRIOR_CLOSE_LOOKBACK_DAYS = 10
+EODHD_LISTING_TTL_SECONDS = int(os.environ.get("EODHD_LISTING_TTL_DAYS", "30")) * 86400
+EODHD_LISTING_MISS_TTL_SECONDS = int(os.environ.get("EODHD_LISTING_MISS_TTL_HOURS", "24")) * 3600
+RESOLVER_CACHE_TABLE = "resolver_cache"
+BNP_HISTORY_CACHE_NAMESPACE = "bnp_history"
+# Security directory: one resolver-cache entry per ISIN/ticker holding names,
+# URLs and symbols; each field is re-resolved once it is older than the max age.
+SECURITY_DIRECTORY_NAMESPACE = "security_directory"
+SECURITY_DIRECTORY_MAX_AGE_SECONDS = int(os.environ.get("SECURITY_DIRECTORY_MAX_AGE_DAYS", "30")) * 86400
+SECURITY_DIRECTORY_MISS_AGE_SECONDS = int(os.environ.get("SECURITY_DIRECTORY_MISS_AGE_HOURS", "24")) * 3600
+BNP_ROUTE_CACHE_NAMESPACE = "bnp_route"
+BNP_ROUTE_TTL_SECONDS = int(os.environ.get("BNP_ROUTE_TTL_DAYS", "90")) * 86400
+BNP_AJAX_CACHE_NAMESPACE = "bnp_ajax_template"
+BNP_HISTORY_HTML_TTL_SECONDS = int(os.environ.get("BNP_HISTORY_HTML_TTL_HOURS", "24")) * 3600
+
+HTTP_POOL_MAX_PER_HOST = int(os.environ.get("HTTP_POOL_MAX_PER_HOST", "8"))
+HTTP_HOST_CONCURRENCY_DEFAULT = int(os.environ.get("HTTP_HOST_CONCURRENCY_DEFAULT", "4"))
+HTTP_MAX_REDIRECTS = 5
+# Token bucket per host (requests/second, override with HTTP_HOST_RATES="eodhd.com=5,...").
+HTTP_HOST_RATE_DEFAULT = float(os.environ.get("HTTP_HOST_RATE_DEFAULT", "10"))
+# Circuit breaker: trips after N consecutive 429/5xx/network failures (or any
+# Retry-After), stays open for an exponential backoff, then lets one probe through.
+HTTP_BREAKER_FAILURES = int(os.environ.get("HTTP_BREAKER_FAILURES", "3"))
+HTTP_BREAKER_BASE_SECONDS = float(os.environ.get("HTTP_BREAKER_BASE_SECONDS", "2"))
+HTTP_BREAKER_MAX_SECONDS = float(os.environ.get("HTTP_BREAKER_MAX_SECONDS", "60"))
+RESOLVER_MAX_WORKERS = int(os.environ.get("RESOLVER_MAX_WORKERS", "8"))
+BNP_SEARCH_MAX_WORKERS = int(os.environ.get("BNP_SEARCH_MAX_WORKERS", "4"))
+# Per-request wall-clock budget; new upstream work stops RESERVE seconds before it.
+API_REQUEST_BUDGET_SECONDS = float(os.environ.get("API_REQUEST_BUDGET_SECONDS", "50"))
+API_RESPONSE_RESERVE_SECONDS = float(os.environ.get("API_RESPONSE_RESERVE_SECONDS", "3"))
+# Rows per bulk_update_transaction_metadata RPC call in the sync.
+TXN_UPDATE_CHUNK_SIZE = int(os.environ.get("TXN_UPDATE_CHUNK_SIZE", "500"))
+# Disk cache for upstream GET responses: history that ends more than SETTLE_DAYS
+# business days ago is kept forever, history inside that window (late prints,
+# corrections) for SETTLE_TTL, and anything touching today is fresh for LIVE_TTL
+# and then revalidated. Empty bodies never outlive LIVE_TTL; error payloads are
+# not stored.
+HTTP_CACHE_LIVE_TTL_SECONDS = int(os.environ.get("HTTP_CACHE_LIVE_TTL_SECONDS", "300"))
+HTTP_CACHE_SETTLE_DAYS = int(os.environ.get("HTTP_CACHE_SETTLE_DAYS", "3"))
+HTTP_CACHE_SETTLE_TTL_SECONDS = int(os.environ.get("HTTP_CACHE_SETTLE_TTL_SECONDS", "21600"))
 
 _BNP_COOKIE_JAR = http.cookiejar.CookieJar()
-_BNP_OPENER = build_opener(HTTPCookieProcessor(_BNP_COOKIE_JAR))
 _BNP_PRIMED = False
 
+HttpResponse = namedtuple("HttpResponse", "status headers body url")
+_HTTP_POOLS = {}  # (scheme, host, port) -> idle keep-alive connections
+_HTTP_POOL_LOCK = threading.Lock()
+_HTTP_SSL_CONTEXT = ssl.create_default_context()
+_HTTP_HOST_SEMAPHORES = {}  # host -> BoundedSemaphore capping in-flight requests per provider
+_REQUEST_DEADLINE = contextvars.ContextVar("request_deadline", default=None)  # time.monotonic() value
 
-def fetch_text(url, headers=None, timeout=25):
-    req = Request(url, headers=headers or {})
-    with urlopen(req, timeout=timeout) as response:
-        return response.read().decode("utf-8", errors="replace")
 
+class DeadlineExceeded(Exception):
+    pass
 
-def fetch_json(url, headers=None, timeout=25):
-    return json.loads(fetch_text(url, headers=headers, timeout=timeout))
 
+@contextmanager
+def deadline_scope(seconds):
+    # Narrows the current request deadline (never extends it) for the block.
+    current = _REQUEST_DEADLINE.get()
+    target = time.monotonic() + max(0.0, float(seconds))
+    token = _REQUEST_DEADLINE.set(target if current is None else min(current, target))
+    try:
+        yield
+    finally:
+        _REQUEST_DEADLINE.reset(token)
+
+
+def deadline_remaining():
+    deadline = _REQUEST_DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def deadline_exceeded(margin=0.0):
+    remaining = deadline_remaining()
+    return remaining is not None and remaining <= margin
+
+
+_HTTP_HOST_GUARDS = {}  # host -> _HostGuard
+_HTTP_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine, BrokenPipeError, ConnectionResetError)
+
+_CACHE_MEMO = {}  # (namespace, key) -> (expires_at_ts or None, payload)
+_CACHE_LOCK = threading.Lock()
+_CACHE_SQLITE = None
+_HTTP_CACHE_SQLITE = None
+_HTTP_CACHE_LOCK = threading.Lock()
+
+
+def _http_host_setting(env_name, host, default):
+    # env value like "eodhd.com=15,finance.yahoo.com=8" (suffix match on host).
+    for part in os.environ.get(env_name, "").split(","):
+        name, _, value = part.strip().partition("=")
+        if name and value and (host == name or host.endswith(f".{name}")):
+            try:
+                return float(value)
+            except ValueError:
+                pass
+    return default
+
+
+def http_host_timeout(host, default):
+    return _http_host_setting("HTTP_HOST_TIMEOUTS", host, default)
+
+
+def _http_host_semaphore(host):
+    with _HTTP_POOL_LOCK:
+        sem = _HTTP_HOST_SEMAPHORES.get(host)
+        if sem is None:
+            limit = int(_http_host_setting("HTTP_HOST_CONCURRENCY", host, HTTP_HOST_CONCURRENCY_DEFAULT))
+            sem = threading.BoundedSemaphore(max(1, limit))
+            _HTTP_HOST_SEMAPHORES[host] = sem
+        return sem
+
+
+class CircuitOpen(Exception):
+    """Raised without touching the network while a host's circuit breaker is open."""
+
+
+class _HostGuard:
+    # Token bucket plus circuit breaker for one upstream host, shared by all
+    # threads (and warm invocations) of this process.
+    def __init__(self, host):
+        self.host = host
+        self.rate = max(0.1, _http_host_setting("HTTP_HOST_RATES", host, HTTP_HOST_RATE_DEFAULT))
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.stamp = time.monotonic()
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+        self.tripped = False
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        # Fails fast while open; half-open admits a single probe. Then waits for a token.
+        with self.lock:
+            now = time.monotonic()
+            if self.open_until > now:
+                raise CircuitOpen(f"{self.host} circuit open for another {self.open_until - now:.1f}s")
+            if self.tripped:
+                if self.probing:
+                    raise CircuitOpen(f"{self.host} circuit half-open, probe in flight")
+                self.probing = True
+            self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= 1.0
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        if wait > 0:
+            remaining = deadline_remaining()
+            if remaining is not None and wait >= remaining:
+                self.record(None)
+                raise DeadlineExceeded(f"Rate limit wait for {self.host} exceeds the request deadline")
+            time.sleep(wait)
+
+    def record(self, ok, retry_after=None):
+        # ok: True (host answered), False (429/5xx/network error), None (no verdict).
+        with self.lock:
+            self.probing = False
+            if ok is None:
+                return
+            if ok:
+                self.failures = 0
+                self.trips = 0
+                self.tripped = False
+                self.open_until = 0.0
+                return
+            self.failures += 1
+            if retry_after is None and self.failures < HTTP_BREAKER_FAILURES and not self.tripped:
+                return
+            backoff = min(HTTP_BREAKER_MAX_SECONDS, HTTP_BREAKER_BASE_SECONDS * (2 ** self.trips))
+            self.trips += 1
+            self.tripped = True
+            self.open_until = time.monotonic() + (
+                min(HTTP_BREAKER_MAX_SECONDS, retry_after) if retry_after is not None else backoff
+            )
+
+
+def _http_host_guard(host):
+    with _HTTP_POOL_LOCK:
+        guard = _HTTP_HOST_GUARDS.get(host)
+        if guard is None:
+            guard = _HTTP_HOST_GUARDS[host] = _HostGuard(host)
+        return guard
+
+
+def _retry_after_seconds(value):
+    # Retry-After is either delta-seconds or an HTTP date.
+    value = (value or "").strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def parallel_map(fn, items, max_workers=None):
+    # Bounded thread fan-out; results come back in input order. Each task runs
+    # in a copy of the caller's context so the request deadline carries over.
+    items = list(items)
+    workers = min(max_workers or RESOLVER_MAX_WORKERS, len(items))
+    if workers <= 1:
+        return [fn(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(contextvars.copy_context().run, fn, item) for item in items]
+        return [f.result() for f in futures]
+
+
+def parallel_as_completed(fn, items, max_workers=None):
+    # Same fan-out as parallel_map, but yields (item, result) as each task
+    # finishes so callers can stream the fastest results first.
+    items = list(items)
+    workers = min(max_workers or RESOLVER_MAX_WORKERS, len(items))
+    if workers <= 1:
+        for item in items:
+            yield item, fn(item)
+        return
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(contextvars.copy_context().run, fn, item): item for item in items}
+        for f in as_completed(futures):
+            yield futures[f], f.result()
+
+
+def _http_checkout(key, timeout):
+    with _HTTP_POOL_LOCK:
+        idle = _HTTP_POOLS.get(key) or []
+        conn = idle.pop() if idle else None
+    if conn is not None:
+        conn.timeout = timeout
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn, True
+    return _http_connect(key, timeout), False
+
+
+def _http_connect(key, timeout):
+    scheme, host, port = key
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=timeout, context=_HTTP_SSL_CONTEXT)
+    return http.client.HTTPConnection(host, port, timeout=timeout)
+
+
+def _http_checkin(key, conn):
+    with _HTTP_POOL_LOCK:
+        idle = _HTTP_POOLS.setdefault(key, [])
+        if len(idle) < HTTP_POOL_MAX_PER_HOST:
+            idle.append(conn)
+            return
+    conn.close()
+
+
+def _http_decode_body(body, encoding):
+    encoding = (encoding or "").strip().lower()
+    if encoding == "gzip":
+        return gzip.decompress(body)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    return body
+
+
+class _CookieResponse:
+    # Minimal response shape http.cookiejar needs to read Set-Cookie headers.
+    def __init__(self, headers):
+        self._headers = headers
+
+    def info(self):
+        return self._headers
+
+
+def http_request(method, url, headers=None, data=None, timeout=25, cookie_jar=None):
+    """Shared HTTP client: per-host keep-alive pools, rate limiting and circuit
+    breaking, gzip/deflate decoding, redirects and optional cookie jar.
+    Raises urllib's HTTPError for >= 400 and CircuitOpen while a host is backed off."""
+    method = method.upper()
+    for _ in range(HTTP_MAX_REDIRECTS + 1):
+        parsed = urlparse(url)
+        scheme = parsed.scheme or "https"
+        port = parsed.port or (443 if scheme == "https" else 80)
+        key = (scheme, parsed.hostname or "", port)
+        path = (parsed.path or "/") + (f"?{parsed.query}" if parsed.query else "")
+
+        send_headers = {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive", **(headers or {})}
+        cookie_req = None
+        if cookie_jar is not None:
+            cookie_req = Request(url, headers=send_headers, method=method)
+            cookie_jar.add_cookie_header(cookie_req)
+            send_headers.update(cookie_req.unredirected_hdrs)
+
+        conn_timeout = http_host_timeout(key[1], timeout)
+        remaining = deadline_remaining()
+        if remaining is not None:
+            if remaining <= 0:
+                raise DeadlineExceeded(f"Request deadline reached before {method} {key[1]}")
+            conn_timeout = min(conn_timeout, remaining)
+        guard = _http_host_guard(key[1])
+        guard.acquire()
+        sem = _http_host_semaphore(key[1])
+        if not sem.acquire(timeout=conn_timeout):
+            guard.record(None)
+            # Only a wait cut off by the request deadline aborts the caller; a host
+            # timeout is an ordinary (retryable) timeout, like a slow connect.
+            if remaining is not None and conn_timeout >= remaining:
+                raise DeadlineExceeded(f"Request deadline reached waiting for a {key[1]} slot")
+            raise TimeoutError(f"Timed out waiting for a {key[1]} slot")
+        try:
+            conn, reused = _http_checkout(key, conn_timeout)
+            try:
+                try:
+                    conn.request(method, path, body=data, headers=send_headers)
+                    resp = conn.getresponse()
+                except _HTTP_STALE_ERRORS:
+                    # Idle keep-alive connection was closed by the server; retry once fresh.
+                    conn.close()
+                    if not reused:
+                        raise
+                    conn = _http_connect(key, conn_timeout)
+                    conn.request(method, path, body=data, headers=send_headers)
+                    resp = conn.getresponse()
+                raw = resp.read()
+            except Exception:
+                conn.close()
+                guard.record(False)
+                raise
+        finally:
+            sem.release()
+        if resp.status == 429 or resp.status >= 500:
+            guard.record(False, _retry_after_seconds(resp.getheader("Retry-After")))
+        else:
+            guard.record(True)
+        if resp.will_close:
+            conn.close()
+        else:
+            _http_checkin(key, conn)
+
+        if cookie_jar is not None:
+            cookie_jar.extract_cookies(_CookieResponse(resp.msg), cookie_req)
+        body = _http_decode_body(raw, resp.getheader("Content-Encoding"))
+
+        location = resp.getheader("Location")
+        if resp.status in (301, 302, 303, 307, 308) and location:
+            url = urljoin(url, location)
+            if resp.status == 303 or (resp.status in (301, 302) and method not in ("GET", "HEAD")):
+                method, data = "GET", None
+            continue
+        if resp.status >= 400:
+            raise HTTPError(url, resp.status, resp.reason, resp.msg, io.BytesIO(body))
+        return HttpResponse(resp.status, resp.msg, body, url)
+    raise HTTPError(url, 310, "Too many redirects", None, io.BytesIO(b""))
+
+
+def _http_cache_sqlite():
+    global _HTTP_CACHE_SQLITE
+    if _HTTP_CACHE_SQLITE is None:
+        path = os.environ.get("HTTP_CACHE_SQLITE_PATH") or os.path.join(tempfile.gettempdir(), "portfolio_stalker_http.sqlite3")
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute(
+            "create table if not exists http_cache ("
+            "url_hash text primary key, body blob not null, etag text, last_modified text, "
+            "expires_at real, stored_at real not null)"
+        )
+        conn.commit()
+        _HTTP_CACHE_SQLITE = conn
+    return _HTTP_CACHE_SQLITE
+
+
+def _http_cache_enabled():
+    return os.environ.get("HTTP_CACHE", "").strip().lower() not in ("off", "0", "false")
 
 
+def _http_cache_key(url):
+    return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+
+def _http_cache_expiry(history_end, now_ts):
+    # None (never expires) once the response only covers sessions that have
+    # settled, i.e. ended more than HTTP_CACHE_SETTLE_DAYS business days ago.
+    today = datetime.fromtimestamp(now_ts, tz=timezone.utc).date()
+    settled = today
+    remaining = HTTP_CACHE_SETTLE_DAYS
+    while remaining > 0:
+        settled -= timedelta(days=1)
+        if settled.weekday() < 5:
+            remaining -= 1
+    end = str(history_end or "")[:10]
+    if end and end < settled.isoformat():
+        return None
+    if end and end < today.isoformat():
+        return now_ts + HTTP_CACHE_SETTLE_TTL_SECONDS
+    return now_ts + HTTP_CACHE_LIVE_TTL_SECONDS
+
+
+def _http_cache_body_kind(body):
+    # "error" for payloads that report a failure with HTTP 200 (Yahoo chart
+    # errors, EODHD error objects), "empty" for blank/[]/{}/null bodies or a
+    # chart without results, "data" otherwise.
+    text = (body or b"").strip()
+    if not text:
+        return "empty"
+    try:
+        payload = json.loads(text)
+    except ValueError:
+        return "error"
+    if not payload:
+        return "empty"
+    if isinstance(payload, dict):
+        if payload.get("error") or payload.get("errors"):
+            return "error"
+        chart = payload.get("chart")
+        if isinstance(chart, dict):
+            if chart.get("error"):
+                return "error"
+            if not chart.get("result"):
+                return "empty"
+    return "data"
+
+
+def _http_cache_read(key):
+    try:
+        with _HTTP_CACHE_LOCK:
+            return _http_cache_sqlite().execute(
+                "select body, etag, last_modified, expires_at from http_cache where url_hash = ?", (key,)
+            ).fetchone()
+    except Exception:
+        return None
+
+
+def _http_cache_write(key, body, etag, last_modified, expires_at, now_ts):
+    try:
+        with _HTTP_CACHE_LOCK:
+            conn = _http_cache_sqlite()
+            conn.execute(
+                "insert or replace into http_cache (url_hash, body, etag, last_modified, expires_at, stored_at) "
+                "values (?, ?, ?, ?, ?, ?)",
+                (key, body, etag, last_modified, expires_at, now_ts),
+            )
+            conn.commit()
+    except Exception:
+        pass
+
+
+def cached_http_get(url, headers, timeout, history_end):
+    """GET through the disk response cache. history_end is the last date the
+    response can cover: once settled it is cached without expiry, otherwise it
+    is reused for a TTL and then revalidated with If-None-Match/If-Modified-Since
+    (a 304 keeps the stored body). Empty bodies get at most the live TTL and
+    error payloads are passed through uncached."""
+    if not _http_cache_enabled():
+        return http_request("GET", url, headers=headers, timeout=timeout).body
+    key = _http_cache_key(url)
+    now_ts = time.time()
+    hit = _http_cache_read(key)
+    if hit and not _cache_expired(hit[3], now_ts):
+        return hit[0]
+
+    send_headers = dict(headers or {})
+    if hit:
+        if hit[1]:
+            send_headers["If-None-Match"] = hit[1]
+        if hit[2]:
+            send_headers["If-Modified-Since"] = hit[2]
+    resp = http_request("GET", url, headers=send_headers, timeout=timeout)
+    expires_at = _http_cache_expiry(history_end, now_ts)
+    body = hit[0] if resp.status == 304 and hit else resp.body
+    kind = _http_cache_body_kind(body)
+    if kind == "empty":
+        live_until = now_ts + HTTP_CACHE_LIVE_TTL_SECONDS
+        expires_at = live_until if expires_at is None else min(expires_at, live_until)
+    if resp.status == 304 and hit:
+        _http_cache_write(key, hit[0], hit[1], hit[2], expires_at, now_ts)
+        return hit[0]
+    if resp.status == 200 and kind != "error":
+        _http_cache_write(key, resp.body, resp.headers.get("ETag"), resp.headers.get("Last-Modified"), expires_at, now_ts)
+    return resp.body
+
+
+def fetch_text(url, headers=None, timeout=25, history_end=None):
+    # Only responses with a known history_end go through the response cache.
+    if not history_end:
+        body = http_request("GET", url, headers=headers, timeout=timeout).body
+    else:
+        body = cached_http_get(url, headers=headers, timeout=timeout, history_end=history_end)
+    return body.decode("utf-8", errors="replace")
+
+
+def fetch_json(url, headers=None, timeout=25, history_end=None):
+    return json.loads(fetch_text(url, headers=headers, timeout=timeout, history_end=history_end))
+
 
 def bnp_fetch_text(url, headers=None, timeout=25):
-    req = Request(url, headers=headers or {})
-    with _BNP_OPENER.open(req, timeout=timeout) as response:
-        return response.read().decode("utf-8", errors="replace")
+    response = http_request("GET", url, headers=headers, timeout=timeout, cookie_jar=_BNP_COOKIE_JAR)
+    return response.body.decode("utf-8", errors="replace")
 
 
 def prime_bnp_session():
     global _BNP_PRIMED
-    if _BNP_PRIMED:
+    if _BNP_PRIMED or deadline_exceeded():
         return
     headers = {
         "User-Agent": UA,
@@ -73,6 +567,239 @@ def bnp_fetch_json(url, headers=None, timeout=25):
     prime_bnp_session()
     return json.loads(bnp_fetch_text(url, headers=headers, timeout=timeout))
 
+def _supabase_rest():
+    url = os.environ.get("SUPABASE_URL", "").rstrip("/")
+    key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+    if not url or not key:
+        return "", {}
+    return f"{url}/rest/v1", {"apikey": key, "Authorization": f"Bearer {key}", "Accept": "application/json"}
+
+
+def resolver_cache_backend():
+    # "supabase" when the service credentials are present, otherwise a local
+    # SQLite file (also what tests/local runs use). "off" disables persistence.
+    backend = os.environ.get("RESOLVER_CACHE_BACKEND", "").strip().lower()
+    if backend in ("supabase", "sqlite", "off"):
+        return backend
+    rest_base, _ = _supabase_rest()
+    return "supabase" if rest_base else "sqlite"
+
+
+def _cache_sqlite():
+    global _CACHE_SQLITE
+    if _CACHE_SQLITE is None:
+        path = os.environ.get("RESOLVER_CACHE_SQLITE_PATH") or os.path.join(tempfile.gettempdir(), "portfolio_stalker_cache.sqlite3")
+        conn = sqlite3.connect(path, check_same_thread=False)
+        conn.execute(
+            f"create table if not exists {RESOLVER_CACHE_TABLE} ("
+            "namespace text not null, cache_key text not null, payload text not null, "
+            "expires_at real, updated_at real not null, primary key (namespace, cache_key))"
+        )
+        conn.commit()
+        _CACHE_SQLITE = conn
+    return _CACHE_SQLITE
+
+
+def _cache_expired(expires_at, now_ts):
+    return expires_at is not None and expires_at <= now_ts
+
+
+def _iso_to_ts(value):
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).replace("Z", "+00:00")).timestamp()
+    except Exception:
+        return None
+
+
+def cache_get(namespace, key):
+    # Returns the cached payload, or None on miss/expiry/backend failure.
+    return cache_get_many(namespace, [key]).get(key)
+
+
+def cache_get_many(namespace, keys):
+    # {key: payload} for the keys that are cached and unexpired; one backend
+    # round trip for everything the in-process memo does not already hold.
+    now_ts = datetime.now(timezone.utc).timestamp()
+    out = {}
+    missing = []
+    with _CACHE_LOCK:
+        for key in dict.fromkeys(keys):
+            hit = _CACHE_MEMO.get((namespace, key))
+            if hit is not None and not _cache_expired(hit[0], now_ts):
+                out[key] = hit[1]
+            else:
+                _CACHE_MEMO.pop((namespace, key), None)
+                missing.append(key)
+    if not missing:
+        return out
+
+    backend = resolver_cache_backend()
+    found = []  # (key, expires_at, payload)
+    try:
+        if backend == "supabase":
+            rest_base, headers = _supabase_rest()
+            if len(missing) == 1:
+                key_filter = f"eq.{quote_plus(missing[0])}"
+            else:
+                key_filter = quote_plus("in.(" + ",".join('"' + k.replace('"', '') + '"' for k in missing) + ")")
+            rows = json.loads(fetch_text(
+                f"{rest_base}/{RESOLVER_CACHE_TABLE}?namespace=eq.{quote_plus(namespace)}"
+                f"&cache_key={key_filter}&select=cache_key,payload,expires_at",
+                headers=headers,
+                timeout=10,
+            ))
+            found = [(r.get("cache_key"), _iso_to_ts(r.get("expires_at")), r.get("payload")) for r in rows or []]
+        elif backend == "sqlite":
+            with _CACHE_LOCK:
+                rows = _cache_sqlite().execute(
+                    f"select cache_key, payload, expires_at from {RESOLVER_CACHE_TABLE} "
+                    f"where namespace = ? and cache_key in ({','.join('?' for _ in missing)})",
+                    (namespace, *missing),
+                ).fetchall()
+            found = [(r[0], r[2], json.loads(r[1])) for r in rows]
+    except Exception:
+        return out
+
+    with _CACHE_LOCK:
+        for key, expires_at, payload in found:
+            if payload is None or _cache_expired(expires_at, now_ts):
+                continue
+            _CACHE_MEMO[(namespace, key)] = (expires_at, payload)
+            out[key] = payload
+    return out
+
+
+def cache_put(namespace, key, payload, ttl_seconds=None):
+    # ttl_seconds=None stores the entry without expiry.
+    return cache_put_many(namespace, {key: payload}, ttl_seconds=ttl_seconds)
+
+
+def cache_put_many(namespace, entries, ttl_seconds=None):
+    # entries: {key: payload}, written in one backend call.
+    if not entries:
+        return True
+    now_ts = datetime.now(timezone.utc).timestamp()
+    expires_at = (now_ts + ttl_seconds) if ttl_seconds is not None else None
+    with _CACHE_LOCK:
+        for key, payload in entries.items():
+            _CACHE_MEMO[(namespace, key)] = (expires_at, payload)
+
+    backend = resolver_cache_backend()
+    try:
+        if backend == "supabase":
+            rest_base, headers = _supabase_rest()
+            rows = [
+                {
+                    "namespace": namespace,
+                    "cache_key": key,
+                    "payload": payload,
+                    "expires_at": datetime.fromtimestamp(expires_at, tz=timezone.utc).isoformat() if expires_at else None,
+                    "updated_at": datetime.fromtimestamp(now_ts, tz=timezone.utc).isoformat(),
+                }
+                for key, payload in entries.items()
+            ]
+            http_request(
+                "POST",
+                f"{rest_base}/{RESOLVER_CACHE_TABLE}?on_conflict=namespace,cache_key",
+                headers={**headers, "Content-Type": "application/json", "Prefer": "resolution=merge-duplicates,return=minimal"},
+                data=json.dumps(rows).encode("utf-8"),
+                timeout=10,
+            )
+        elif backend == "sqlite":
+            with _CACHE_LOCK:
+                conn = _cache_sqlite()
+                conn.executemany(
+                    f"insert or replace into {RESOLVER_CACHE_TABLE} (namespace, cache_key, payload, expires_at, updated_at) "
+                    "values (?, ?, ?, ?, ?)",
+                    [(namespace, key, json.dumps(payload), expires_at, now_ts) for key, payload in entries.items()],
+                )
+                conn.commit()
+    except Exception:
+        return False
+    return True
+
+
+def cache_invalidate(namespace, key=None):
+    # Drops one key, or the whole namespace when key is None.
+    with _CACHE_LOCK:
+        for memo_key in [k for k in _CACHE_MEMO if k[0] == namespace and (key is None or k[1] == key)]:
+            _CACHE_MEMO.pop(memo_key, None)
+
+    backend = resolver_cache_backend()
+    try:
+        if backend == "supabase":
+            rest_base, headers = _supabase_rest()
+            key_filter = f"&cache_key=eq.{quote_plus(key)}" if key is not None else ""
+            http_request(
+                "DELETE",
+                f"{rest_base}/{RESOLVER_CACHE_TABLE}?namespace=eq.{quote_plus(namespace)}{key_filter}",
+                headers={**headers, "Prefer": "return=minimal"},
+                timeout=10,
+            )
+        elif backend == "sqlite":
+            with _CACHE_LOCK:
+                conn = _cache_sqlite()
+                if key is None:
+                    conn.execute(f"delete from {RESOLVER_CACHE_TABLE} where namespace = ?", (namespace,))
+                else:
+                    conn.execute(f"delete from {RESOLVER_CACHE_TABLE} where namespace = ? and cache_key = ?", (namespace, key))
+                conn.commit()
+    except Exception:
+        return False
+    return True
+
+
+def _directory_key(symbol):
+    isin = normalize_isin(symbol)
+    return f"isin:{isin}" if isin else f"ticker:{normalize_symbol(symbol)}"
+
+
+def security_directory_get_many(symbols):
+    # {symbol: entry} (entry {} when unknown). An entry maps fields such as
+    # name, bnp_url, category, yahoo_symbol, yahoo_name, eodhd_symbol, currency
+    # to values, plus "checked": {field: unix ts of the last resolution}.
+    keys = {symbol: _directory_key(symbol) for symbol in symbols if normalize_symbol(symbol)}
+    cached = cache_get_many(SECURITY_DIRECTORY_NAMESPACE, list(keys.values()))
+    return {symbol: cached.get(key) or {} for symbol, key in keys.items()}
+
+
+def security_directory_get(symbol):
+    return security_directory_get_many([symbol]).get(symbol) or {}
+
+
+def security_directory_lookup(entry, field):
+    # (value, fresh). Empty results (misses) go stale sooner than hits.
+    checked = (entry.get("checked") or {}).get(field)
+    if checked is None:
+        return None, False
+    value = entry.get(field)
+    max_age = SECURITY_DIRECTORY_MAX_AGE_SECONDS if value else SECURITY_DIRECTORY_MISS_AGE_SECONDS
+    return value, datetime.now(timezone.utc).timestamp() - checked < max_age
+
+
+def security_directory_update_many(updates):
+    # updates: {symbol: {field: value}}; stamps each field as just resolved.
+    now_ts = datetime.now(timezone.utc).timestamp()
+    current = security_directory_get_many(list(updates))
+    entries = {}
+    for symbol, fields in updates.items():
+        if not fields or not normalize_symbol(symbol):
+            continue
+        entry = dict(current.get(symbol) or {})
+        entry["checked"] = dict(entry.get("checked") or {})
+        for field, value in fields.items():
+            entry[field] = value
+            entry["checked"][field] = now_ts
+        entries[_directory_key(symbol)] = entry
+    return cache_put_many(SECURITY_DIRECTORY_NAMESPACE, entries)
+
+
+def security_directory_update(symbol, **fields):
+    return security_directory_update_many({symbol: fields})
+
+
 def read_str(record, keys):
     for key in keys:
         value = record.get(key)
@@ -155,22 +882,91 @@ def eodhd_pick_best_eur(candidates):
     return eur[0]
 
 
-def eodhd_close_for_symbol_date(symbol, txn_date):
+def eodhd_best_listing_for_isin(isin, refresh=False):
+    # ISIN -> best EUR listing, answered from the resolver cache before any search call.
+    target = normalize_isin(isin)
+    if not target or not eodhd_api_token():
+        return None
+    if not refresh:
+        cached = cache_get("eodhd_listing", target)
+        if cached is not None:
+            return cached.get("best") or None
+
+    best = eodhd_pick_best_eur(eodhd_search_candidates_for_isin(target))
+    ttl = EODHD_LISTING_TTL_SECONDS if best else EODHD_LISTING_MISS_TTL_SECONDS
+    cache_put("eodhd_listing", target, {"best": best}, ttl_seconds=ttl)
+    if best:
+        security_directory_update(
+            target,
+            eodhd_symbol=best.get("symbol") or "",
+            eodhd_name=best.get("name") or "",
+            currency=best.get("currency") or "",
+        )
+    return best
+
+
+def invalidate_eodhd_listing(isin=None):
+    target = normalize_isin(isin) if isin else None
+    return cache_invalidate("eodhd_listing", target)
+
+
+def eodhd_eod_series(symbol, from_date, to_date):
     token = eodhd_api_token()
-    if not token or not txn_date:
-        return "", ""
+    if not token or not symbol or not from_date or not to_date:
+        return []
     payload = fetch_json(
-        f"{EODHD_EOD_BASE}{quote_plus(symbol)}?api_token={quote_plus(token)}&fmt=json&period=d&order=a&from={quote_plus(txn_date)}&to={quote_plus(txn_date)}",
+        f"{EODHD_EOD_BASE}{quote_plus(symbol)}?api_token={quote_plus(token)}&fmt=json&period=d&order=a&from={quote_plus(from_date)}&to={quote_plus(to_date)}",
         headers={"User-Agent": UA, "Accept": "application/json"},
         timeout=25,
+        history_end=to_date,
     )
-    if not isinstance(payload, list) or not payload:
-        return "unavailable", "EUR"
-    first = payload[0] if isinstance(payload[0], dict) else {}
-    close = maybe_parse_float(first.get("close"))
-    if close is None:
-        return "unavailable", "EUR"
-    return f"{close:.6f}", "EUR"
+    if not isinstance(payload, list):
+        return []
+    rows = []
+    for row in payload:
+        if not isinstance(row, dict):
+            continue
+        d = normalize_payload_date(row.get("date"))
+        close = maybe_parse_float(row.get("close"))
+        if not d or close is None:
+            continue
+        rows.append((d, close))
+    rows.sort(key=lambda x: x[0])
+    return rows
+
+
+def close_on_or_before(rows, txn_date):
+    # rows are (date, close) sorted by date; exact date wins, otherwise the nearest prior close.
+    idx = bisect_right(rows, (txn_date, float("inf")))
+    if idx == 0:
+        return None
+    return rows[idx - 1]
+
+
+def eodhd_closes_for_symbol_dates(symbol, txn_dates):
+    # One EOD call covering every requested date; each date is answered from the series.
+    dates = sorted({d for d in (txn_dates or []) if d})
+    if not dates or not eodhd_api_token():
+        return {}
+    try:
+        first = datetime.strptime(dates[0], "%Y-%m-%d")
+    except Exception:
+        return {d: ("unavailable", "EUR") for d in dates}
+    # Look back far enough that a weekend/holiday at the window start still finds a prior close.
+    from_date = (first - timedelta(days=EODHD_PRIOR_CLOSE_LOOKBACK_DAYS)).strftime("%Y-%m-%d")
+    rows = eodhd_eod_series(symbol, from_date, dates[-1])
+
+    out = {}
+    for d in dates:
+        hit = close_on_or_before(rows, d)
+        stale = hit is not None and (
+            datetime.strptime(d, "%Y-%m-%d") - datetime.strptime(hit[0], "%Y-%m-%d")
+        ).days > EODHD_PRIOR_CLOSE_LOOKBACK_DAYS
+        if hit is None or stale:
+            out[d] = ("unavailable", "EUR")
+        else:
+            out[d] = (f"{hit[1]:.6f}", "EUR")
+    return out
 
 
 def normalize_name(value):
@@ -244,29 +1040,42 @@ def normalize_payload_date(value):
 def yahoo_chart(symbol, params):
     query = "&".join([f"{k}={quote_plus(str(v))}" for k, v in params.items()])
     url = f"{YAHOO_CHART_BASE}{quote_plus(symbol)}?{query}"
+    # A period2 window covers history up to the day before period2; range= always includes today.
+    end_ts = int(params["period2"]) - 1 if "period2" in params else time.time()
+    history_end = datetime.fromtimestamp(end_ts, tz=timezone.utc).strftime("%Y-%m-%d")
     return fetch_json(
         url,
         headers={
             "User-Agent": UA,
             "Accept": "application/json",
         },
+        history_end=history_end,
     )
 
 
 def yahoo_symbol_name(symbol):
+    entry = security_directory_get(symbol)
+    cached, fresh = security_directory_lookup(entry, "yahoo_name")
+    if fresh:
+        return cached or ""
     try:
         payload = yahoo_chart(symbol, {"interval": "1d", "range": "5d"})
     except Exception:
-        return ""
+        return cached or ""
     res0 = ((payload or {}).get("chart", {}).get("result") or [None])[0] or {}
     meta = res0.get("meta") or {}
-    name = meta.get("shortName") or meta.get("longName") or ""
-    return normalize_name(name)
+    name = normalize_name(meta.get("shortName") or meta.get("longName") or "")
+    security_directory_update(symbol, yahoo_name=name)
+    return name
 
 
 
 
 def yahoo_symbol_for_isin(isin):
+    entry = security_directory_get(isin)
+    cached, fresh = security_directory_lookup(entry, "yahoo_search")
+    if fresh:
+        return tuple(cached or ("", ""))
     try:
         payload = fetch_json(
             f"{YAHOO_SEARCH_URL}?q={quote_plus(isin)}",
@@ -274,8 +1083,13 @@ def yahoo_symbol_for_isin(isin):
             timeout=20,
         )
     except Exception:
-        return "", ""
+        return tuple(cached or ("", ""))
+    found = _yahoo_symbol_from_search(payload, isin)
+    security_directory_update(isin, yahoo_search=list(found), yahoo_symbol=found[0])
+    return found
+
 
+def _yahoo_symbol_from_search(payload, isin):
     quotes = payload.get("quotes") or []
     best_symbol = ""
     best_name = ""
@@ -406,27 +1220,31 @@ def historical_prices_url_from_security_url(security_url):
     return f"{base}/Kurse-und-Handelsplaetze/Historische-Kurse"
 
 
-def ajax_price_endpoints_from_historical_url(hist_url, page):
-    candidates = []
-    templates = [x.strip() for x in os.environ.get("BNP_WM_CLOSE_AJAX_URLS", "").split(",") if x.strip()]
-    for t in templates:
-        candidates.append(
-            t.replace("{history_url}", hist_url).replace("{page}", str(page))
-        )
-
-    tail_patterns = [
-        f"{hist_url}/_jcr_content/historicalpricechanges.ajax.json?page={page}",
-        f"{hist_url}/_jcr_content/historicalpricechanges.json?page={page}",
-        f"{hist_url}/_jcr_content/historicalPrices.ajax.json?page={page}",
-        f"{hist_url}/_jcr_content/historicalPrices.json?page={page}",
-        f"{hist_url}.ajax.json?page={page}",
-        f"{hist_url}.json?page={page}",
+def ajax_price_templates_from_historical_url(hist_url):
+    # Candidate endpoint templates for a history page; "{page}" is filled per page.
+    templates = [
+        t.replace("{history_url}", hist_url)
+        for t in (x.strip() for x in os.environ.get("BNP_WM_CLOSE_AJAX_URLS", "").split(","))
+        if t
     ]
-    candidates.extend(tail_patterns)
-    return candidates
+    templates.extend([
+        f"{hist_url}/_jcr_content/historicalpricechanges.ajax.json?page={{page}}",
+        f"{hist_url}/_jcr_content/historicalpricechanges.json?page={{page}}",
+        f"{hist_url}/_jcr_content/historicalPrices.ajax.json?page={{page}}",
+        f"{hist_url}/_jcr_content/historicalPrices.json?page={{page}}",
+        f"{hist_url}.ajax.json?page={{page}}",
+        f"{hist_url}.json?page={{page}}",
+    ])
+    return templates
 
 
 def discover_ajax_template_from_history_page(hist_url):
+    # The history HTML is downloaded at most once per BNP_HISTORY_HTML_TTL_HOURS
+    # per instrument; "no template found" is cached too.
+    cached = cache_get(BNP_AJAX_CACHE_NAMESPACE, f"html:{hist_url}")
+    if cached is not None:
+        return cached.get("template") or ""
+
     headers = {
         "User-Agent": UA,
         "Accept": "text/html,application/xhtml+xml",
@@ -437,17 +1255,82 @@ def discover_ajax_template_from_history_page(hist_url):
     except Exception:
         return ""
 
+    template = ""
     m = re.search(r"((?:https?:\\/\\/|\\/)[^\"']*histor[^\"']*ajax[^\"']*json[^\"']*)", html, flags=re.IGNORECASE)
-    if not m:
-        return ""
-    url = unescape(m.group(1)).replace("\/", "/")
-    url = to_absolute_url(url)
-    if "{page}" in url:
-        return url
-    if "page=" in url:
-        return re.sub(r"page=\d+", "page={page}", url)
-    glue = "&" if "?" in url else "?"
-    return f"{url}{glue}page={{page}}"
+    if m:
+        url = unescape(m.group(1)).replace("\\/", "/")
+        url = to_absolute_url(url)
+        if "{page}" in url:
+            template = url
+        elif "page=" in url:
+            template = re.sub(r"page=\d+", "page={page}", url)
+        else:
+            glue = "&" if "?" in url else "?"
+            template = f"{url}{glue}page={{page}}"
+    cache_put(BNP_AJAX_CACHE_NAMESPACE, f"html:{hist_url}", {"template": template}, ttl_seconds=BNP_HISTORY_HTML_TTL_SECONDS)
+    return template
+
+
+def _ajax_template_order(history_url, templates):
+    # Learned ranking: the instrument's last working template, then the shape
+    # that last worked on this host, then the rest; templates that failed for
+    # this instrument are demoted to the end.
+    learned = cache_get(BNP_AJAX_CACHE_NAMESPACE, f"url:{history_url}") or {}
+    host_shape = (cache_get(BNP_AJAX_CACHE_NAMESPACE, f"host:{urlparse(history_url).hostname}") or {}).get("shape") or ""
+    failed = set(learned.get("failed") or [])
+    preferred = [learned.get("working") or "", host_shape.replace("{history_url}", history_url)]
+    ordered = []
+    for t in preferred + templates:
+        if t and t not in ordered:
+            ordered.append(t)
+    return [t for t in ordered if t not in failed] + [t for t in ordered if t in failed]
+
+
+def _ajax_template_learn(history_url, working, failed):
+    learned = cache_get(BNP_AJAX_CACHE_NAMESPACE, f"url:{history_url}") or {}
+    if working == learned.get("working") and not (set(failed) - set(learned.get("failed") or [])):
+        return
+    demoted = sorted((set(learned.get("failed") or []) | set(failed)) - {working})
+    cache_put(BNP_AJAX_CACHE_NAMESPACE, f"url:{history_url}", {"working": working or learned.get("working") or "", "failed": demoted})
+    if working and history_url in working:
+        cache_put(
+            BNP_AJAX_CACHE_NAMESPACE,
+            f"host:{urlparse(history_url).hostname}",
+            {"shape": working.replace(history_url, "{history_url}")},
+        )
+
+
+def _close_from_ajax_payload(payload_text, txn_date):
+    # JSON path first
+    try:
+        payload_json = json.loads(payload_text)
+        for obj in iter_dicts(payload_json):
+            val = extract_close_value_from_json_obj(obj, txn_date)
+            if val is not None:
+                return val
+    except Exception:
+        pass
+
+    # Text fallback
+    d = re.escape(txn_date)
+    patterns = [
+        rf"{d}[^\n\r]{{0,180}}(?:close|closing|closePrice|price|nav|kurs|schlusskurs)\"?\s*[:=]\s*\"?([0-9]+(?:[\\.,][0-9]+)?)",
+        rf"(?:close|closing|closePrice|price|nav|kurs|schlusskurs)\"?\s*[:=]\s*\"?([0-9]+(?:[\\.,][0-9]+)?)[^\n\r]{{0,180}}{d}",
+    ]
+    for pattern in patterns:
+        m = re.search(pattern, payload_text, flags=re.IGNORECASE)
+        if m:
+            val = maybe_parse_float(m.group(1))
+            if val is not None:
+                return val
+    return None
+
+
+def _is_json_payload(payload_text):
+    try:
+        return any(True for _ in iter_dicts(json.loads(payload_text)))
+    except Exception:
+        return False
 
 
 def find_closing_price_via_ajax(history_url, txn_date):
@@ -459,48 +1342,37 @@ def find_closing_price_via_ajax(history_url, txn_date):
     page_limit = int(os.environ.get("BNP_WM_CLOSE_PAGE_LIMIT", "80"))
 
     discovered_template = discover_ajax_template_from_history_page(history_url)
-
+    templates = ajax_price_templates_from_historical_url(history_url)
+    if discovered_template:
+        templates.insert(0, discovered_template)
+    templates = _ajax_template_order(history_url, templates)
+
+    # Once a template answers with JSON it is pinned: later pages only use it.
+    working = ""
+    failed = []
+    result = "unavailable"
     for page in range(0, page_limit):
-        page_urls = []
-        if discovered_template:
-            page_urls.append(discovered_template.replace("{page}", str(page)))
-        page_urls.extend(ajax_price_endpoints_from_historical_url(history_url, page))
-
-        seen = set()
+        if deadline_exceeded():
+            break
         page_found_any = False
-        for url in page_urls:
-            if url in seen:
-                continue
-            seen.add(url)
+        value = None
+        for template in ([working] if working else templates):
             try:
-                payload_text = fetch_text(url, headers=headers)
+                payload_text = fetch_text(template.replace("{page}", str(page)), headers=headers)
             except Exception:
+                if page == 0 and template not in failed:
+                    failed.append(template)
                 continue
             page_found_any = True
+            if not working and _is_json_payload(payload_text):
+                working = template
+            value = _close_from_ajax_payload(payload_text, txn_date)
+            if value is not None or working:
+                break
 
-            # JSON path first
-            try:
-                payload_json = json.loads(payload_text)
-                for obj in iter_dicts(payload_json):
-                    val = extract_close_value_from_json_obj(obj, txn_date)
-                    if val is not None:
-                        return f"{val:.4f}"
-            except Exception:
-                pass
-
-            # Text fallback
-            d = re.escape(txn_date)
-            patterns = [
-                rf"{d}[^\n\r]{{0,180}}(?:close|closing|closePrice|price|nav|kurs|schlusskurs)\"?\s*[:=]\s*\"?([0-9]+(?:[\\.,][0-9]+)?)",
-                rf"(?:close|closing|closePrice|price|nav|kurs|schlusskurs)\"?\s*[:=]\s*\"?([0-9]+(?:[\\.,][0-9]+)?)[^\n\r]{{0,180}}{d}",
-            ]
-            for pattern in patterns:
-                m = re.search(pattern, payload_text, flags=re.IGNORECASE)
-                if m:
-                    val = maybe_parse_float(m.group(1))
-                    if val is not None:
-                        return f"{val:.4f}"
-
+        if value is not None:
+            result = f"{value:.4f}"
+            break
         # if no endpoint responded on first page at all, likely wrong endpoint family
         if page == 0 and not page_found_any and not discovered_template:
             continue
@@ -508,9 +1380,8 @@ def find_closing_price_via_ajax(history_url, txn_date):
         if page > 0 and not page_found_any:
             break
 
-    return "unavailable"
-
-
+    _ajax_template_learn(history_url, working, failed)
+    return result
 
 
 def _extract_consors_ids(meta_payload):
@@ -531,53 +1402,216 @@ def _extract_consors_ids(meta_payload):
     return ids
 
 
+def _marketdata_history_page(market_type, instrument_id, page, headers):
+    # One HistoryV1 page as ascending [(date, close, ccy)]; [] when the server
+    # answered without history rows (past the end, or an id/market type it does
+    # not serve: 4xx or a payload without HistoryV1), None when the fetch failed
+    # (timeout, 5xx, 429, unreadable body) and may succeed on a retry.
+    hist_url = (
+        f"{BASE_DOMAIN}/web-financialinfo-service/api/marketdata/{market_type}"
+        f"?id={quote_plus(str(instrument_id))}&field=HistoryV1&page={page}&range=-5000&resolution=1D"
+    )
+    try:
+        hist_payload = bnp_fetch_json(hist_url, headers=headers)
+    except HTTPError as e:
+        return [] if 400 <= e.code < 500 and e.code != 429 else None
+    except Exception:
+        return None
+    if not isinstance(hist_payload, list) or not hist_payload or not isinstance(hist_payload[0], dict):
+        return []
+
+    rows = []
+    for item in (hist_payload[0].get("HistoryV1") or {}).get("ITEMS") or []:
+        item_date = normalize_payload_date(item.get("DATETIME_LAST") or item.get("date") or "")
+        if not item_date:
+            continue
+        close_val = maybe_parse_float(item.get("LAST"))
+        if close_val is None:
+            close_val = maybe_parse_float(item.get("close"))
+        if close_val is None:
+            continue
+        rows.append((item_date, close_val, normalize_currency_code(item.get("ISO_CURRENCY"))))
+    return sorted(rows)
+
+
+class HistoryPageUnavailable(Exception):
+    """A HistoryV1 page needed to place txn_date could not be fetched."""
+
+
+def _locate_history_page(fetch_page, txn_date, page_limit):
+    # Pages run newest (page 0) to oldest. Find the first page whose oldest row
+    # is on or before txn_date: exponential probe for an upper bound, then
+    # binary search, i.e. O(log pages) fetches instead of a linear scan.
+    # Past-the-end (empty) pages count as "on or before". Only [] means "no
+    # rows"; a page that fails twice (None) raises HistoryPageUnavailable
+    # rather than steering the search. Returns that page's rows.
+    def fetch_or_raise(page):
+        rows = fetch_page(page)
+        if rows is None:
+            rows = fetch_page(page, retry=True)
+        if rows is None:
+            raise HistoryPageUnavailable(f"HistoryV1 page {page} unavailable")
+        return rows
+
+    def reaches(page):
+        rows = fetch_or_raise(page)
+        return not rows or rows[0][0] <= txn_date
+
+    first = 0
+    if not fetch_or_raise(0):
+        # Some instruments only answer from page 1.
+        first = 1
+        if page_limit < 2 or not fetch_or_raise(1):
+            return None
+    if reaches(first):
+        return fetch_page(first)
+
+    lo, step = first, 1  # invariant: page lo is entirely after txn_date
+    hi = None
+    while lo + step < page_limit:
+        if deadline_exceeded():
+            return None
+        if reaches(lo + step):
+            hi = lo + step
+            break
+        lo += step
+        step *= 2
+    if hi is None:
+        if lo + 1 >= page_limit or not reaches(page_limit - 1):
+            return None
+        hi = page_limit - 1
+
+    while hi - lo > 1:
+        if deadline_exceeded():
+            return None
+        mid = (lo + hi) // 2
+        if reaches(mid):
+            hi = mid
+        else:
+            lo = mid
+    return fetch_page(hi)
+
+
+def _history_mirror_load(market_type, instrument_id):
+    # Local copy of an instrument's HistoryV1 closes, kept in the resolver cache:
+    # ascending dates/closes/ccys, the date ranges known to be complete
+    # ("segments"), and the first date of the whole history once seen ("start").
+    cached = cache_get(BNP_HISTORY_CACHE_NAMESPACE, f"{market_type}:{instrument_id}") or {}
+    return {
+        "dates": list(cached.get("dates") or []),
+        "closes": list(cached.get("closes") or []),
+        "ccys": list(cached.get("ccys") or []),
+        "segments": [list(seg) for seg in cached.get("segments") or []],
+        "start": cached.get("start") or "",
+    }
+
+
+def _history_mirror_lookup(mirror, txn_date):
+    # (close, ccy) answered from the mirror, ("", "") when the date is known to
+    # predate the history, or None when the mirror does not cover txn_date.
+    if mirror["start"] and txn_date < mirror["start"]:
+        return "", ""
+    if not any(lo <= txn_date <= hi for lo, hi in mirror["segments"]):
+        return None
+    i = bisect_right(mirror["dates"], txn_date) - 1
+    if i < 0:
+        return None
+    return f"{mirror['closes'][i]:.4f}", mirror["ccys"][i]
+
+
+def _history_mirror_merge(mirror, pages):
+    # Folds fetched pages ({page: rows or None}) into the mirror. Each run of
+    # consecutive non-empty pages is one complete segment; an empty (not failed)
+    # page right after a non-empty one marks the start of the history. Today's row can
+    # still move intraday, so only closes before today are kept.
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    rows = dict(zip(mirror["dates"], zip(mirror["closes"], mirror["ccys"])))
+    segments = [list(seg) for seg in mirror["segments"]]
+    run = None
+    for page in sorted(pages):
+        page_rows = [r for r in pages[page] or () if r[0] < today]
+        if not pages[page]:
+            if pages[page] == [] and run is not None and pages.get(page - 1):
+                mirror["start"] = run[0]
+            run = None
+            continue
+        for d, close, ccy in page_rows:
+            rows[d] = (close, ccy)
+        if not page_rows:
+            run = None
+            continue
+        if run is not None and pages.get(page - 1):
+            run[0] = page_rows[0][0]
+        else:
+            run = [page_rows[0][0], page_rows[-1][0]]
+            segments.append(run)
+
+    merged = []
+    for lo, hi in sorted(segments):
+        if merged and lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+    ordered = sorted(rows)
+    mirror["dates"] = ordered
+    mirror["closes"] = [rows[d][0] for d in ordered]
+    mirror["ccys"] = [rows[d][1] for d in ordered]
+    mirror["segments"] = merged
+    return mirror
+
+
 def _scan_marketdata_history(market_type, instrument_ids, txn_date, headers, page_limit=80):
+    # Answers from the local history mirror when it covers txn_date; otherwise
+    # tops it up from page 0 (dates after its high-water mark) or locates the
+    # page holding txn_date, and stores every fetched page. Raises
+    # HistoryPageUnavailable when no close was found and a lookup was cut short
+    # by a failed page, so callers do not read that as "no history".
     best_prior = None
+    failed = False
     for instrument_id in instrument_ids:
-        for page in range(0, page_limit):
-            hist_url = (
-                f"{BASE_DOMAIN}/web-financialinfo-service/api/marketdata/{market_type}"
-                f"?id={quote_plus(str(instrument_id))}&field=HistoryV1&page={page}&range=-5000&resolution=1D"
-            )
-            try:
-                hist_payload = bnp_fetch_json(hist_url, headers=headers)
-            except Exception:
-                if page > 0:
-                    break
-                continue
-
-            if not isinstance(hist_payload, list) or not hist_payload or not isinstance(hist_payload[0], dict):
-                if page > 0:
-                    break
-                continue
-
-            items = (hist_payload[0].get("HistoryV1") or {}).get("ITEMS") or []
-            if not items:
-                if page > 0:
-                    break
-                continue
+        if deadline_exceeded():
+            break
+        mirror = _history_mirror_load(market_type, instrument_id)
+        hit = _history_mirror_lookup(mirror, txn_date)
+        if hit is not None:
+            if hit[0]:
+                return hit
+            continue
 
-            for item in items:
-                item_date = normalize_payload_date(item.get("DATETIME_LAST") or item.get("date") or "")
-                if not item_date:
-                    continue
-                close_val = maybe_parse_float(item.get("LAST"))
-                if close_val is None:
-                    close_val = maybe_parse_float(item.get("close"))
-                if close_val is None:
-                    continue
+        pages = {}
 
-                item_ccy = normalize_currency_code(item.get("ISO_CURRENCY"))
+        def fetch_page(page, retry=False):
+            if page not in pages or (retry and pages[page] is None and not deadline_exceeded()):
+                pages[page] = _marketdata_history_page(market_type, instrument_id, page, headers)
+            return pages[page]
 
-                if item_date == txn_date:
-                    return f"{close_val:.4f}", item_ccy
+        try:
+            if mirror["segments"] and txn_date > mirror["segments"][-1][1]:
+                located = fetch_page(0)
+                if not located or located[0][0] > txn_date:
+                    located = _locate_history_page(fetch_page, txn_date, page_limit)
+            else:
+                located = _locate_history_page(fetch_page, txn_date, page_limit)
+        except HistoryPageUnavailable:
+            failed = True
+            located = None
+        if any(pages.values()):
+            cache_put(
+                BNP_HISTORY_CACHE_NAMESPACE,
+                f"{market_type}:{instrument_id}",
+                _history_mirror_merge(mirror, pages),
+            )
 
-                if item_date <= txn_date:
-                    if best_prior is None or item_date > best_prior[0]:
-                        best_prior = (item_date, close_val, item_ccy)
+        for item_date, close_val, item_ccy in located or ():
+            if item_date == txn_date:
+                return f"{close_val:.4f}", item_ccy
+            if item_date < txn_date and (best_prior is None or item_date > best_prior[0]):
+                best_prior = (item_date, close_val, item_ccy)
 
     if best_prior is not None:
         return f"{best_prior[1]:.4f}", best_prior[2]
+    if failed:
+        raise HistoryPageUnavailable(f"HistoryV1 lookup for {txn_date} incomplete")
     return "", ""
 
 
@@ -588,20 +1622,62 @@ def bnp_marketdata_history_close_for_isin_date(isin, txn_date):
         "Referer": f"{BASE_DOMAIN}/web/home",
     }
     page_limit = int(os.environ.get("BNP_WM_CLOSE_PAGE_LIMIT", "80"))
+
+    # Known route (market type + history ids) for this ISIN: try it first.
+    route = cache_get(BNP_ROUTE_CACHE_NAMESPACE, isin)
+    if route and route.get("market_type") and route.get("instrument_ids"):
+        try:
+            close_price, close_ccy = _scan_marketdata_history(
+                route["market_type"],
+                route["instrument_ids"],
+                txn_date,
+                headers,
+                page_limit=page_limit,
+            )
+        except HistoryPageUnavailable:
+            # Transient failure: keep the route, just report no close this time.
+            return "", ""
+        if close_price:
+            return close_price, close_ccy
+        if _route_has_history(route["market_type"], route["instrument_ids"]):
+            # The route still serves history; the date itself is just not covered.
+            return "", ""
+        cache_invalidate(BNP_ROUTE_CACHE_NAMESPACE, isin)
+
+    close_price, close_ccy, route = _probe_marketdata_history(isin, txn_date, headers, page_limit)
+    if route:
+        cache_put(BNP_ROUTE_CACHE_NAMESPACE, isin, route, ttl_seconds=BNP_ROUTE_TTL_SECONDS)
+    return close_price, close_ccy
+
+
+def _route_has_history(market_type, instrument_ids):
+    return any(_history_mirror_load(market_type, iid)["dates"] for iid in instrument_ids)
+
+
+def _probe_marketdata_history(isin, txn_date, headers, page_limit):
+    # Full probe over every market type; returns (close, ccy, route) where route
+    # is the {"market_type", "instrument_ids"} whose history answered, even if
+    # it has no close for txn_date. A lookup cut short by a failed page ends the
+    # probe without a route, so nothing is cached from a partial answer.
     market_types = ["funds", "stocks", "bonds", "etfs", "certificates", "indices"]
     basic_fields = ["BasicV2", "BasicV1"]
 
     for market_type in market_types:
+        if deadline_exceeded():
+            break
         # First, try history directly by ISIN (works for some instruments/endpoints).
-        direct_close, direct_ccy = _scan_marketdata_history(
-            market_type,
-            [isin],
-            txn_date,
-            headers,
-            page_limit=page_limit,
-        )
-        if direct_close:
-            return direct_close, direct_ccy
+        try:
+            direct_close, direct_ccy = _scan_marketdata_history(
+                market_type,
+                [isin],
+                txn_date,
+                headers,
+                page_limit=page_limit,
+            )
+        except HistoryPageUnavailable:
+            return "", "", None
+        if direct_close or _route_has_history(market_type, [isin]):
+            return direct_close, direct_ccy, {"market_type": market_type, "instrument_ids": [isin]}
 
         consors_ids = []
         seen_ids = set()
@@ -624,17 +1700,20 @@ def bnp_marketdata_history_close_for_isin_date(isin, txn_date):
         if not consors_ids:
             continue
 
-        close_price, close_ccy = _scan_marketdata_history(
-            market_type,
-            consors_ids,
-            txn_date,
-            headers,
-            page_limit=page_limit,
-        )
-        if close_price:
-            return close_price, close_ccy
+        try:
+            close_price, close_ccy = _scan_marketdata_history(
+                market_type,
+                consors_ids,
+                txn_date,
+                headers,
+                page_limit=page_limit,
+            )
+        except HistoryPageUnavailable:
+            return "", "", None
+        if close_price or _route_has_history(market_type, consors_ids):
+            return close_price, close_ccy, {"market_type": market_type, "instrument_ids": consors_ids}
 
-    return "", ""
+    return "", "", None
 
 
 def bnp_closing_price_for_isin_date(isin, txn_date, security_url=""):
@@ -664,9 +1743,7 @@ def bnp_closing_price_for_isin_date(isin, txn_date, security_url=""):
     return "unavailable", ""
 
 
-def resolve_security_metadata(isin, txn_date=None):
-    candidates = eodhd_search_candidates_for_isin(isin)
-    best = eodhd_pick_best_eur(candidates)
+def _security_metadata_from_best(isin, best, close_price, close_ccy):
     if not best:
         return {
             "name": "",
@@ -678,9 +1755,7 @@ def resolve_security_metadata(isin, txn_date=None):
             "txn_close_currency": "EUR",
         }
 
-    close_price, close_ccy = eodhd_close_for_symbol_date(best.get("symbol", ""), txn_date) if txn_date else ("", "EUR")
     close_with_ccy = combine_close_and_currency(close_price, close_ccy)
-
     return {
         "name": best.get("name") or normalize_isin(isin),
         "symbol": best.get("symbol") or normalize_isin(isin),
@@ -692,11 +1767,7 @@ def resolve_security_metadata(isin, txn_date=None):
     }
 
 
-def resolve_symbol_metadata(symbol, txn_date=None):
-    normalized = normalize_symbol(symbol)
-    if not normalized:
-        return {"name": "", "url": "", "source": "", "category": "", "txn_close_price": ""}
-    close_price, close_ccy = eodhd_close_for_symbol_date(normalized, txn_date) if txn_date else ("", "EUR")
+def _symbol_metadata_from_close(normalized, close_price, close_ccy):
     close_with_ccy = combine_close_and_currency(close_price, close_ccy)
     return {
         "name": normalized,
@@ -709,6 +1780,55 @@ def resolve_symbol_metadata(symbol, txn_date=None):
     }
 
 
+def resolve_security_metadata(isin, txn_date=None, refresh=False):
+    return resolve_security_metadata_for_dates(isin, [txn_date or ""], refresh=refresh)[txn_date or ""]
+
+
+def resolve_security_metadata_for_dates(isin, txn_dates, refresh=False):
+    # Range variant: one cached listing lookup and one EOD call covering all dates.
+    dates = sorted({d or "" for d in (txn_dates or [])})
+    best = eodhd_best_listing_for_isin(isin, refresh=refresh)
+    closes = eodhd_closes_for_symbol_dates(best.get("symbol", ""), dates) if best else {}
+    out = {}
+    for d in dates:
+        close_price, close_ccy = closes.get(d, ("unavailable", "EUR")) if d else ("", "EUR")
+        out[d] = _security_metadata_from_best(isin, best, close_price, close_ccy)
+    return out
+
+
+def resolve_symbol_metadata(symbol, txn_date=None):
+    normalized = normalize_symbol(symbol)
+    if not normalized:
+        return {"name": "", "url": "", "source": "", "category": "", "txn_close_price": ""}
+    return resolve_symbol_metadata_for_dates(normalized, [txn_date or ""])[txn_date or ""]
+
+
+def resolve_symbol_metadata_for_dates(symbol, txn_dates):
+    normalized = normalize_symbol(symbol)
+    dates = sorted({d or "" for d in (txn_dates or [])})
+    if not normalized:
+        return {d: {"name": "", "url": "", "source": "", "category": "", "txn_close_price": ""} for d in dates}
+    closes = eodhd_closes_for_symbol_dates(normalized, dates)
+    out = {}
+    for d in dates:
+        if not d:
+            close_price, close_ccy = "", "EUR"
+        elif not eodhd_api_token():
+            close_price, close_ccy = "", ""
+        else:
+            close_price, close_ccy = closes.get(d, ("unavailable", "EUR"))
+        out[d] = _symbol_metadata_from_close(normalized, close_price, close_ccy)
+    return out
+
+
+def resolve_metadata_for_dates(symbol, txn_dates):
+    # Dispatch on ISIN vs. ticker; returns {txn_date: metadata} for every requested date.
+    isin = normalize_isin(symbol)
+    if isin:
+        return resolve_security_metadata_for_dates(isin, txn_dates)
+    return resolve_symbol_metadata_for_dates(symbol, txn_dates)
+
+
 def to_absolute_url(path_or_url):
     value = (path_or_url or "").strip()
     if not value:
@@ -839,42 +1959,50 @@ def search_json_endpoints_for_isin(isin):
 
 
 def discover_security_url_for_isin(isin):
+    # {"url", "source", "name_hint"} on a hit, {} when every search answered
+    # without one, None when a search failed (error, timeout, deadline) and the
+    # miss is therefore not conclusive.
     headers = {
         "User-Agent": UA,
         "Accept": "text/html,application/json;q=0.9,*/*;q=0.8",
         "Referer": f"{BASE_DOMAIN}/web/home",
     }
+    candidates = search_result_pages_for_isin(isin) + search_json_endpoints_for_isin(isin)
 
-    best_name = ""
-
-    for candidate in search_result_pages_for_isin(isin):
+    def probe(candidate):
+        if deadline_exceeded():
+            return None
         try:
             payload = fetch_text(candidate, headers=headers)
         except Exception:
-            continue
-        name_hint = extract_name_hint_from_text(payload, isin)
-        if name_hint and not best_name:
-            best_name = name_hint
-        security_url = extract_security_url_from_text(payload, isin)
-        if security_url:
-            return {"url": security_url, "source": candidate, "name_hint": name_hint or best_name}
-
-    for candidate in search_json_endpoints_for_isin(isin):
-        try:
-            payload = fetch_text(candidate, headers=headers)
-        except Exception:
-            continue
-        name_hint = extract_name_hint_from_text(payload, isin)
-        if name_hint and not best_name:
-            best_name = name_hint
-        security_url = extract_security_url_from_text(payload, isin)
-        if security_url:
-            return {"url": security_url, "source": candidate, "name_hint": name_hint or best_name}
+            return None
+        return extract_name_hint_from_text(payload, isin), extract_security_url_from_text(payload, isin)
+
+    # Hedged search: candidates are fetched concurrently, but results are taken
+    # in priority order, so a hit only wins once every earlier candidate missed.
+    # Queued candidates are dropped as soon as the winner is known.
+    best_name = ""
+    failed = False
+    pool = ThreadPoolExecutor(max_workers=max(1, min(BNP_SEARCH_MAX_WORKERS, len(candidates))))
+    try:
+        futures = [pool.submit(contextvars.copy_context().run, probe, c) for c in candidates]
+        for candidate, future in zip(candidates, futures):
+            result = future.result()
+            if not result:
+                failed = True
+                continue
+            name_hint, security_url = result
+            if name_hint and not best_name:
+                best_name = name_hint
+            if security_url:
+                return {"url": security_url, "source": candidate, "name_hint": name_hint or best_name}
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
 
     if best_name:
         return {"url": "", "source": "search-text", "name_hint": best_name}
 
-    return None
+    return None if failed else {}
 
 
 def extract_security_name_from_page(url):
@@ -922,21 +2050,34 @@ def extract_security_name_from_page(url):
 
 def openfigi_name_for_isin(isin):
     # Fallback resolver when BNP page discovery fails.
+    entry = security_directory_get(isin)
+    cached, fresh = security_directory_lookup(entry, "openfigi_name")
+    if fresh:
+        return cached or ""
+    name = _openfigi_name_for_isin(isin)
+    if name is None:
+        return cached or ""
+    security_directory_update(isin, openfigi_name=name)
+    return name
+
+
+def _openfigi_name_for_isin(isin):
+    # "" when OpenFIGI has no usable name, None when the call itself failed.
     try:
-        req = Request(
+        response = http_request(
+            "POST",
             "https://api.openfigi.com/v3/mapping",
-            data=json.dumps([{"idType": "ID_ISIN", "idValue": isin}]).encode("utf-8"),
             headers={
                 "User-Agent": UA,
                 "Content-Type": "application/json",
                 "Accept": "application/json",
             },
-            method="POST",
+            data=json.dumps([{"idType": "ID_ISIN", "idValue": isin}]).encode("utf-8"),
+            timeout=25,
         )
-        with urlopen(req, timeout=25) as response:
-            payload = json.loads(response.read().decode("utf-8"))
+        payload = json.loads(response.body.decode("utf-8"))
     except Exception:
-        return ""
+        return None
 
     if not isinstance(payload, list) or not payload:
         return ""
@@ -959,6 +2100,31 @@ def openfigi_name_for_isin(isin):
     return candidate
 
 def bnp_find_url_and_name_for_isin(isin):
+    # Security directory first; BNP discovery (with its OpenFIGI fallback) only
+    # runs when the stored result is missing or older than the max age.
+    entry = security_directory_get(isin)
+    cached, fresh = security_directory_lookup(entry, "bnp")
+    if fresh:
+        return cached or None
+    found = _bnp_find_url_and_name_for_isin(isin)
+    if found:
+        security_directory_update(
+            isin,
+            bnp=found,
+            name=found.get("name") or "",
+            bnp_url=found.get("url") or "",
+            category=found.get("category") or "",
+        )
+    elif found is not None and not deadline_exceeded():
+        # Only a conclusive miss is recorded; failed lookups (None) and misses
+        # cut short by the deadline are retried next time.
+        security_directory_update(isin, bnp={})
+    return found or None
+
+
+def _bnp_find_url_and_name_for_isin(isin):
+    # The BNP result dict, {} when BNP and OpenFIGI conclusively have nothing,
+    # None when a fetch failed along the way.
     discovered = discover_security_url_for_isin(isin)
     if not discovered:
         fallback_name = openfigi_name_for_isin(isin)
@@ -969,7 +2135,7 @@ def bnp_find_url_and_name_for_isin(isin):
                 "source": "openfigi",
                 "category": "",
             }
-        return None
+        return discovered
 
     name_hint = normalize_name(discovered.get("name_hint"))
     if name_hint and normalize_isin(name_hint) != isin:
@@ -990,14 +2156,15 @@ def bnp_find_url_and_name_for_isin(isin):
                 "source": "openfigi",
                 "category": "",
             }
-        return None
+        return {}
 
     try:
         name = extract_security_name_from_page(url)
     except Exception:
-        name = ""
+        name = None
 
-    name = normalize_name(name)
+    page_failed = name is None
+    name = normalize_name(name or "")
     if not name or normalize_isin(name) == isin:
         fallback_name = openfigi_name_for_isin(isin)
         if fallback_name:
@@ -1007,7 +2174,7 @@ def bnp_find_url_and_name_for_isin(isin):
                 "source": "openfigi",
                 "category": "",
             }
-        return None
+        return None if page_failed else {}
 
     parsed = urlparse(url)
     path = parsed.path or ""
@@ -1024,6 +2191,72 @@ def bnp_find_url_and_name_for_isin(isin):
     }
 
 
+def patch_transaction_row(supabase_url, headers, row):
+    payload = dict(row)
+    row_id = payload.pop("id")
+    http_request(
+        "PATCH",
+        f"{supabase_url}/rest/v1/transactions?id=eq.{quote_plus(str(row_id))}",
+        headers={**headers, "Content-Type": "application/json", "Prefer": "return=minimal"},
+        data=json.dumps(payload).encode("utf-8"),
+        timeout=30,
+    )
+
+
+def bulk_update_transactions(supabase_url, headers, user_id, rows, chunk_size=None):
+    # Applies {"id", column: value} rows chunk by chunk through the
+    # bulk_update_transaction_metadata RPC (sql/bulk_update_transaction_metadata.sql).
+    # A failing chunk is bisected until the bad record is isolated, so one
+    # malformed row only loses itself. Falls back to one PATCH per row when the
+    # RPC is not installed. Returns (applied, unapplied, errors).
+    size = max(1, chunk_size or TXN_UPDATE_CHUNK_SIZE)
+    stack = [rows[i:i + size] for i in range(0, len(rows), size)][::-1]
+    applied = 0
+    unapplied = 0
+    errors = []
+    use_rpc = True
+    while stack:
+        chunk = stack.pop()
+        if deadline_exceeded():
+            unapplied += len(chunk)
+            continue
+        if not use_rpc and len(chunk) > 1:
+            stack.extend([row] for row in reversed(chunk))
+            continue
+        try:
+            if use_rpc:
+                resp = http_request(
+                    "POST",
+                    f"{supabase_url}/rest/v1/rpc/bulk_update_transaction_metadata",
+                    headers={**headers, "Content-Type": "application/json"},
+                    data=json.dumps({
+                        "p_user_id": user_id,
+                        "p_rows": [{k: v for k, v in row.items() if k != "user_id"} for row in chunk],
+                    }).encode("utf-8"),
+                    timeout=30,
+                )
+                try:
+                    applied += int(json.loads(resp.body.decode("utf-8")))
+                except (TypeError, ValueError):
+                    applied += len(chunk)
+            else:
+                patch_transaction_row(supabase_url, headers, chunk[0])
+                applied += 1
+        except (DeadlineExceeded, CircuitOpen):
+            unapplied += len(chunk)
+        except Exception as e:
+            if use_rpc and isinstance(e, HTTPError) and e.code == 404:
+                use_rpc = False
+                stack.append(chunk)
+            elif len(chunk) > 1:
+                mid = len(chunk) // 2
+                stack.append(chunk[mid:])
+                stack.append(chunk[:mid])
+            elif len(errors) < 10:
+                errors.append(f"id={chunk[0].get('id')}: {e}")
+    return applied, unapplied, errors
+
+
 class handler(BaseHTTPRequestHandler):
     def _cors(self):
         self.send_header("Access-Control-Allow-Origin", "*")
@@ -1043,6 +2276,10 @@ class handler(BaseHTTPRequestHandler):
         self.end_headers()
 
     def do_GET(self):
+        with deadline_scope(API_REQUEST_BUDGET_SECONDS - API_RESPONSE_RESERVE_SECONDS):
+            self._handle_get()
+
+    def _handle_get(self):
         try:
             auth = self.headers.get("Authorization", "")
             if not auth.startswith("Bearer "):
@@ -1082,7 +2319,8 @@ class handler(BaseHTTPRequestHandler):
 
             if isin:
                 txn_date = (q.get("txn_date") or [""])[0]
-                meta = resolve_security_metadata(isin, txn_date=txn_date)
+                refresh = (q.get("refresh") or [""])[0].lower() in ("1", "true", "yes")
+                meta = resolve_security_metadata(isin, txn_date=txn_date, refresh=refresh)
                 if not meta.get("name"):
                     self._send(404, {"status": "error", "message": f"No security name found for {isin}"})
                     return
@@ -1116,8 +2354,12 @@ class handler(BaseHTTPRequestHandler):
                 elif old_name.upper() != row_symbol:
                     canonical_names[row_symbol] = old_name
 
-            pair_cache = {}
-            updates = []
+            # Plan first: collect the distinct symbols that need a name and the
+            # distinct (symbol, date) closes, then resolve each symbol once over
+            # its whole date range. Names come from the per-ISIN listing, so they
+            # are resolved once per ISIN regardless of how many dates it has.
+            candidates = []
+            wanted = {}  # symbol -> dates needing a close (may be empty: name only)
             for row in txs:
                 row_id = row.get("id")
                 row_symbol = normalize_symbol(row.get("symbol"))
@@ -1135,29 +2377,51 @@ class handler(BaseHTTPRequestHandler):
 
                 if not needs_name and not needs_close:
                     continue
-
-                key = (row_symbol, txn_date)
-                if key not in pair_cache:
-                    try:
-                        if row_isin:
-                            meta = resolve_security_metadata(row_isin, txn_date=txn_date)
-                        else:
-                            meta = resolve_symbol_metadata(row_symbol, txn_date=txn_date)
-                    except Exception:
-                        meta = {"name": canonical_names.get(row_symbol, ""), "txn_close_price": "unavailable", "txn_close_currency": ""}
-
-                    if canonical_names.get(row_symbol):
-                        meta["name"] = canonical_names[row_symbol]
-                    if meta.get("name"):
-                        canonical_names[row_symbol] = meta["name"]
-                    pair_cache[key] = meta
-                meta = pair_cache[key]
+                candidates.append((row, row_symbol, txn_date, needs_name, needs_close))
+                dates = wanted.setdefault(row_symbol, set())
+                if needs_close:
+                    dates.add(txn_date)
+
+            def resolve_one(row_symbol):
+                if deadline_exceeded():
+                    return None
+                try:
+                    return resolve_metadata_for_dates(row_symbol, sorted(wanted[row_symbol]) or [""])
+                except DeadlineExceeded:
+                    return None
+                except Exception:
+                    return {}
+
+            symbols = sorted(wanted)
+            names = {}   # symbol -> resolved name
+            closes = {}  # (symbol, txn_date) -> close text
+            skipped_symbols = []
+            for row_symbol, metas in zip(symbols, parallel_map(resolve_one, symbols)):
+                if metas is None:
+                    skipped_symbols.append(row_symbol)
+                    continue
+                name = canonical_names.get(row_symbol) or next(
+                    (m.get("name") for m in metas.values() if m.get("name")), ""
+                )
+                if name:
+                    names[row_symbol] = name
+                for txn_date in wanted[row_symbol]:
+                    meta = metas.get(txn_date)
+                    closes[(row_symbol, txn_date)] = meta.get("txn_close_price") if meta else "unavailable"
+
+            skipped = set(skipped_symbols)
+            updates = []
+            for row, row_symbol, txn_date, needs_name, needs_close in candidates:
+                if row_symbol in skipped:
+                    # Deadline skipped this symbol; leave the row for the next sync.
+                    continue
+                row_id = row.get("id")
 
                 update_row = {"id": row_id, "user_id": user_id}
-                if needs_name and meta.get("name"):
-                    update_row["security_name"] = meta["name"]
+                if needs_name and names.get(row_symbol):
+                    update_row["security_name"] = names[row_symbol]
                 if needs_close:
-                    resolved_close = meta.get("txn_close_price")
+                    resolved_close = closes.get((row_symbol, txn_date))
                     if not resolved_close:
                         fallback_price = maybe_parse_float(row.get("price"))
                         resolved_close = f"{fallback_price:.4f}" if fallback_price is not None else "unavailable"
@@ -1166,43 +2430,29 @@ class handler(BaseHTTPRequestHandler):
                 if len(update_row) > 2:
                     updates.append(update_row)
 
-            applied_updates = 0
-            update_errors = []
-            if updates:
-                # Apply row-by-row so a single malformed record does not fail whole sync.
-                for row in updates:
-                    row_id = row.get("id")
-                    if row_id is None:
-                        continue
-                    payload = dict(row)
-                    payload.pop("id", None)
-                    if not payload:
-                        continue
-                    req = Request(
-                        f"{supabase_url}/rest/v1/transactions?id=eq.{quote_plus(str(row_id))}",
-                        data=json.dumps(payload).encode("utf-8"),
-                        headers={
-                            **supa_headers,
-                            "Content-Type": "application/json",
-                            "Prefer": "return=minimal",
-                        },
-                        method="PATCH",
-                    )
-                    try:
-                        with urlopen(req, timeout=30):
-                            applied_updates += 1
-                    except Exception as e:
-                        if len(update_errors) < 10:
-                            update_errors.append(f"id={row_id}: {e}")
+            # Chunked bulk update; a bad record is isolated by bisecting its chunk.
+            applied_updates, unapplied_updates, update_errors = bulk_update_transactions(
+                supabase_url,
+                supa_headers,
+                user_id,
+                [row for row in updates if row.get("id") is not None],
+            )
 
             response = {
                 "status": "ok",
                 "updated_rows": applied_updates,
-                "resolved_symbols": len(pair_cache),
+                "resolved_symbols": len(symbols) - len(skipped_symbols),
                 "candidate_updates": len(updates),
             }
             if update_errors:
                 response["warnings"] = update_errors
+            if skipped_symbols or unapplied_updates:
+                # Deadline reached: a later sync picks these rows up again.
+                response["partial"] = True
+                response["skipped_symbols"] = skipped_symbols
+                response["unapplied_updates"] = unapplied_updates
             self._send(200, response)
+        except DeadlineExceeded as e:
+            self._send(504, {"status": "error", "message": f"Request budget exhausted: {str(e)}"})
         except Exception as e:
             self._send(500, {"status": "error", "message": str(e)})
@@ -1,9 +1,29 @@
 from http.server import BaseHTTPRequestHandler
-import os, json, re
-from urllib.request import Request, urlopen
-from urllib.parse import urlencode, quote
+import os, json, re, threading
+import http.cookiejar
+from array import array
+from bisect import bisect_left, bisect_right
+from urllib.error import HTTPError
+from urllib.parse import urlencode, quote, urlparse, parse_qs
 from datetime import datetime, timedelta, timezone
-from api.isin_name import resolve_security_metadata, resolve_symbol_metadata, normalize_isin
+from api.isin_name import (
+    API_REQUEST_BUDGET_SECONDS,
+    API_RESPONSE_RESERVE_SECONDS,
+    DeadlineExceeded,
+    cached_http_get,
+    deadline_exceeded,
+    deadline_remaining,
+    deadline_scope,
+    cache_get_many,
+    cache_put_many,
+    http_request,
+    parallel_as_completed,
+    parallel_map,
+    resolve_metadata_for_dates,
+    security_directory_get_many,
+    security_directory_lookup,
+    security_directory_update_many,
+)
 
 UA = (
     "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -15,12 +35,33 @@ YAHOO_BASES = [
     "https://query1.finance.yahoo.com/v8/finance/chart/",
     "https://query2.finance.yahoo.com/v8/finance/chart/",
 ]
-
-
-def fetch_json(url, headers, timeout=20):
-    req = Request(url, headers=headers)
-    with urlopen(req, timeout=timeout) as r:
-        return json.loads(r.read().decode("utf-8"))
+YAHOO_QUOTE_URL = "https://query1.finance.yahoo.com/v7/finance/quote"
+YAHOO_QUOTE_BATCH_SIZE = 50
+# The v7 quote endpoint only answers with a session cookie plus its crumb token.
+YAHOO_COOKIE_URL = "https://fc.yahoo.com"
+YAHOO_CRUMB_URL = "https://query1.finance.yahoo.com/v1/test/getcrumb"
+# Resolver-cache namespace holding the date intervals already fetched into fx_daily per currency.
+FX_COVERAGE_NAMESPACE = "fx_coverage"
+# Rates of the most recent days may still change, so they are refetched on every request.
+FX_REFRESH_DAYS = 3
+# fx_daily is loaded from this many days before the earliest lookup so as-of
+# lookups across weekends and holidays still find the previous rate.
+FX_ASOF_LOOKBACK_DAYS = 14
+# Held symbols get at least a month-end row, so an as-of price lookup rarely
+# needs rows older than this; misses fall back to a full reload.
+PRICE_ASOF_LOOKBACK_DAYS = 45
+# PostgREST paging: rows per Range request and keys per in.() filter.
+SUPABASE_PAGE_SIZE = int(os.environ.get("SUPABASE_PAGE_SIZE", "1000"))
+SUPABASE_IN_FILTER_MAX = 100
+
+
+def fetch_json(url, headers, timeout=20, history_end=None):
+    # history_end routes market data through the disk response cache (api/isin_name.py).
+    if history_end:
+        body = cached_http_get(url, headers, timeout, history_end)
+    else:
+        body = http_request("GET", url, headers=headers, timeout=timeout).body
+    return json.loads(body.decode("utf-8"))
 
 
 def yahoo_meta(symbol, date=None):
@@ -32,7 +73,8 @@ def yahoo_meta(symbol, date=None):
     else:
         url = f"{base}{symbol}?interval=1d&range=1d"
 
-    data = fetch_json(url, {"User-Agent": UA, "Accept": "application/json"})
+    history_end = date or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    data = fetch_json(url, {"User-Agent": UA, "Accept": "application/json"}, history_end=history_end)
     chart = data.get("chart", {})
     if chart.get("error"):
         raise Exception(str(chart["error"]))
@@ -43,11 +85,98 @@ def yahoo_meta(symbol, date=None):
     return res0.get("meta") or {}
 
 
+_YAHOO_COOKIE_JAR = http.cookiejar.CookieJar()
+_YAHOO_CRUMB = None
+_YAHOO_CRUMB_LOCK = threading.Lock()
+
+
+def yahoo_crumb(refresh=False):
+    # Cookie/crumb handshake for the quote endpoint, shared by warm invocations.
+    # Returns "" when Yahoo does not hand out a crumb; only a valid crumb is
+    # kept, so the next call tries the handshake again.
+    global _YAHOO_CRUMB
+    with _YAHOO_CRUMB_LOCK:
+        if _YAHOO_CRUMB is not None and not refresh:
+            return _YAHOO_CRUMB
+        headers = {"User-Agent": UA, "Accept": "text/plain,*/*"}
+        try:
+            # Answers 404, but sets the session cookie the crumb is bound to.
+            http_request("GET", YAHOO_COOKIE_URL, headers=headers, timeout=10, cookie_jar=_YAHOO_COOKIE_JAR)
+        except Exception:
+            pass
+        try:
+            crumb = http_request(
+                "GET", YAHOO_CRUMB_URL, headers=headers, timeout=10, cookie_jar=_YAHOO_COOKIE_JAR
+            ).body.decode("utf-8", errors="replace").strip()
+        except Exception:
+            crumb = ""
+        # A crumb is a short token; anything else is an error page.
+        if not crumb or len(crumb) > 64 or re.search(r"[\s<{]", crumb):
+            _YAHOO_CRUMB = None
+            return ""
+        _YAHOO_CRUMB = crumb
+        return crumb
+
+
+def yahoo_quote_batch(chunk):
+    # One v7 quote request; a missing or rejected crumb is renewed once.
+    for attempt in range(2):
+        crumb = yahoo_crumb(refresh=attempt > 0)
+        if not crumb:
+            if attempt == 0:
+                continue
+            return {}
+        url = f"{YAHOO_QUOTE_URL}?symbols={quote(','.join(chunk), safe=',')}&crumb={quote(crumb, safe='')}"
+        try:
+            resp = http_request(
+                "GET", url, headers={"User-Agent": UA, "Accept": "application/json"}, timeout=20, cookie_jar=_YAHOO_COOKIE_JAR
+            )
+        except HTTPError as e:
+            if e.code in (401, 403) and attempt == 0:
+                continue
+            return {}
+        return json.loads(resp.body.decode("utf-8"))
+    return {}
+
+
+def yahoo_quotes(symbols):
+    # Current price/currency/names for many symbols via multi-symbol quote
+    # requests. Symbols the batch endpoint does not return fall back to one
+    # chart call each. Values mirror chart meta keys; {} when unavailable.
+    wanted = sorted({str(s or "").strip().upper() for s in symbols if str(s or "").strip()})
+    out = {}
+    for i in range(0, len(wanted), YAHOO_QUOTE_BATCH_SIZE):
+        chunk = wanted[i:i + YAHOO_QUOTE_BATCH_SIZE]
+        try:
+            data = yahoo_quote_batch(chunk)
+        except Exception:
+            continue
+        for q in ((data or {}).get("quoteResponse") or {}).get("result") or []:
+            sym = str(q.get("symbol") or "").upper()
+            if sym not in chunk or q.get("regularMarketPrice") is None:
+                continue
+            out[sym] = {
+                "regularMarketPrice": q.get("regularMarketPrice"),
+                "currency": q.get("currency"),
+                "shortName": q.get("shortName"),
+                "longName": q.get("longName"),
+            }
+
+    for sym in wanted:
+        if sym in out:
+            continue
+        try:
+            out[sym] = yahoo_meta(sym)
+        except Exception:
+            out[sym] = {}
+    return out
+
+
 def yahoo_daily_closes(symbol, start_date, end_date):
     start_ts = int(datetime.strptime(start_date, "%Y-%m-%d").replace(tzinfo=timezone.utc).timestamp())
     end_ts = int((datetime.strptime(end_date, "%Y-%m-%d").replace(tzinfo=timezone.utc) + timedelta(days=1)).timestamp())
     url = f"{YAHOO_BASES[0]}{quote(symbol)}?interval=1d&period1={start_ts}&period2={end_ts}"
-    data = fetch_json(url, {"User-Agent": UA, "Accept": "application/json"})
+    data = fetch_json(url, {"User-Agent": UA, "Accept": "application/json"}, history_end=end_date)
     chart = data.get("chart", {})
     if chart.get("error"):
         raise Exception(str(chart["error"]))
@@ -65,25 +194,354 @@ def yahoo_daily_closes(symbol, start_date, end_date):
     return {"currency": meta.get("currency"), "rows": out}
 
 
+def is_permanent_http_error(exc):
+    return isinstance(exc, HTTPError) and 400 <= exc.code < 500 and exc.code != 429
+
+
+def date_ordinal(date_iso):
+    return datetime.fromisoformat(str(date_iso)[:10]).toordinal()
+
+
+def ordinal_date(ordinal):
+    return datetime.fromordinal(ordinal).strftime("%Y-%m-%d")
+
+
+class DateSeries:
+    """Date-sorted float64 series with O(log n) as-of lookups.
+
+    Dates are stored as proleptic ordinals in an ``array('l')`` next to an
+    ``array('d')`` value column; ``aux_fields`` are kept as parallel lists.
+    """
+
+    aux_fields = ("updated_at",)
+
+    def __init__(self):
+        self.ordinals = array("l")
+        self.values = array("d")
+        self.aux = {f: [] for f in self.aux_fields}
+
+    @classmethod
+    def from_rows(cls, rows, value_key):
+        series = cls()
+        parsed = []
+        for r in rows or []:
+            d = str(r.get("date") or "")
+            v = r.get(value_key)
+            if not d or v is None:
+                continue
+            parsed.append((date_ordinal(d), float(v), r))
+        parsed.sort(key=lambda x: x[0])
+        for o, v, r in parsed:
+            if series.ordinals and series.ordinals[-1] == o:
+                series._set(len(series.ordinals) - 1, v, r)
+                continue
+            series.ordinals.append(o)
+            series.values.append(v)
+            for f in series.aux_fields:
+                series.aux[f].append(r.get(f))
+        return series
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def __contains__(self, date_iso):
+        return self.index_of(date_iso) >= 0
+
+    def _set(self, i, value, aux):
+        self.values[i] = float(value)
+        for f in self.aux_fields:
+            self.aux[f][i] = aux.get(f)
+
+    def upsert(self, date_iso, value, **aux):
+        o = date_ordinal(date_iso)
+        i = bisect_left(self.ordinals, o)
+        if i < len(self.ordinals) and self.ordinals[i] == o:
+            self._set(i, value, aux)
+            return
+        self.ordinals.insert(i, o)
+        self.values.insert(i, float(value))
+        for f in self.aux_fields:
+            self.aux[f].insert(i, aux.get(f))
+
+    def date_at(self, i):
+        return ordinal_date(self.ordinals[i])
+
+    def index_of(self, date_iso):
+        o = date_ordinal(date_iso)
+        i = bisect_left(self.ordinals, o)
+        return i if i < len(self.ordinals) and self.ordinals[i] == o else -1
+
+    def index_on_or_before(self, date_iso):
+        return bisect_right(self.ordinals, date_ordinal(date_iso)) - 1
+
+    def index_on_or_after(self, date_iso):
+        i = bisect_left(self.ordinals, date_ordinal(date_iso))
+        return i if i < len(self.ordinals) else -1
+
+    def value_on_or_before(self, date_iso):
+        i = self.index_on_or_before(date_iso)
+        return self.values[i] if i >= 0 else None
+
+    def indexes_on_or_before(self, dates):
+        # Batched as-of: one merge walk over the series for many dates.
+        order = sorted(range(len(dates)), key=lambda k: dates[k])
+        out = [-1] * len(dates)
+        i = -1
+        n = len(self.ordinals)
+        for k in order:
+            o = date_ordinal(dates[k])
+            while i + 1 < n and self.ordinals[i + 1] <= o:
+                i += 1
+            out[k] = i
+        return out
+
+
+class PriceSeries(DateSeries):
+    """Native closes for one symbol; ``currency`` travels with each point."""
+
+    aux_fields = ("currency", "updated_at")
+
+    @classmethod
+    def from_rows(cls, rows, value_key="close_native"):
+        return super().from_rows(rows, value_key)
+
+    def currency_at(self, i):
+        return self.aux["currency"][i] if i >= 0 else None
+
+
+class FxSeries(DateSeries):
+    """EUR->ccy rates for one currency."""
+
+    @classmethod
+    def from_rows(cls, rows, value_key="eur_to_ccy"):
+        return super().from_rows(rows, value_key)
+
+
+LEDGER_CHECKPOINT_VERSION = 2
+
+
+def ledger_sort_key(t):
+    return (t["txn_date"], t["created_at"], t["symbol"])
+
+
+LEDGER_FIELDS = ("qty", "cost_native", "asset_ccy", "realized_eur", "sold_qty_native", "sold_value_native", "sold_cost_native")
+
+
+def new_ledger_state():
+    return {f: {} for f in LEDGER_FIELDS}
+
+
+def apply_ledger_transactions(transactions, currency_on_date, eur_to_ccy_on_date, state=None):
+    """Average-cost ledger in native currency, in one pass over sorted transactions.
+
+    ``transactions`` are normalized rows (symbol, side, quantity, price_eur,
+    txn_date) in (txn_date, created_at) order. ``currency_on_date(symbol, date)``
+    and ``eur_to_ccy_on_date(ccy, date)`` are called at most once per key.
+    Realized P&L is converted to EUR at each SELL date. Raises when currency
+    or FX is missing for a transaction. Returns the updated ``state``.
+    """
+    state = state or new_ledger_state()
+    qty = state["qty"]
+    cost_native = state["cost_native"]
+    asset_ccy = state["asset_ccy"]
+    realized_eur = state["realized_eur"]
+    sold_qty_native = state["sold_qty_native"]
+    sold_value_native = state["sold_value_native"]
+    sold_cost_native = state["sold_cost_native"]
+
+    ccy_memo = {}
+    fx_memo = {}
+    for t in transactions:
+        sym = t["symbol"]
+        q = t["quantity"]
+        d = t["txn_date"]
+
+        if (sym, d) not in ccy_memo:
+            ccy_memo[(sym, d)] = currency_on_date(sym, d)
+        ccy = ccy_memo[(sym, d)]
+        if not ccy:
+            raise Exception(f"Missing currency for {sym} on {d}")
+        asset_ccy[sym] = ccy
+
+        if (ccy, d) not in fx_memo:
+            fx_memo[(ccy, d)] = eur_to_ccy_on_date(ccy, d)
+        fx_eur_to_ccy = fx_memo[(ccy, d)]
+        if fx_eur_to_ccy is None or fx_eur_to_ccy <= 1e-12:
+            raise Exception(f"Missing FX EUR->{ccy} on {d}")
+        trade_price_native = t["price_eur"] * fx_eur_to_ccy
+
+        qty.setdefault(sym, 0.0)
+        cost_native.setdefault(sym, 0.0)
+        realized_eur.setdefault(sym, 0.0)
+        sold_qty_native.setdefault(sym, 0.0)
+        sold_value_native.setdefault(sym, 0.0)
+        sold_cost_native.setdefault(sym, 0.0)
+
+        if t["side"] == "BUY":
+            qty[sym] += q
+            cost_native[sym] += q * trade_price_native
+            continue
+
+        # SELL: realized profit is (sell - avg_cost) * qty_sold in NATIVE currency
+        if qty[sym] <= 1e-12:
+            # selling without holdings - ignore
+            continue
+        avg_cost = cost_native[sym] / qty[sym]
+        sell_q = min(q, qty[sym])
+
+        realized_native_tx = (trade_price_native - avg_cost) * sell_q
+        realized_eur[sym] += realized_native_tx / fx_eur_to_ccy  # convert at SELL date
+        sold_qty_native[sym] += sell_q
+        sold_value_native[sym] += trade_price_native * sell_q
+        sold_cost_native[sym] += avg_cost * sell_q
+
+        qty[sym] -= sell_q
+        cost_native[sym] -= avg_cost * sell_q
+
+    return state
+
+
+def holding_intervals(transactions, start_holdings=None, start_date=""):
+    # symbol -> [(first_held, last_held)], inclusive ISO dates; last_held is ""
+    # while the position is still open. Symbols already open in start_holdings
+    # (a ledger checkpoint) count as held from start_date.
+    held = {sym: q for sym, q in (start_holdings or {}).items() if q > 1e-12}
+    intervals = {sym: [(start_date, "")] for sym in held}
+    for t in sorted(transactions, key=ledger_sort_key):
+        sym = t["symbol"]
+        before = held.get(sym, 0.0)
+        if t["side"] == "BUY":
+            after = before + float(t["quantity"])
+            if before <= 1e-12 < after:
+                intervals.setdefault(sym, []).append((t["txn_date"], ""))
+        else:
+            after = max(0.0, before - float(t["quantity"]))
+            if after <= 1e-12 < before:
+                intervals[sym][-1] = (intervals[sym][-1][0], t["txn_date"])
+        held[sym] = after
+    return intervals
+
+
+def dates_within_intervals(sorted_dates, intervals):
+    # Subset of sorted_dates falling inside any of the (first, last) intervals.
+    out = []
+    for first, last in intervals:
+        lo = bisect_left(sorted_dates, first)
+        hi = bisect_right(sorted_dates, last) if last else len(sorted_dates)
+        out.extend(sorted_dates[lo:hi])
+    return sorted(set(out))
+
+
+class DateIntervalSet:
+    """Disjoint inclusive date intervals kept as sorted ordinal bounds.
+
+    Overlapping or adjacent intervals are merged on ``add``; coverage checks
+    and gap computation are bisects over the bounds.
+    """
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        for start, end in intervals:
+            self.add(start, end)
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    def add(self, start_iso, end_iso):
+        lo, hi = date_ordinal(start_iso), date_ordinal(end_iso)
+        if hi < lo:
+            return
+        i = bisect_left(self.ends, lo - 1)
+        j = bisect_right(self.starts, hi + 1)
+        if i < j:
+            lo = min(lo, self.starts[i])
+            hi = max(hi, self.ends[j - 1])
+        self.starts[i:j] = [lo]
+        self.ends[i:j] = [hi]
+
+    def covers(self, start_iso, end_iso):
+        lo, hi = date_ordinal(start_iso), date_ordinal(end_iso)
+        i = bisect_right(self.starts, lo) - 1
+        return i >= 0 and self.ends[i] >= hi
+
+    def gaps(self, start_iso, end_iso):
+        # Uncovered sub-ranges of [start, end] as inclusive ISO date pairs.
+        lo, hi = date_ordinal(start_iso), date_ordinal(end_iso)
+        out = []
+        i = bisect_left(self.ends, lo)
+        while lo <= hi and i < len(self.starts) and self.starts[i] <= hi:
+            if self.starts[i] > lo:
+                out.append((ordinal_date(lo), ordinal_date(self.starts[i] - 1)))
+            lo = max(lo, self.ends[i] + 1)
+            i += 1
+        if lo <= hi:
+            out.append((ordinal_date(lo), ordinal_date(hi)))
+        return out
+
+    def to_list(self, until_iso=None):
+        # [[start, end], ...], optionally clipped to end on or before until_iso.
+        cap = date_ordinal(until_iso) if until_iso else None
+        out = []
+        for lo, hi in zip(self.starts, self.ends):
+            if cap is not None:
+                if lo > cap:
+                    break
+                hi = min(hi, cap)
+            out.append([ordinal_date(lo), ordinal_date(hi)])
+        return out
+
+
 class handler(BaseHTTPRequestHandler):
     def _cors(self):
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Authorization, Content-Type")
 
+    _stream_format = ""     # "", "ndjson" or "sse" (?stream=...)
+    _stream_started = False
+
     def _send(self, code, obj):
+        if self._stream_started:
+            # Headers already went out with the first record; report the outcome in-band.
+            self._emit("error" if code >= 400 else "summary", {"http_status": code, **obj})
+            return
         self.send_response(code)
         self._cors()
         self.send_header("Content-Type", "application/json; charset=utf-8")
         self.end_headers()
         self.wfile.write(json.dumps(obj).encode("utf-8"))
 
+    def _emit(self, kind, obj):
+        # One streamed record: an NDJSON line {"type": kind, ...} or an SSE event.
+        if not self._stream_started:
+            self.send_response(200)
+            self._cors()
+            if self._stream_format == "sse":
+                self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            else:
+                self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            self._stream_started = True
+        if self._stream_format == "sse":
+            chunk = f"event: {kind}\ndata: {json.dumps(obj)}\n\n"
+        else:
+            chunk = json.dumps({"type": kind, **obj}) + "\n"
+        self.wfile.write(chunk.encode("utf-8"))
+        self.wfile.flush()
+
     def do_OPTIONS(self):
         self.send_response(204)
         self._cors()
         self.end_headers()
 
     def do_GET(self):
+        with deadline_scope(API_REQUEST_BUDGET_SECONDS - API_RESPONSE_RESERVE_SECONDS):
+            self._handle_get()
+
+    def _handle_get(self):
+        unfinished = []  # work cut short by the request deadline, resumable on the next call
         try:
             auth = self.headers.get("Authorization", "")
             if not auth.startswith("Bearer "):
@@ -123,17 +581,21 @@ class handler(BaseHTTPRequestHandler):
             now_utc = datetime.now(timezone.utc)
             today = now_utc.strftime("%Y-%m-%d")
             one_year_ago = (now_utc - timedelta(days=365)).strftime("%Y-%m-%d")
-            price_cache = {}  # symbol -> {date -> row}
-            fx_cache = {}     # ccy -> {date -> row}
+            price_cache = {}  # symbol -> PriceSeries
+            fx_cache = {}     # ccy -> FxSeries
             table_cache_enabled = {
                 "prices": True,
                 "fx_daily": True,
                 # Deprecated tables removed from Supabase schema.
                 "asset_event_prices": False,
                 "portfolio_daily_value": False,
+                "portfolio_ledger_checkpoints": True,
             }
             ensured_symbol_min = {}
-            ensured_fx_min = {}
+            price_loaded_since = {}  # symbol -> lower date bound of rows loaded into price_cache ("" = all)
+            fx_loaded_since = {}     # ccy -> lower date bound of rows loaded into fx_cache ("" = all)
+            fx_coverage = {}         # ccy -> DateIntervalSet fetched into fx_cache (incl. this request)
+            fx_coverage_stored = {}  # ccy -> DateIntervalSet persisted in fx_daily
             write_warnings = []
 
             def supa_get(table, params):
@@ -142,34 +604,151 @@ class handler(BaseHTTPRequestHandler):
                 qs = urlencode(params)
                 try:
                     return fetch_json(f"{supabase_url}/rest/v1/{table}?{qs}", supa_rest_headers)
-                except Exception:
-                    table_cache_enabled[table] = False
+                except Exception as e:
+                    # Transient failures (5xx, 429, timeouts) are paced by the shared
+                    # per-host breaker; only a client error (missing table/column,
+                    # permissions) turns the table off for the rest of the request.
+                    if is_permanent_http_error(e):
+                        table_cache_enabled[table] = False
                     return []
 
+            def supa_get_all(table, params):
+                # Like supa_get, but pages past the server's max-rows cap with Range
+                # headers; params must carry a stable order. Returns (rows, complete):
+                # a failure after some pages keeps the rows fetched so far.
+                if not table_cache_enabled.get(table, True):
+                    return [], True
+                url = f"{supabase_url}/rest/v1/{table}?{urlencode(params)}"
+                out = []
+                while True:
+                    headers = {
+                        **supa_rest_headers,
+                        "Range-Unit": "items",
+                        "Range": f"{len(out)}-{len(out) + SUPABASE_PAGE_SIZE - 1}",
+                        "Prefer": "count=exact",
+                    }
+                    try:
+                        resp = http_request("GET", url, headers=headers, timeout=20)
+                    except Exception as e:
+                        if is_permanent_http_error(e):
+                            table_cache_enabled[table] = False
+                        return out, False
+                    page = json.loads(resp.body.decode("utf-8")) or []
+                    out.extend(page)
+                    # Content-Range is "<first>-<last>/<total>"; without a total, a short page is the last one.
+                    total = str((resp.headers or {}).get("Content-Range") or "").rpartition("/")[2]
+                    if not page or (total.isdigit() and len(out) >= int(total)):
+                        return out, True
+                    if not total.isdigit() and len(page) < SUPABASE_PAGE_SIZE:
+                        return out, True
+
             def supa_upsert(table, rows, on_conflict):
                 if not rows or not table_cache_enabled.get(table, True):
                     return False
-                req = Request(
-                    f"{supabase_url}/rest/v1/{table}?on_conflict={on_conflict}",
-                    data=json.dumps(rows).encode("utf-8"),
-                    headers={
-                        **supa_rest_headers,
-                        "Content-Type": "application/json",
-                        "Prefer": "resolution=merge-duplicates,return=minimal",
-                    },
-                    method="POST",
-                )
                 try:
-                    with urlopen(req, timeout=25):
-                        return True
+                    http_request(
+                        "POST",
+                        f"{supabase_url}/rest/v1/{table}?on_conflict={on_conflict}",
+                        headers={
+                            **supa_rest_headers,
+                            "Content-Type": "application/json",
+                            "Prefer": "resolution=merge-duplicates,return=minimal",
+                        },
+                        data=json.dumps(rows).encode("utf-8"),
+                        timeout=25,
+                    )
+                    return True
                 except Exception as e:
-                    table_cache_enabled[table] = False
+                    if is_permanent_http_error(e):
+                        table_cache_enabled[table] = False
                     if len(write_warnings) < 20:
                         write_warnings.append(f"upsert {table} failed: {e}")
                     return False
 
+            def supa_delete(table, params):
+                if not table_cache_enabled.get(table, True):
+                    return False
+                try:
+                    http_request(
+                        "DELETE",
+                        f"{supabase_url}/rest/v1/{table}?{urlencode(params)}",
+                        headers={**supa_rest_headers, "Prefer": "return=minimal"},
+                        timeout=25,
+                    )
+                    return True
+                except Exception as e:
+                    if is_permanent_http_error(e):
+                        table_cache_enabled[table] = False
+                    if len(write_warnings) < 20:
+                        write_warnings.append(f"delete {table} failed: {e}")
+                    return False
+
+            def load_ledger_checkpoint():
+                rows = supa_get(
+                    "portfolio_ledger_checkpoints",
+                    {
+                        "user_id": f"eq.{user_id}",
+                        "select": "version,state,watermark_txn_date,watermark_created_at,watermark_symbol,as_of,pending_events,tx_closes",
+                        "limit": "1",
+                    },
+                )
+                cp = rows[0] if rows else None
+                if not cp or cp.get("version") != LEDGER_CHECKPOINT_VERSION:
+                    return None
+                state = cp.get("state") or {}
+                if not cp.get("watermark_txn_date") or any(not isinstance(state.get(f), dict) for f in LEDGER_FIELDS):
+                    return None
+                if str(cp.get("as_of") or "") > today:
+                    return None
+                if not isinstance(cp.get("tx_closes"), dict):
+                    return None
+                return cp
+
+            def save_ledger_checkpoint(state, watermark, pending_events, tx_closes):
+                # A watermark in the future would force a rebuild on every request; skip it.
+                if not watermark or watermark[0] > today:
+                    return False
+                return supa_upsert(
+                    "portfolio_ledger_checkpoints",
+                    [{
+                        "user_id": user_id,
+                        "version": LEDGER_CHECKPOINT_VERSION,
+                        "state": state,
+                        "watermark_txn_date": watermark[0],
+                        "watermark_created_at": watermark[1] or None,
+                        "watermark_symbol": watermark[2],
+                        "as_of": today,
+                        "pending_events": sorted(pending_events),
+                        "tx_closes": tx_closes,
+                        "updated_at": now_utc.isoformat(),
+                    }],
+                    "user_id",
+                )
+
+            # Incremental mode: replay only transactions after the checkpoint
+            # watermark. Back-dated inserts/edits/deletes drop the checkpoint
+            # (see sql/portfolio_ledger_checkpoints.sql), forcing a full rebuild.
+            query = parse_qs(urlparse(self.path).query)
+            force_full = (query.get("full") or [""])[0].lower() in ("1", "true", "yes")
+            stream_format = (query.get("stream") or [""])[0].lower()
+            self._stream_format = stream_format if stream_format in ("ndjson", "sse") else ""
+            checkpoint = None if force_full else load_ledger_checkpoint()
+            if self._stream_format:
+                # First byte goes out now; positions follow as they are valued.
+                self._emit("start", {
+                    "user": {"id": user_id, "email": email},
+                    "ledger_mode": "incremental" if checkpoint else "full",
+                })
+            # The ISO week holding the watermark is loaded whole: its already-replayed
+            # transactions still decide that week's valuation event date.
+            week_start = ""
+            if checkpoint:
+                wm_date = datetime.strptime(str(checkpoint["watermark_txn_date"])[:10], "%Y-%m-%d").date()
+                week_start = (wm_date - timedelta(days=wm_date.weekday())).strftime("%Y-%m-%d")
+            tx_filter = f"&txn_date=gte.{quote(week_start, safe='')}" if checkpoint else ""
+
             txs = fetch_json(
-                f"{supabase_url}/rest/v1/transactions?user_id=eq.{user_id}&select=symbol,side,quantity,price,txn_date,created_at,txn_close_price",
+                f"{supabase_url}/rest/v1/transactions?user_id=eq.{user_id}{tx_filter}&select=symbol,side,quantity,price,txn_date,created_at,txn_close_price",
                 supa_rest_headers,
             )
 
@@ -193,7 +772,20 @@ class handler(BaseHTTPRequestHandler):
                     "created_at": created_at,
                     "txn_close_price": str(t.get("txn_close_price") or ""),
                 })
-            norm.sort(key=lambda x: (x["txn_date"], x["created_at"], x["symbol"]))
+            norm.sort(key=ledger_sort_key)
+
+            watermark = None
+            week_context = []  # replayed transactions of the watermark's week (events only)
+            if checkpoint:
+                watermark = (
+                    str(checkpoint["watermark_txn_date"]),
+                    str(checkpoint.get("watermark_created_at") or ""),
+                    str(checkpoint.get("watermark_symbol") or ""),
+                )
+                week_context = [t for t in norm if ledger_sort_key(t) <= watermark]
+                norm = [t for t in norm if ledger_sort_key(t) > watermark]
+            if norm:
+                watermark = ledger_sort_key(norm[-1])
 
 
             def parse_close_price_and_currency(text):
@@ -240,11 +832,14 @@ class handler(BaseHTTPRequestHandler):
                     cur -= timedelta(days=1)
                 return cur
 
-            def build_valuation_events(norm_rows, today_iso):
-                if not norm_rows:
+            def build_valuation_events(norm_rows, today_iso, since_iso="", include_future=False):
+                # since_iso (incremental mode): month-end events only after it; weekly
+                # events still follow the given transactions.
+                tx_dates = sorted({datetime.strptime(t["txn_date"], "%Y-%m-%d").date() for t in norm_rows or []})
+                if not tx_dates and not since_iso:
                     return []
-                tx_dates = sorted({datetime.strptime(t["txn_date"], "%Y-%m-%d").date() for t in norm_rows})
-                first_date = tx_dates[0]
+                since = datetime.strptime(since_iso, "%Y-%m-%d").date() if since_iso else None
+                first_date = since + timedelta(days=1) if since else tx_dates[0]
 
                 # Weekly transaction events
                 week_map = {}
@@ -275,49 +870,74 @@ class handler(BaseHTTPRequestHandler):
                         m += 1
 
                 # Ensure event series starts at first transaction date.
-                events.add(move_to_business_day(first_date))
-
-                return sorted(d.strftime("%Y-%m-%d") for d in events if d <= end_date)
+                if not since:
+                    events.add(move_to_business_day(first_date))
+
+                return sorted(d.strftime("%Y-%m-%d") for d in events if include_future or d <= end_date)
+
+            def resolve_closes_by_symbol(wanted, stage):
+                # wanted: symbol -> set of dates. One range resolution per symbol
+                # instead of one upstream call per (symbol, date); symbols resolve
+                # in parallel, results are merged in sorted symbol order.
+                # Symbols reached after the deadline are left out of the result
+                # (their cells stay pending) and listed in `unfinished` under the
+                # caller's stage.
+                def resolve_one(sym):
+                    if deadline_exceeded():
+                        return None
+                    try:
+                        return resolve_metadata_for_dates(sym, sorted(wanted[sym]))
+                    except DeadlineExceeded:
+                        return None
+                    except Exception:
+                        return {}
+
+                symbols = sorted(wanted)
+                out = {}
+                for sym, metas in zip(symbols, parallel_map(resolve_one, symbols)):
+                    if metas is None:
+                        unfinished.append({"stage": stage, "symbol": sym, "dates": sorted(wanted[sym])})
+                        continue
+                    for d in sorted(wanted[sym]):
+                        out[(sym, d)] = str((metas.get(d) or {}).get("txn_close_price") or "").strip()
+                return out
+
+            def rebuild_prices_events_table(norm_rows, today_iso, start_holdings=None, since_iso="", carried_events=(),
+                                            week_context=(), carried_closes=None):
+                # Returns (rows_written, future_events, tx_closes). Future events and
+                # the latest transaction close per symbol ({symbol: [date, close, ccy]},
+                # the fallback for later events) are carried in the ledger checkpoint.
+                # week_context are already-replayed transactions of the watermark's
+                # week: they only shape that week's event, so it matches a full rebuild.
+                all_events = set(build_valuation_events(list(week_context) + list(norm_rows), today_iso, since_iso, include_future=True))
+                # The week's event as computed before its newer transactions arrived.
+                superseded = set(build_valuation_events(week_context, today_iso, since_iso, include_future=True)) - all_events
+                all_events.update(e for e in carried_events if e not in superseded)
+                # The last run priced a superseded event for the symbols open at the
+                # watermark; drop those rows so the table matches a full rebuild.
+                stale_dates = sorted(e for e in superseded if e <= today_iso)
+                stale_symbols = sorted(sym for sym, q in (start_holdings or {}).items() if q > 1e-12)
+                if stale_dates and stale_symbols:
+                    supa_delete("prices", {
+                        "symbol": "in.(" + ",".join('"' + sym + '"' for sym in stale_symbols) + ")",
+                        "date": "in.(" + ",".join(stale_dates) + ")",
+                        "source": "eq.bnp_txn_close",
+                    })
+                valuation_events = sorted(e for e in all_events if e <= today_iso)
+                future_events = sorted(e for e in all_events if e > today_iso)
 
-            def rebuild_prices_events_table(norm_rows, today_iso):
-                if not norm_rows:
-                    return 0
-                valuation_events = build_valuation_events(norm_rows, today_iso)
-                if not valuation_events:
-                    return 0
+                tx_sorted = sorted(norm_rows, key=lambda x: (x["txn_date"], x["created_at"], x["symbol"]))
 
-                tx_close_map = {}
-                resolver_cache = {}
+                # Plan every (symbol, date) close the pass needs before resolving anything.
+                wanted = {}
                 for t in norm_rows:
-                    sym = t["symbol"]
-                    d = t["txn_date"]
-                    v, c = parse_close_price_and_currency(t.get("txn_close_price"))
-                    if v is None:
-                        key = (sym, d)
-                        if key not in resolver_cache:
-                            isin = normalize_isin(sym)
-                            try:
-                                meta_t = resolve_security_metadata(isin, txn_date=d) if isin else resolve_symbol_metadata(sym, txn_date=d)
-                            except Exception:
-                                meta_t = {}
-                            resolver_cache[key] = parse_close_price_and_currency((meta_t or {}).get("txn_close_price") or "")
-                        v, c = resolver_cache[key]
+                    v, _ = parse_close_price_and_currency(t.get("txn_close_price"))
                     if v is None:
-                        continue
-                    tx_close_map.setdefault(sym, {})[d] = (v, c)
-
-                def latest_tx_close_on_or_before(sym, date_iso):
-                    rows = tx_close_map.get(sym) or {}
-                    candidates = [d for d in rows.keys() if d <= date_iso]
-                    if not candidates:
-                        return None, ""
-                    return rows[max(candidates)]
+                        wanted.setdefault(t["symbol"], set()).add(t["txn_date"])
 
-                tx_sorted = sorted(norm_rows, key=lambda x: (x["txn_date"], x["created_at"], x["symbol"]))
                 idx = 0
-                holdings = {}
-                out_rows = []
-                seen = set()
+                holdings = dict(start_holdings or {})
+                open_by_event = []
                 for ev in valuation_events:
                     while idx < len(tx_sorted) and tx_sorted[idx]["txn_date"] <= ev:
                         t = tx_sorted[idx]
@@ -329,17 +949,49 @@ class handler(BaseHTTPRequestHandler):
                             holdings[sym] = max(0.0, holdings.get(sym, 0.0) - qty)
                         idx += 1
 
-                    open_symbols = [sym for sym, q in holdings.items() if q > 1e-12]
-                    for sym in sorted(open_symbols):
-                        isin = normalize_isin(sym)
-                        try:
-                            meta = resolve_security_metadata(isin, txn_date=ev) if isin else resolve_symbol_metadata(sym, txn_date=ev)
-                        except Exception:
-                            meta = {}
-                        raw_close = (meta or {}).get("txn_close_price") or ""
-                        close_val, ccy = parse_close_price_and_currency(raw_close)
+                    open_symbols = sorted(sym for sym, q in holdings.items() if q > 1e-12)
+                    open_by_event.append((ev, open_symbols))
+                    for sym in open_symbols:
+                        wanted.setdefault(sym, set()).add(ev)
+
+                resolved = resolve_closes_by_symbol(wanted, "prices_events")
+
+                tx_close_map = {}  # symbol -> PriceSeries of known transaction closes
+                for sym, (d, v, c) in (carried_closes or {}).items():
+                    tx_close_map.setdefault(sym, PriceSeries()).upsert(d, v, currency=c)
+                for t in norm_rows:
+                    sym = t["symbol"]
+                    d = t["txn_date"]
+                    v, c = parse_close_price_and_currency(t.get("txn_close_price"))
+                    if v is None:
+                        v, c = parse_close_price_and_currency(resolved.get((sym, d), ""))
+                    if v is None:
+                        continue
+                    tx_close_map.setdefault(sym, PriceSeries()).upsert(d, v, currency=c)
+
+                # Events without a resolved close fall back to the latest known
+                # transaction close; one batched as-of walk per symbol.
+                fallback_events = {}  # symbol -> event dates needing the fallback
+                for ev, open_symbols in open_by_event:
+                    for sym in open_symbols:
+                        if parse_close_price_and_currency(resolved.get((sym, ev), ""))[0] is None:
+                            fallback_events.setdefault(sym, []).append(ev)
+                fallback_closes = {}  # (symbol, event) -> (close, currency)
+                for sym, evs in fallback_events.items():
+                    series = tx_close_map.get(sym)
+                    if series is None:
+                        continue
+                    for ev, i in zip(evs, series.indexes_on_or_before(evs)):
+                        if i >= 0:
+                            fallback_closes[(sym, ev)] = (series.values[i], series.currency_at(i))
+
+                out_rows = []
+                seen = set()
+                for ev, open_symbols in open_by_event:
+                    for sym in open_symbols:
+                        close_val, ccy = parse_close_price_and_currency(resolved.get((sym, ev), ""))
                         if close_val is None:
-                            close_val, ccy = latest_tx_close_on_or_before(sym, ev)
+                            close_val, ccy = fallback_closes.get((sym, ev), (None, ""))
                         if close_val is None:
                             continue
                         key = (sym, ev)
@@ -357,7 +1009,12 @@ class handler(BaseHTTPRequestHandler):
 
                 if out_rows:
                     supa_upsert("prices", out_rows, "symbol,date")
-                return len(out_rows)
+                tx_closes = {
+                    sym: [series.date_at(len(series) - 1), series.values[-1], series.currency_at(len(series) - 1)]
+                    for sym, series in tx_close_map.items()
+                    if len(series)
+                }
+                return len(out_rows), future_events, tx_closes
 
 
 
@@ -390,20 +1047,18 @@ class handler(BaseHTTPRequestHandler):
                     "updated_at": row.get("updated_at"),
                 }
 
-                patch_req = Request(
-                    f"{supabase_url}/rest/v1/asset_event_prices?user_id=eq.{user_q}&symbol=eq.{sym_q}&valuation_date=eq.{date_q}",
-                    data=json.dumps(payload).encode("utf-8"),
-                    headers={
-                        **supa_rest_headers,
-                        "Content-Type": "application/json",
-                        "Prefer": "return=representation",
-                    },
-                    method="PATCH",
-                )
-
                 try:
-                    with urlopen(patch_req, timeout=20) as r:
-                        body = r.read().decode("utf-8")
+                    body = http_request(
+                        "PATCH",
+                        f"{supabase_url}/rest/v1/asset_event_prices?user_id=eq.{user_q}&symbol=eq.{sym_q}&valuation_date=eq.{date_q}",
+                        headers={
+                            **supa_rest_headers,
+                            "Content-Type": "application/json",
+                            "Prefer": "return=representation",
+                        },
+                        data=json.dumps(payload).encode("utf-8"),
+                        timeout=20,
+                    ).body.decode("utf-8")
                     patched = json.loads(body) if body else []
                     if isinstance(patched, list) and len(patched) > 0:
                         return True
@@ -419,19 +1074,19 @@ class handler(BaseHTTPRequestHandler):
                     "valuation_date": row.get("valuation_date"),
                     **payload,
                 }
-                ins_req = Request(
-                    f"{supabase_url}/rest/v1/asset_event_prices",
-                    data=json.dumps([insert_row]).encode("utf-8"),
-                    headers={
-                        **supa_rest_headers,
-                        "Content-Type": "application/json",
-                        "Prefer": "return=minimal",
-                    },
-                    method="POST",
-                )
                 try:
-                    with urlopen(ins_req, timeout=20):
-                        return True
+                    http_request(
+                        "POST",
+                        f"{supabase_url}/rest/v1/asset_event_prices",
+                        headers={
+                            **supa_rest_headers,
+                            "Content-Type": "application/json",
+                            "Prefer": "return=minimal",
+                        },
+                        data=json.dumps([insert_row]).encode("utf-8"),
+                        timeout=20,
+                    )
+                    return True
                 except Exception as e:
                     if len(write_warnings) < 20:
                         write_warnings.append(
@@ -439,11 +1094,18 @@ class handler(BaseHTTPRequestHandler):
                         )
                     return False
 
-            def sync_asset_event_prices(norm_rows, today_iso):
-                if not norm_rows:
+            def sync_asset_event_prices(norm_rows, today_iso, start_holdings=None, since_iso=""):
+                # Nothing would receive the resolved closes; don't resolve them.
+                if not norm_rows or not table_cache_enabled.get("asset_event_prices", True):
                     return {"grid_rows": 0, "updated_rows": 0, "symbols": 0, "dates": 0}
 
-                symbols = sorted({t["symbol"] for t in norm_rows if t.get("symbol")})
+                # Only cells where the symbol was actually held (plus its own
+                # transaction dates) make it into the grid.
+                intervals = holding_intervals(norm_rows, start_holdings, since_iso)
+                txn_dates_by_symbol = {}
+                for t in norm_rows:
+                    txn_dates_by_symbol.setdefault(t["symbol"], set()).add(t["txn_date"])
+                symbols = sorted(set(intervals) | set(txn_dates_by_symbol))
                 dates = set(build_valuation_events(norm_rows, today_iso))
                 dates.update({t["txn_date"] for t in norm_rows if t.get("txn_date")})
 
@@ -461,13 +1123,19 @@ class handler(BaseHTTPRequestHandler):
                     if d:
                         dates.add(d)
 
-                all_dates = sorted(d for d in dates if d)
+                all_dates = sorted(d for d in dates if d and d >= since_iso)
                 if not symbols or not all_dates:
                     return {"grid_rows": 0, "updated_rows": 0, "symbols": len(symbols), "dates": len(all_dates)}
 
+                cells = {}  # symbol -> sorted dates held
+                for sym in symbols:
+                    held = set(dates_within_intervals(all_dates, intervals.get(sym, ())))
+                    held.update(txn_dates_by_symbol.get(sym, ()))
+                    cells[sym] = sorted(held)
+
                 grid_rows = []
                 for sym in symbols:
-                    for d in all_dates:
+                    for d in cells[sym]:
                         grid_rows.append({
                             "user_id": user_id,
                             "symbol": sym,
@@ -490,28 +1158,24 @@ class handler(BaseHTTPRequestHandler):
                     for r in (existing_rows or [])
                 }
 
-                resolver_cache = {}
-                updates = []
+                pending = {}
                 for sym in symbols:
-                    for d in all_dates:
+                    for d in cells[sym]:
                         cur = existing.get((sym, d), {})
                         cur_text = str(cur.get("close_price_text") or "").strip()
                         cur_status = str(cur.get("price_status") or "").strip().lower()
                         if cur_text and cur_text.lower() != "unavailable" and cur_status == "resolved":
                             continue
+                        pending.setdefault(sym, set()).add(d)
 
-                        key = (sym, d)
-                        if key not in resolver_cache:
-                            isin = normalize_isin(sym)
-                            try:
-                                meta = resolve_security_metadata(isin, txn_date=d) if isin else resolve_symbol_metadata(sym, txn_date=d)
-                            except Exception:
-                                meta = {}
-                            raw = str((meta or {}).get("txn_close_price") or "").strip() or "unavailable"
-                            val, ccy = parse_close_price_and_currency(raw)
-                            resolver_cache[key] = (raw, val, ccy)
-
-                        raw, val, ccy = resolver_cache[key]
+                resolved = resolve_closes_by_symbol(pending, "asset_event_prices")
+                updates = []
+                for sym in symbols:
+                    for d in sorted(pending.get(sym) or ()):
+                        if (sym, d) not in resolved:
+                            continue
+                        raw = resolved[(sym, d)] or "unavailable"
+                        val, ccy = parse_close_price_and_currency(raw)
                         updates.append({
                             "user_id": user_id,
                             "symbol": sym,
@@ -535,17 +1199,54 @@ class handler(BaseHTTPRequestHandler):
                 return {
                     "grid_rows": len(grid_rows),
                     "updated_rows": len(updates),
-                    "updated_ok": update_write_stats.get("ok", 0),
-                    "updated_failed": update_write_stats.get("failed", 0),
+                    "updated_ok": updated_ok,
+                    "updated_failed": updated_failed,
                     "grid_upsert_ok": grid_write_stats.get("ok", 0),
                     "grid_upsert_failed": grid_write_stats.get("failed", 0),
                     "symbols": len(symbols),
                     "dates": len(all_dates),
                 }
 
-            # Price/FX caches backed by Supabase
-            asset_event_stats = sync_asset_event_prices(norm, today)
-            prices_rows_written = rebuild_prices_events_table(norm, today)
+            # Price/FX caches backed by Supabase. This phase gets at most half of
+            # the remaining budget so the portfolio itself can still be valued.
+            asset_event_stats = {}
+            prices_rows_written, pending_events, tx_closes = 0, [], {}
+            # Month-end events are re-priced from the day of the first replayed
+            # transaction when it is dated before the last run.
+            events_since = ""
+            if checkpoint:
+                events_since = str(checkpoint.get("as_of") or "")
+                if norm:
+                    first_new = datetime.strptime(norm[0]["txn_date"][:10], "%Y-%m-%d") - timedelta(days=1)
+                    events_since = min(events_since, first_new.strftime("%Y-%m-%d"))
+            with deadline_scope(deadline_remaining() / 2):
+                try:
+                    if checkpoint:
+                        asset_event_stats = sync_asset_event_prices(
+                            norm,
+                            today,
+                            start_holdings=checkpoint["state"]["qty"],
+                            since_iso=events_since,
+                        )
+                    else:
+                        asset_event_stats = sync_asset_event_prices(norm, today)
+                except DeadlineExceeded:
+                    unfinished.append({"stage": "asset_event_prices"})
+                try:
+                    if checkpoint:
+                        prices_rows_written, pending_events, tx_closes = rebuild_prices_events_table(
+                            norm,
+                            today,
+                            start_holdings=checkpoint["state"]["qty"],
+                            since_iso=events_since,
+                            carried_events=checkpoint.get("pending_events") or (),
+                            week_context=week_context,
+                            carried_closes=checkpoint["tx_closes"],
+                        )
+                    else:
+                        prices_rows_written, pending_events, tx_closes = rebuild_prices_events_table(norm, today)
+                except DeadlineExceeded:
+                    unfinished.append({"stage": "prices_events"})
 
             def normalize_price_and_ccy(raw_ccy, raw_price):
                 c = raw_ccy
@@ -566,48 +1267,30 @@ class handler(BaseHTTPRequestHandler):
                 except Exception:
                     return None
 
-            def contiguous_ranges(date_list):
-                if not date_list:
-                    return []
-                ordered = sorted(date_list)
-                ranges = []
-                start = ordered[0]
-                prev = ordered[0]
-                for d in ordered[1:]:
-                    prev_dt = datetime.strptime(prev, "%Y-%m-%d")
-                    d_dt = datetime.strptime(d, "%Y-%m-%d")
-                    if d_dt - prev_dt > timedelta(days=1):
-                        ranges.append((start, prev))
-                        start = d
-                    prev = d
-                ranges.append((start, prev))
-                return ranges
-
             def save_prices(symbol, rows):
                 if not rows:
                     return
                 supa_upsert("prices", rows, "symbol,date")
-                entry = price_cache.setdefault(symbol, {})
+                series = price_cache.setdefault(symbol, PriceSeries())
                 for r in rows:
-                    entry[r["date"]] = r
+                    series.upsert(r["date"], r["close_native"], currency=r.get("currency"), updated_at=r.get("updated_at"))
 
             def ensure_price_anchor_on_date(symbol, anchor_date):
-                rows = load_prices(symbol)
-                if anchor_date in rows:
+                series = load_prices(symbol, anchor_date)
+                if anchor_date in series:
                     return
                 # On non-trading BUY dates (weekends/holidays), copy the first
                 # available later close so history starts on the BUY date.
-                next_dates = [d for d in rows.keys() if d >= anchor_date]
-                if not next_dates:
+                i = series.index_on_or_after(anchor_date)
+                if i < 0:
                     return
-                first_after = rows[min(next_dates)]
                 save_prices(
                     symbol,
                     [{
                         "symbol": symbol,
                         "date": anchor_date,
-                        "close_native": float(first_after["close_native"]),
-                        "currency": first_after["currency"],
+                        "close_native": series.values[i],
+                        "currency": series.currency_at(i),
                         "source": "synthetic_anchor",
                         "updated_at": now_utc.isoformat(),
                     }],
@@ -615,56 +1298,109 @@ class handler(BaseHTTPRequestHandler):
 
             def save_fx(ccy, rows):
                 if not rows:
-                    return
-                supa_upsert("fx_daily", rows, "ccy,date")
-                entry = fx_cache.setdefault(ccy, {})
+                    return True
+                saved = supa_upsert("fx_daily", rows, "ccy,date")
+                series = fx_cache.setdefault(ccy, FxSeries())
                 for r in rows:
-                    entry[r["date"]] = r
+                    series.upsert(r["date"], r["eur_to_ccy"], updated_at=r.get("updated_at"))
+                return saved
 
             def ensure_fx_anchor_on_date(ccy, anchor_date):
-                rows = load_fx(ccy)
-                if anchor_date in rows:
+                series = load_fx(ccy, fx_window_start(anchor_date))
+                if anchor_date in series:
                     return
-                next_dates = [d for d in rows.keys() if d >= anchor_date]
-                if not next_dates:
+                i = series.index_on_or_after(anchor_date)
+                if i < 0:
                     return
-                first_after = rows[min(next_dates)]
                 save_fx(
                     ccy,
                     [{
                         "ccy": ccy,
                         "date": anchor_date,
-                        "eur_to_ccy": float(first_after["eur_to_ccy"]),
+                        "eur_to_ccy": series.values[i],
                         "updated_at": now_utc.isoformat(),
                     }],
                 )
 
-            def load_prices(symbol):
-                if symbol in price_cache:
-                    return price_cache[symbol]
-                rows = supa_get(
-                    "prices",
-                    {
-                        "symbol": f"eq.{symbol}",
-                        "select": "symbol,date,close_native,currency,source,updated_at",
-                        "order": "date.asc",
-                    },
+            def load_series_many(table, key_col, keys, select, since=""):
+                # (key -> rows in date order, keys fully loaded) from one paged in.()
+                # query per chunk of keys; keys without rows map to []. Keys of a
+                # chunk whose paging failed keep the rows fetched so far but are
+                # left out of the fully-loaded set.
+                out = {k: [] for k in keys}
+                complete = set()
+                for i in range(0, len(keys), SUPABASE_IN_FILTER_MAX):
+                    chunk = keys[i:i + SUPABASE_IN_FILTER_MAX]
+                    params = {
+                        key_col: "in.(" + ",".join('"' + k.replace('"', "") + '"' for k in chunk) + ")",
+                        "select": select,
+                        "order": f"{key_col}.asc,date.asc",
+                    }
+                    if since:
+                        params["date"] = f"gte.{since}"
+                    rows, chunk_complete = supa_get_all(table, params)
+                    for r in rows:
+                        k = str(r.get(key_col) or "")
+                        if k in out:
+                            out[k].append(r)
+                    if chunk_complete:
+                        complete.update(chunk)
+                return out, complete
+
+            def price_window_start(date_iso):
+                return (datetime.strptime(date_iso, "%Y-%m-%d") - timedelta(days=PRICE_ASOF_LOOKBACK_DAYS)).strftime("%Y-%m-%d")
+
+            def load_prices_many(symbols, since=""):
+                # Same reload rule as load_fx_many: only when rows before the loaded
+                # window are needed; rows saved earlier in this request are kept.
+                missing = sorted({s for s in symbols if s and not (s in price_loaded_since and price_loaded_since[s] <= since)})
+                if not missing:
+                    return
+                rows_by_symbol, complete = load_series_many(
+                    "prices", "symbol", missing, "symbol,date,close_native,currency,source,updated_at", since
                 )
-                price_cache[symbol] = {r["date"]: r for r in rows}
+                for sym, rows in rows_by_symbol.items():
+                    series = PriceSeries.from_rows(rows)
+                    old = price_cache.get(sym)
+                    for i in range(len(old or ())):
+                        if old.date_at(i) not in series:
+                            series.upsert(
+                                old.date_at(i),
+                                old.values[i],
+                                currency=old.aux["currency"][i],
+                                updated_at=old.aux["updated_at"][i],
+                            )
+                    price_cache[sym] = series
+                    if sym in complete:
+                        price_loaded_since[sym] = since
+
+            def load_prices(symbol, since=""):
+                load_prices_many([symbol], since)
                 return price_cache[symbol]
 
-            def load_fx(ccy):
-                if ccy in fx_cache:
-                    return fx_cache[ccy]
-                rows = supa_get(
-                    "fx_daily",
-                    {
-                        "ccy": f"eq.{ccy}",
-                        "select": "ccy,date,eur_to_ccy,updated_at",
-                        "order": "date.asc",
-                    },
-                )
-                fx_cache[ccy] = {r["date"]: r for r in rows}
+            def fx_window_start(date_iso):
+                return (datetime.strptime(date_iso, "%Y-%m-%d") - timedelta(days=FX_ASOF_LOOKBACK_DAYS)).strftime("%Y-%m-%d")
+
+            def load_fx_many(ccys, since=""):
+                # Reloads a currency only when rows before its loaded window are needed;
+                # rows saved earlier in this request are kept. A partially read
+                # currency is retried on its next lookup.
+                missing = sorted({c for c in ccys if c and not (c in fx_loaded_since and fx_loaded_since[c] <= since)})
+                if not missing:
+                    return
+                rows_by_ccy, complete = load_series_many("fx_daily", "ccy", missing, "ccy,date,eur_to_ccy,updated_at", since)
+                for ccy, rows in rows_by_ccy.items():
+                    series = FxSeries.from_rows(rows)
+                    old = fx_cache.get(ccy)
+                    for i in range(len(old or ())):
+                        if old.date_at(i) not in series:
+                            series.upsert(old.date_at(i), old.values[i], updated_at=old.aux["updated_at"][i])
+                    fx_cache[ccy] = series
+                    if ccy in complete:
+                        fx_loaded_since[ccy] = since
+
+            def load_fx(ccy, since=""):
+                load_fx_many([ccy], since)
                 return fx_cache[ccy]
 
             def ensure_symbol_history(symbol, min_needed_date):
@@ -673,62 +1409,89 @@ class handler(BaseHTTPRequestHandler):
                 return
 
 
-            def ensure_fx_history(ccy, min_needed_date):
+            def load_fx_coverage(ccys):
+                missing = [c for c in ccys if c not in fx_coverage]
+                if not missing:
+                    return
+                stored = cache_get_many(FX_COVERAGE_NAMESPACE, missing)
+                for ccy in missing:
+                    intervals = (stored.get(ccy) or {}).get("intervals") or []
+                    fx_coverage[ccy] = DateIntervalSet(intervals)
+                    fx_coverage_stored[ccy] = DateIntervalSet(intervals)
+
+            def ensure_fx_histories(needs):
+                # needs: ccy -> earliest date a rate is needed. The uncovered gaps up
+                # to today of every currency are planned together and fetched in
+                # parallel; fetched ranges count as covered even where Yahoo has no
+                # rows (weekends, holidays).
                 if not table_cache_enabled.get("fx_daily", True):
                     return
-                ccy = normalize_ccy(ccy)
-                if ccy == "EUR":
+                wanted = {}
+                for ccy, d in needs.items():
+                    ccy = normalize_ccy(ccy)
+                    if ccy and ccy != "EUR" and d:
+                        wanted[ccy] = min(d, wanted.get(ccy, d))
+                if not wanted:
                     return
-                prev = ensured_fx_min.get(ccy)
-                if prev and prev <= min_needed_date:
+                load_fx_coverage(list(wanted))
+                # Load stored rows first so save_fx extends them rather than starting a new series.
+                load_fx_many(list(wanted), fx_window_start(min(wanted.values())))
+                jobs = []
+                for ccy, d in wanted.items():
+                    if not len(fx_cache[ccy]) and not fx_coverage[ccy]:
+                        d = min(d, one_year_ago)
+                    jobs.extend((ccy, r_start, r_end) for r_start, r_end in fx_coverage[ccy].gaps(d, today))
+                if not jobs:
                     return
-                rows = load_fx(ccy)
-                if not rows:
-                    min_needed_date = min(min_needed_date, one_year_ago)
-
-                start_dt = datetime.strptime(min_needed_date, "%Y-%m-%d")
-                end_dt = datetime.strptime(today, "%Y-%m-%d")
-                refresh_cutoff = (datetime.strptime(today, "%Y-%m-%d") - timedelta(days=3)).strftime("%Y-%m-%d")
-
-                wanted = []
-                d = start_dt
-                while d <= end_dt:
-                    ds = d.strftime("%Y-%m-%d")
-                    if (ds not in rows) or (ds >= refresh_cutoff):
-                        wanted.append(ds)
-                    d += timedelta(days=1)
 
-                pair = f"EUR{ccy}=X"
-                for r_start, r_end in contiguous_ranges(wanted):
-                    payload = yahoo_daily_closes(pair, r_start, r_end)
-                    to_save = []
-                    for y in payload.get("rows") or []:
-                        to_save.append(
-                            {
-                                "ccy": ccy,
-                                "date": y["date"],
-                                "eur_to_ccy": y["close"],
-                                "updated_at": now_utc.isoformat(),
-                            }
-                        )
-                    save_fx(ccy, to_save)
-                ensure_fx_anchor_on_date(ccy, min_needed_date)
-                ensured_fx_min[ccy] = min_needed_date
+                def fetch_range(job):
+                    ccy, r_start, r_end = job
+                    try:
+                        return yahoo_daily_closes(f"EUR{ccy}=X", r_start, r_end)
+                    except DeadlineExceeded:
+                        raise
+                    except Exception:
+                        return None
+
+                changed = set()
+                for (ccy, r_start, r_end), payload in zip(jobs, parallel_map(fetch_range, jobs)):
+                    # Failed ranges are not retried within this request (lookups fall back to yahoo_meta).
+                    fx_coverage[ccy].add(r_start, r_end)
+                    if payload is None:
+                        continue
+                    to_save = [
+                        {"ccy": ccy, "date": y["date"], "eur_to_ccy": y["close"], "updated_at": now_utc.isoformat()}
+                        for y in payload.get("rows") or []
+                    ]
+                    if save_fx(ccy, to_save):
+                        fx_coverage_stored[ccy].add(r_start, r_end)
+                        changed.add(ccy)
+                for ccy in {job[0] for job in jobs}:
+                    ensure_fx_anchor_on_date(ccy, wanted[ccy])
+
+                # Only dates before the refresh window are final; later ones are refetched next request.
+                final_until = (now_utc - timedelta(days=FX_REFRESH_DAYS + 1)).strftime("%Y-%m-%d")
+                if changed and table_cache_enabled.get("fx_daily", True):
+                    cache_put_many(
+                        FX_COVERAGE_NAMESPACE,
+                        {ccy: {"intervals": fx_coverage_stored[ccy].to_list(final_until)} for ccy in changed},
+                    )
 
-            def latest_row_on_or_before(table, date):
-                keys = [k for k in table.keys() if k <= date]
-                if not keys:
-                    return None
-                return table[max(keys)]
+            def ensure_fx_history(ccy, min_needed_date):
+                ccy = normalize_ccy(ccy)
+                cov = fx_coverage.get(ccy)
+                if cov is not None and cov.covers(min_needed_date, today):
+                    return
+                ensure_fx_histories({ccy: min_needed_date})
 
             def eur_to_ccy_on_date(ccy: str, date: str):
                 ccy = normalize_ccy(ccy)
                 if ccy == "EUR":
                     return 1.0
                 ensure_fx_history(ccy, date)
-                row = latest_row_on_or_before(load_fx(ccy), date)
-                if row and row.get("eur_to_ccy"):
-                    return float(row["eur_to_ccy"])
+                rate = load_fx(ccy, fx_window_start(date)).value_on_or_before(date)
+                if rate:
+                    return rate
                 try:
                     fx_meta = yahoo_meta(f"EUR{ccy}=X", date)
                     rate = fx_meta.get("regularMarketPrice")
@@ -736,30 +1499,20 @@ class handler(BaseHTTPRequestHandler):
                 except Exception:
                     return None
 
-            def ccy_to_eur_on_date(ccy: str, date: str):
-                ccy = normalize_ccy(ccy)
-                if ccy == "EUR":
-                    return 1.0
-                eur_to_ccy = eur_to_ccy_on_date(ccy, date)
-                return (1.0 / eur_to_ccy) if eur_to_ccy and eur_to_ccy > 1e-12 else None
-
             def ccy_to_eur_today(ccy: str):
                 ccy = normalize_ccy(ccy)
                 if ccy == "EUR":
                     return 1.0
                 ensure_fx_history(ccy, today)
-                today_row = load_fx(ccy).get(today)
-                if today_row:
-                    updated = parse_iso_ts(today_row.get("updated_at"))
+                series = load_fx(ccy, fx_window_start(today))
+                i = series.index_of(today)
+                if i >= 0:
+                    updated = parse_iso_ts(series.aux["updated_at"][i])
                     if updated and (now_utc - updated) <= timedelta(minutes=30):
-                        rate = float(today_row.get("eur_to_ccy") or 0)
+                        rate = series.values[i]
                         return (1.0 / rate) if rate > 1e-12 else None
 
-                try:
-                    fx_meta = yahoo_meta(f"EUR{ccy}=X")
-                    rate = fx_meta.get("regularMarketPrice")
-                except Exception:
-                    rate = None
+                rate = live_quote(f"EUR{ccy}=X").get("regularMarketPrice")
                 if rate:
                     save_fx(
                         ccy,
@@ -768,143 +1521,132 @@ class handler(BaseHTTPRequestHandler):
                     return 1.0 / float(rate)
                 return None
 
+            # First currency recorded on each symbol's transaction closes.
+            txn_close_ccy = {}
+            for t in norm:
+                if t["symbol"] not in txn_close_ccy:
+                    _, ccy = parse_close_price_and_currency(t.get("txn_close_price"))
+                    if ccy:
+                        txn_close_ccy[t["symbol"]] = ccy
+            if checkpoint:
+                for sym, ccy in checkpoint["state"]["asset_ccy"].items():
+                    txn_close_ccy.setdefault(sym, ccy)
+
             def symbol_currency_on_date(symbol: str, date: str):
                 ensure_symbol_history(symbol, date)
-                row = latest_row_on_or_before(load_prices(symbol), date)
-                if row and row.get("currency"):
-                    return normalize_ccy(row.get("currency"))
-                for t in norm:
-                    if t["symbol"] == symbol:
-                        _, ccy = parse_close_price_and_currency(t.get("txn_close_price"))
-                        if ccy:
-                            return normalize_ccy(ccy)
+                series = load_prices(symbol, price_window_start(date))
+                i = series.index_on_or_before(date)
+                if i < 0 and price_loaded_since.get(symbol):
+                    # Nothing inside the lookback window: widen to the full history.
+                    series = load_prices(symbol)
+                    i = series.index_on_or_before(date)
+                ccy = series.currency_at(i)
+                if ccy:
+                    return normalize_ccy(ccy)
+                if txn_close_ccy.get(symbol):
+                    return normalize_ccy(txn_close_ccy[symbol])
                 try:
                     meta_trade = yahoo_meta(symbol)
                     return normalize_ccy(meta_trade.get("currency"))
                 except Exception:
                     return None
 
+            live_quotes = {}  # symbol -> quote meta, one batched fetch per request
+
+            def live_quote(symbol: str):
+                if symbol not in live_quotes:
+                    live_quotes.update(yahoo_quotes([symbol]))
+                return live_quotes.get(symbol) or {}
+
             def latest_symbol_price(symbol: str):
                 ensure_symbol_history(symbol, today)
-                today_row = load_prices(symbol).get(today)
-                if today_row:
-                    updated = parse_iso_ts(today_row.get("updated_at"))
+                series = load_prices(symbol, today)
+                i = series.index_of(today)
+                if i >= 0:
+                    updated = parse_iso_ts(series.aux["updated_at"][i])
                     if updated and (now_utc - updated) <= timedelta(minutes=30):
-                        return normalize_ccy(today_row.get("currency")), float(today_row.get("close_native"))
+                        return normalize_ccy(series.currency_at(i)), series.values[i]
 
-                try:
-                    meta_now = yahoo_meta(symbol)
-                    price_now = meta_now.get("regularMarketPrice")
-                    raw_ccy = meta_now.get("currency")
-                except Exception:
-                    return None, None
+                meta_now = live_quote(symbol)
+                price_now = meta_now.get("regularMarketPrice")
+                raw_ccy = meta_now.get("currency")
                 if price_now is None or not raw_ccy:
                     return None, None
 
                 ccy, close = normalize_price_and_ccy(raw_ccy, price_now)
                 return ccy, close
 
-            # --- Average-cost tracking in NATIVE currency ---
-            qty = {}            # symbol -> open qty
-            cost_native = {}    # symbol -> open cost basis (native)
-            # Cache asset trading currency (from Yahoo at transaction time)
-            asset_ccy = {}  # symbol -> currency
-
+            # FX for currencies known up front is fetched in one planning step and
+            # stored prices are loaded in bulk, so the ledger pass and valuations
+            # only do as-of lookups.
+            fx_needs = {}
             for t in norm:
-                sym = t["symbol"]
-                side = t["side"]
-                q = t["quantity"]
-                price_eur = t["price_eur"]
-                d = t["txn_date"]
-
-                # Determine asset currency at that date
-                ccy = symbol_currency_on_date(sym, d)
-                if not ccy:
-                    raise Exception(f"Missing currency for {sym} on {d}")
-                asset_ccy[sym] = ccy
-
-                # Convert EUR trade price to native currency at transaction date
-                fx_eur_to_ccy = eur_to_ccy_on_date(ccy, d)
-                if fx_eur_to_ccy is None:
-                    raise Exception(f"Missing FX EUR->{ccy} on {d}")
-                trade_price_native = price_eur * fx_eur_to_ccy
-
-                qty.setdefault(sym, 0.0)
-                cost_native.setdefault(sym, 0.0)
-                if side == "BUY":
-                    qty[sym] += q
-                    cost_native[sym] += q * trade_price_native
-                else:
-                    # SELL: realized profit is (sell - avg_cost) * qty_sold in NATIVE currency
-                    if qty[sym] <= 1e-12:
-                        # selling without holdings - ignore
-                        continue
-                    avg_cost = cost_native[sym] / qty[sym]
-                    sell_q = min(q, qty[sym])
+                ccy = txn_close_ccy.get(t["symbol"])
+                if ccy:
+                    fx_needs[ccy] = min(t["txn_date"], fx_needs.get(ccy, t["txn_date"]))
+            for ccy in txn_close_ccy.values():
+                fx_needs.setdefault(ccy, today)
+            ensure_fx_histories(fx_needs)
+            load_prices_many(
+                {t["symbol"] for t in norm} | set((checkpoint or {}).get("state", {}).get("qty") or {}),
+                price_window_start(min((t["txn_date"] for t in norm), default=today)),
+            )
 
-                    qty[sym] -= sell_q
-                    cost_native[sym] -= avg_cost * sell_q
+            # --- Average-cost tracking in NATIVE currency ---
+            ledger = apply_ledger_transactions(
+                norm,
+                symbol_currency_on_date,
+                eur_to_ccy_on_date,
+                state=checkpoint["state"] if checkpoint else None,
+            )
+            # A checkpoint taken after a cut-short events rebuild (including symbols
+            # whose closes were not resolved in time) would lose those events, so
+            # only save it when that phase finished.
+            checkpoint_saved = False
+            if not any(u["stage"] == "prices_events" for u in unfinished):
+                checkpoint_saved = save_ledger_checkpoint(ledger, watermark, pending_events, tx_closes)
+            qty = ledger["qty"]                      # symbol -> open qty
+            cost_native = ledger["cost_native"]      # symbol -> open cost basis (native)
+            asset_ccy = ledger["asset_ccy"]          # symbol -> currency
+            realized_eur = ledger["realized_eur"]    # symbol -> realized in EUR
+            sold_qty_native = ledger["sold_qty_native"]
+            sold_value_native = ledger["sold_value_native"]
+            sold_cost_native = ledger["sold_cost_native"]
 
             # Build portfolio + performance
             results = []
             performance = []
             errors = []
+            skipped = []  # open positions not valued because the deadline was reached
 
             total_unrealized_eur = 0.0
             total_cost_basis_eur = 0.0
             total_realized_eur = 0.0
 
-            # Recompute realized EUR accurately (SELL-by-SELL conversion at sale date)
-            qty2 = {}
-            cost2 = {}
-            realized_eur = {}  # symbol -> realized in EUR
-            sold_qty_native = {}
-            sold_value_native = {}
-            sold_cost_native = {}
-
-            for t in norm:
-                sym = t["symbol"]
-                side = t["side"]
-                q = t["quantity"]
-                price_eur = t["price_eur"]
-                d = t["txn_date"]
-
-                ccy = symbol_currency_on_date(sym, d)
-                if not ccy:
-                    continue
-
-                fx_eur_to_ccy = eur_to_ccy_on_date(ccy, d)
-                fx_ccy_to_eur = ccy_to_eur_on_date(ccy, d)
-                if fx_eur_to_ccy is None or fx_ccy_to_eur is None:
-                    continue
-
-                trade_price_native = price_eur * fx_eur_to_ccy
-
-                qty2.setdefault(sym, 0.0)
-                cost2.setdefault(sym, 0.0)
-                realized_eur.setdefault(sym, 0.0)
-                sold_qty_native.setdefault(sym, 0.0)
-                sold_value_native.setdefault(sym, 0.0)
-                sold_cost_native.setdefault(sym, 0.0)
-
-                if side == "BUY":
-                    qty2[sym] += q
-                    cost2[sym] += q * trade_price_native
-                else:
-                    if qty2[sym] <= 1e-12:
-                        continue
-                    avg_cost = cost2[sym] / qty2[sym]
-                    sell_q = min(q, qty2[sym])
-
-                    realized_native_tx = (trade_price_native - avg_cost) * sell_q
-                    realized_eur_tx = realized_native_tx * fx_ccy_to_eur  # convert at SELL date
-                    realized_eur[sym] += realized_eur_tx
-                    sold_qty_native[sym] += sell_q
-                    sold_value_native[sym] += trade_price_native * sell_q
-                    sold_cost_native[sym] += avg_cost * sell_q
-
-                    qty2[sym] -= sell_q
-                    cost2[sym] -= avg_cost * sell_q
+            # Display names come from the security directory; only symbols whose
+            # stored Yahoo name is missing or stale take it from a live quote.
+            known_names = {}
+            for sym, entry in security_directory_get_many(list(qty)).items():
+                stored, fresh = security_directory_lookup(entry, "yahoo_name")
+                if fresh:
+                    known_names[sym] = stored or ""
+            learned_names = {}  # symbol -> name seen in this request's quotes
+
+            def display_name(sym):
+                if sym in known_names:
+                    return known_names[sym] or None
+                meta = live_quote(sym)
+                name = meta.get("shortName") or meta.get("longName")
+                if meta:
+                    learned_names[sym] = name or ""
+                return name
+
+            # Prefetch quotes (price, currency, names) for open symbols, closed
+            # symbols without a stored name, and the EUR FX pairs of their
+            # currencies in as few requests as possible.
+            fx_pairs = {f"EUR{normalize_ccy(c)}=X" for c in asset_ccy.values() if c and normalize_ccy(c) != "EUR"}
+            quote_symbols = [sym for sym, q_open in qty.items() if q_open > 1e-12 or sym not in known_names]
+            live_quotes.update(yahoo_quotes(quote_symbols + sorted(fx_pairs)))
 
             # Build rows for fully closed positions (quantity == 0) in Performance tab
             closed_symbols = [sym for sym, q_open in qty.items() if q_open <= 1e-12]
@@ -916,11 +1658,7 @@ class handler(BaseHTTPRequestHandler):
                 avg_cost_sold = (sold_cost / sold_qty) if sold_qty > 1e-12 else 0.0
                 avg_sold = (sold_value / sold_qty) if sold_qty > 1e-12 else 0.0
                 percent_realized = ((avg_sold / avg_cost_sold - 1.0) * 100.0) if avg_cost_sold > 1e-12 else 0.0
-                try:
-                    meta_closed = yahoo_meta(sym)
-                    closed_name = meta_closed.get("shortName") or meta_closed.get("longName") or sym
-                except Exception:
-                    closed_name = sym
+                closed_name = display_name(sym) or sym
                 performance.append({
                     "symbol": sym,
                     "name": closed_name,
@@ -934,25 +1672,26 @@ class handler(BaseHTTPRequestHandler):
                     "realized_eur": realized_eur.get(sym, 0.0),
                     "percent_realized": percent_realized,
                 })
-
-            # Now build open positions
-            for sym, q_open in qty.items():
-                if q_open <= 1e-12:
-                    # closed symbols are shown in Performance tab
-                    continue
-
+                if self._stream_format:
+                    self._emit("performance", performance[-1])
+
+            # Now build open positions. Each symbol is valued independently (in
+            # parallel); totals are accumulated here as outcomes arrive.
+            def value_open_position(sym):
+                if deadline_exceeded():
+                    return {"skipped": True}
+                q_open = qty[sym]
                 try:
                     ccy_now, price_now = latest_symbol_price(sym)
-                    meta_now = yahoo_meta(sym)
-                    name = meta_now.get("shortName") or meta_now.get("longName")
+                    name = display_name(sym)
+                    if price_now is None and deadline_exceeded():
+                        return {"skipped": True}
                     if price_now is None or not ccy_now:
-                        errors.append({"symbol": sym, "message": "Missing current price"})
-                        continue
+                        return {"error": {"symbol": sym, "message": "Missing current price"}}
 
                     fx_ccy_to_eur_now = ccy_to_eur_today(ccy_now)
                     if fx_ccy_to_eur_now is None:
-                        errors.append({"symbol": sym, "message": f"Missing FX {ccy_now}->EUR (today)"})
-                        continue
+                        return {"error": {"symbol": sym, "message": f"Missing FX {ccy_now}->EUR (today)"}}
 
                     avg_cost_native = cost_native[sym] / q_open
                     unreal_native = (price_now - avg_cost_native) * q_open
@@ -961,20 +1700,6 @@ class handler(BaseHTTPRequestHandler):
                     cost_basis_eur = cost_native[sym] * fx_ccy_to_eur_now
                     value_eur = (q_open * price_now) * fx_ccy_to_eur_now
 
-                    total_unrealized_eur += unreal_eur
-                    total_cost_basis_eur += cost_basis_eur
-                    total_realized_eur += realized_eur.get(sym, 0.0)
-
-                    results.append({
-                        "symbol": sym,
-                        "name": name,
-                        "price": price_now,
-                        "currency": ccy_now,
-                        "quantity": q_open,
-                        "value": q_open * price_now,
-                        "value_eur": value_eur,
-                    })
-
                     sold_qty = sold_qty_native.get(sym, 0.0)
                     sold_value = sold_value_native.get(sym, 0.0)
                     sold_cost = sold_cost_native.get(sym, 0.0)
@@ -982,26 +1707,69 @@ class handler(BaseHTTPRequestHandler):
                     avg_cost_sold = (sold_cost / sold_qty) if sold_qty > 1e-12 else 0.0
                     percent_realized = ((avg_sold / avg_cost_sold - 1.0) * 100.0) if avg_cost_sold > 1e-12 else 0.0
 
-                    performance.append({
-                        "symbol": sym,
-                        "name": name,
-                        "quantity": q_open,
-                        "avg_cost": avg_cost_native,
-                        "avg_sold": avg_sold,
-                        "current_price": price_now,
-                        "currency": ccy_now,
+                    return {
                         "unrealized_eur": unreal_eur,
-                        "percent_unrealized": (price_now / avg_cost_native - 1.0) * 100.0 if avg_cost_native > 1e-12 else 0.0,
-                        "realized_eur": realized_eur.get(sym, 0.0),
-                        "percent_realized": percent_realized,
-                    })
-
+                        "cost_basis_eur": cost_basis_eur,
+                        "result": {
+                            "symbol": sym,
+                            "name": name,
+                            "price": price_now,
+                            "currency": ccy_now,
+                            "quantity": q_open,
+                            "value": q_open * price_now,
+                            "value_eur": value_eur,
+                        },
+                        "performance": {
+                            "symbol": sym,
+                            "name": name,
+                            "quantity": q_open,
+                            "avg_cost": avg_cost_native,
+                            "avg_sold": avg_sold,
+                            "current_price": price_now,
+                            "currency": ccy_now,
+                            "unrealized_eur": unreal_eur,
+                            "percent_unrealized": (price_now / avg_cost_native - 1.0) * 100.0 if avg_cost_native > 1e-12 else 0.0,
+                            "realized_eur": realized_eur.get(sym, 0.0),
+                            "percent_realized": percent_realized,
+                        },
+                    }
+
+                except DeadlineExceeded:
+                    return {"skipped": True}
                 except Exception as e:
-                    errors.append({"symbol": sym, "message": str(e)})
+                    return {"error": {"symbol": sym, "message": str(e)}}
+
+            # closed symbols are shown in Performance tab
+            open_symbols = [sym for sym, q_open in qty.items() if q_open > 1e-12]
+            if self._stream_format:
+                # Fastest symbols first; clients sort on their side.
+                outcomes = parallel_as_completed(value_open_position, open_symbols)
+            else:
+                outcomes = zip(open_symbols, parallel_map(value_open_position, open_symbols))
+
+            for sym, outcome in outcomes:
+                if outcome.get("skipped"):
+                    skipped.append(sym)
+                    continue
+                if outcome.get("error"):
+                    errors.append(outcome["error"])
+                    continue
+                total_unrealized_eur += outcome["unrealized_eur"]
+                total_cost_basis_eur += outcome["cost_basis_eur"]
+                total_realized_eur += realized_eur.get(sym, 0.0)
+                results.append(outcome["result"])
+                performance.append(outcome["performance"])
+                if self._stream_format:
+                    self._emit("position", {"result": outcome["result"], "performance": outcome["performance"]})
+
+            if skipped:
+                unfinished.append({"stage": "positions", "symbols": skipped})
+            if learned_names:
+                security_directory_update_many({sym: {"yahoo_name": name} for sym, name in learned_names.items()})
 
             total_percent = (total_unrealized_eur / total_cost_basis_eur) * 100.0 if total_cost_basis_eur > 1e-12 else 0.0
 
-            self._send(200, {
+            payload = {
                 "status": "ok",
                 "user": {"id": user_id, "email": email},
                 "results": results,
@@ -1013,8 +1781,14 @@ class handler(BaseHTTPRequestHandler):
                     "total_realized_eur": total_realized_eur,
                 },
                 "errors": errors,
+                "partial": bool(unfinished),
+                "skipped": skipped,
+                "unfinished": unfinished,
                 "prices_rows_written": prices_rows_written,
-                "price_symbols_seen": len({t["symbol"] for t in norm}),
+                "price_symbols_seen": len(set(qty) | {t["symbol"] for t in norm}),
+                "ledger_mode": "incremental" if checkpoint else "full",
+                "ledger_replayed_rows": len(norm),
+                "ledger_checkpoint_saved": checkpoint_saved,
                 "asset_event_prices_grid_rows": asset_event_stats.get("grid_rows", 0),
                 "asset_event_prices_updated_rows": asset_event_stats.get("updated_rows", 0),
                 "asset_event_prices_updated_ok": asset_event_stats.get("updated_ok", 0),
@@ -1024,7 +1798,16 @@ class handler(BaseHTTPRequestHandler):
                 "asset_event_prices_symbols": asset_event_stats.get("symbols", 0),
                 "asset_event_prices_dates": asset_event_stats.get("dates", 0),
                 "write_warnings": write_warnings,
-            })
-
+            }
+            if self._stream_format:
+                # Rows were already streamed; the summary carries totals, errors and stats.
+                payload.pop("results")
+                payload.pop("performance")
+                self._emit("summary", payload)
+            else:
+                self._send(200, payload)
+
+        except DeadlineExceeded as e:
+            self._send(504, {"status": "error", "message": f"Request budget exhausted: {str(e)}", "unfinished": unfinished})
         except Exception as e:
             self._send(502, {"status": "error", "message": f"Upstream failed: {str(e)}"})
@@ -0,0 +1,31 @@
+-- Bulk update of resolved security_name / txn_close_price for /api/isin_name sync.
+-- Paste this in Supabase SQL Editor. Safe to run multiple times.
+--
+-- p_rows is a JSON array like [{"id": 1, "security_name": "...", "txn_close_price": "12.34 EUR"}].
+-- A key that is absent leaves the column unchanged. Only rows of p_user_id are touched.
+-- Ids are compared as text so this works whether transactions.id is bigint or uuid.
+-- Returns the number of updated rows.
+
+create or replace function public.bulk_update_transaction_metadata(p_user_id uuid, p_rows jsonb)
+returns integer
+language sql
+as $$
+  with src as (
+    select r as payload, r->>'id' as id
+    from jsonb_array_elements(p_rows) r
+  ),
+  upd as (
+    update public.transactions t
+    set
+      security_name = case when s.payload ? 'security_name' then s.payload->>'security_name' else t.security_name end,
+      txn_close_price = case when s.payload ? 'txn_close_price' then s.payload->>'txn_close_price' else t.txn_close_price end
+    from src s
+    where t.id::text = s.id
+      and t.user_id = p_user_id
+    returning 1
+  )
+  select count(*)::int from upd;
+$$;
+
+revoke all on function public.bulk_update_transaction_metadata(uuid, jsonb) from public, anon, authenticated;
+grant execute on function public.bulk_update_transaction_metadata(uuid, jsonb) to service_role;
@@ -6,9 +6,22 @@ begin;
 -- Remove RPCs that depend on portfolio_daily_value.
 drop function if exists public.refresh_portfolio_daily_value_on_login(date);
 drop function if exists public.refresh_portfolio_daily_value(uuid, date, boolean);
+drop function if exists public.portfolio_daily_value_rows(uuid, date, date);
+
+-- Remove the dirty-from triggers that write into portfolio_daily_value_dirty.
+drop trigger if exists transactions_portfolio_daily_value_dirty_ins_del on public.transactions;
+drop trigger if exists transactions_portfolio_daily_value_dirty_upd on public.transactions;
+drop trigger if exists fx_daily_portfolio_daily_value_dirty_ins on public.fx_daily;
+drop trigger if exists fx_daily_portfolio_daily_value_dirty_upd on public.fx_daily;
+drop trigger if exists fx_daily_portfolio_daily_value_dirty_del on public.fx_daily;
+drop function if exists public.portfolio_daily_value_dirty_from_transactions();
+drop function if exists public.portfolio_daily_value_dirty_from_prices() cascade;
+drop function if exists public.portfolio_daily_value_dirty_from_fx();
+drop function if exists public.mark_portfolio_daily_value_dirty(uuid, date);
 
 -- Remove cache tables.
 drop table if exists public.asset_event_prices;
+drop table if exists public.portfolio_daily_value_dirty;
 drop table if exists public.portfolio_daily_value;
 drop table if exists public.prices;
 
@@ -32,185 +32,428 @@ begin
 end;
 $$;
 
--- Recompute/backfill valuations for a specific user under the new policy:
+-- Index-friendly normalized symbol for as-of price lookups (transactions store
+-- symbols as typed; upper(trim(symbol)) on prices would defeat the index).
+alter table public.prices
+  add column if not exists symbol_norm text generated always as (upper(btrim(symbol))) stored;
+
+-- Synthetic anchors (copied from a later date) are never used for valuation,
+-- so they are left out of the index; the predicate below must match the query.
+create index if not exists prices_symbol_norm_date_idx
+  on public.prices (symbol_norm, date desc)
+  include (close_native, currency)
+  where source is distinct from 'synthetic_anchor';
+
+-- Valuation rows for one user on or after p_from (all dates when null):
 -- 1) one row on each month-end business day
 -- 2) one row 2 business days after each net quantity change date
 -- 3) value = sum((BUY qty - SELL qty) * market price) at valuation date
-create or replace function public.refresh_portfolio_daily_value(
+-- Holdings are running sums of per-day quantity changes, so the cost is
+-- O((valuation dates x symbols + transactions) log n) instead of joining every
+-- valuation date to every earlier transaction. Prices and FX are as-of index
+-- lookups on prices_symbol_norm_date_idx and the fx_daily (ccy, date) key.
+-- Plain SQL without a search_path setting so the planner can inline it
+-- (EXPLAIN ANALYZE shows the full plan, see portfolio_daily_value_benchmark.sql).
+create or replace function public.portfolio_daily_value_rows(
   p_user_id uuid,
   p_as_of date default current_date,
-  p_rebuild boolean default false
+  p_from date default null
 )
-returns void
-language plpgsql
-security definer
-set search_path = public
+returns table (valuation_date date, portfolio_value_eur numeric)
+language sql
+stable
 as $$
-declare
-  v_min_txn_date date;
-  v_start_date date;
-begin
-  if p_user_id is null then
-    raise exception 'p_user_id is required';
-  end if;
-
-  select min(t.txn_date)::date
-    into v_min_txn_date
-  from public.transactions t
-  where t.user_id = p_user_id
-    and t.txn_date is not null;
-
-  -- No transactions -> clear existing valuations and exit.
-  if v_min_txn_date is null then
-    delete from public.portfolio_daily_value where user_id = p_user_id;
-    return;
-  end if;
-
-  -- Always rebuild the full valuation timeline for the user.
-  -- This avoids stale historical rows after pricing/FX policy changes
-  -- (for example removing synthetic anchor prices from valuation).
-  -- Keep p_rebuild for API compatibility, but behavior is intentionally
-  -- equivalent for both true/false.
-  if p_rebuild then
-    null;
-  end if;
-
-  delete from public.portfolio_daily_value where user_id = p_user_id;
-  v_start_date := v_min_txn_date;
-
-  if v_start_date > p_as_of then
-    return;
-  end if;
-
   with tx as (
     select
-      t.user_id,
-      upper(trim(t.symbol)) as symbol,
-      t.side,
-      t.quantity::numeric as quantity,
-      t.txn_date::date as txn_date
+      upper(btrim(t.symbol)) as symbol,
+      t.txn_date::date as txn_date,
+      case when t.side = 'BUY' then t.quantity::numeric
+           when t.side = 'SELL' then -t.quantity::numeric
+           else 0 end as delta_qty
     from public.transactions t
     where t.user_id = p_user_id
-      and t.txn_date::date between v_min_txn_date and p_as_of
+      and t.txn_date is not null
+      and t.txn_date::date <= p_as_of
   ),
-  qty_change_dates as (
-    -- Keep only days where net qty changes for at least one symbol.
-    select d.txn_date as change_date
-    from (
-      select
-        txn_date,
-        symbol,
-        sum(
-          case when side = 'BUY' then quantity
-               when side = 'SELL' then -quantity
-               else 0 end
-        ) as delta_qty
-      from tx
-      group by txn_date, symbol
-    ) d
-    group by d.txn_date
-    having bool_or(abs(d.delta_qty) > 0)
+  deltas as (
+    select symbol, txn_date, sum(delta_qty) as delta_qty
+    from tx
+    group by symbol, txn_date
   ),
-  trigger_dates as (
-    select public.add_business_days(q.change_date, 2) as valuation_date
-    from qty_change_dates q
+  bounds as (
+    select min(txn_date) as start_date from deltas
   ),
-  month_starts as (
-    select date_trunc('month', gs)::date as month_start
-    from generate_series(date_trunc('month', v_start_date), date_trunc('month', p_as_of), interval '1 month') gs
+  trigger_dates as (
+    -- Days where net qty changes for at least one symbol, +2 business days.
+    select public.add_business_days(d.txn_date, 2) as valuation_date
+    from deltas d
+    group by d.txn_date
+    having bool_or(abs(d.delta_qty) > 0)
   ),
   month_end_business_dates as (
-    select max((ms.month_start + offs.day_offset)::date) as valuation_date
-    from month_starts ms
-    cross join lateral generate_series(0, 31) as offs(day_offset)
-    where (ms.month_start + offs.day_offset)::date >= ms.month_start
-      and (ms.month_start + offs.day_offset)::date < (ms.month_start + interval '1 month')::date
-      and extract(isodow from (ms.month_start + offs.day_offset)::date) between 1 and 5
-    group by ms.month_start
+    select (me.month_end - case extract(isodow from me.month_end)::int
+                             when 6 then 1 when 7 then 2 else 0 end) as valuation_date
+    from bounds b
+    cross join lateral generate_series(date_trunc('month', b.start_date), date_trunc('month', p_as_of), interval '1 month') gs
+    cross join lateral (select (gs + interval '1 month' - interval '1 day')::date as month_end) me
   ),
   valuation_dates as (
-    select distinct valuation_date
+    select distinct s.valuation_date
     from (
       select valuation_date from trigger_dates
       union all
       select valuation_date from month_end_business_dates
     ) s
-    where valuation_date between v_start_date and p_as_of
+    cross join bounds b
+    where s.valuation_date between b.start_date and p_as_of
+      and s.valuation_date >= coalesce(p_from, b.start_date)
+  ),
+  timeline as (
+    -- Quantity changes plus a zero-delta marker per (symbol, valuation date);
+    -- markers sort after same-day changes, matching txn_date <= valuation_date.
+    select symbol, txn_date as d, delta_qty, false as is_valuation
+    from deltas
+    union all
+    select s.symbol, vd.valuation_date, 0, true
+    from (select distinct symbol from deltas) s
+    cross join valuation_dates vd
   ),
   holdings as (
-    select
-      vd.valuation_date,
-      tx.symbol,
-      sum(
-        case when tx.side = 'BUY' then tx.quantity
-             when tx.side = 'SELL' then -tx.quantity
-             else 0 end
-      ) as qty
-    from valuation_dates vd
-    join tx
-      on tx.txn_date <= vd.valuation_date
-    group by vd.valuation_date, tx.symbol
-    having sum(
-      case when tx.side = 'BUY' then tx.quantity
-           when tx.side = 'SELL' then -tx.quantity
-           else 0 end
-    ) > 0
+    select r.d as valuation_date, r.symbol, r.qty
+    from (
+      select
+        symbol, d, is_valuation,
+        sum(delta_qty) over (partition by symbol order by d, is_valuation rows unbounded preceding) as qty
+      from timeline
+    ) r
+    where r.is_valuation
+      and r.qty > 0
   ),
   priced_holdings as (
-    select
-      h.valuation_date,
-      h.symbol,
-      h.qty,
-      p.close_native,
-      p.currency
+    select h.valuation_date, h.qty, p.close_native, p.currency
     from holdings h
-    left join lateral (
+    join lateral (
       select pd.close_native, pd.currency
       from public.prices pd
-      where upper(trim(pd.symbol)) = h.symbol
+      where pd.symbol_norm = h.symbol
         and pd.date <= h.valuation_date
-        -- Never value historical rows with synthetic anchors copied from
-        -- a later date (can otherwise leak current prices into the past).
-        and coalesce(pd.source, '') <> 'synthetic_anchor'
+        and pd.source is distinct from 'synthetic_anchor'
       order by pd.date desc
       limit 1
     ) p on true
   ),
-  eur_valued as (
-    select
-      ph.valuation_date,
-      case
-        when ph.close_native is not null then
-          ph.qty * ph.close_native * (
-            case
-              when ph.currency = 'EUR' then 1
-              when fx.eur_to_ccy is not null and fx.eur_to_ccy <> 0 then 1 / fx.eur_to_ccy
-              else null
-            end
-          )
-        else null
-      end as value_eur
-    from priced_holdings ph
+  fx_rates as (
+    -- One as-of FX lookup per (currency, date) rather than per holding.
+    select c.currency, c.valuation_date, fx.eur_to_ccy
+    from (
+      select distinct currency, valuation_date
+      from priced_holdings
+      where currency <> 'EUR'
+    ) c
     left join lateral (
       select f.eur_to_ccy
       from public.fx_daily f
-      where f.ccy = ph.currency
-        and f.date <= ph.valuation_date
+      where f.ccy = c.currency
+        and f.date <= c.valuation_date
       order by f.date desc
       limit 1
-    ) fx on ph.currency <> 'EUR'
-    where ph.close_native is not null
+    ) fx on true
+  ),
+  eur_valued as (
+    select
+      ph.valuation_date,
+      ph.qty * ph.close_native * (
+        case
+          when ph.currency = 'EUR' then 1
+          when fr.eur_to_ccy is not null and fr.eur_to_ccy <> 0 then 1 / fr.eur_to_ccy
+          else null
+        end
+      ) as value_eur
+    from priced_holdings ph
+    left join fx_rates fr
+      on fr.currency = ph.currency
+     and fr.valuation_date = ph.valuation_date
   )
-  insert into public.portfolio_daily_value (user_id, valuation_date, portfolio_value_eur, refreshed_at)
   select
-    p_user_id,
     vd.valuation_date,
-    coalesce(sum(ev.value_eur), 0)::numeric(20, 6) as portfolio_value_eur,
-    now()
+    coalesce(sum(ev.value_eur), 0)::numeric(20, 6) as portfolio_value_eur
   from valuation_dates vd
   left join eur_valued ev
     on ev.valuation_date = vd.valuation_date
-  group by vd.valuation_date
+  group by vd.valuation_date;
+$$;
+
+revoke all on function public.portfolio_daily_value_rows(uuid, date, date) from public, anon, authenticated;
+
+-- Earliest valuation date per user that may be stale. Written by the triggers
+-- below, consumed (deleted) by refresh_portfolio_daily_value.
+create table if not exists public.portfolio_daily_value_dirty (
+  user_id uuid primary key references auth.users (id) on delete cascade,
+  dirty_from date not null,
+  updated_at timestamptz not null default now()
+);
+
+alter table public.portfolio_daily_value_dirty enable row level security;
+
+-- Price lookups from the prices trigger match on the normalized symbol.
+create index if not exists transactions_symbol_norm_user_idx
+  on public.transactions (upper(btrim(symbol)), user_id);
+
+create or replace function public.mark_portfolio_daily_value_dirty(p_user_id uuid, p_from date)
+returns void
+language sql
+security definer
+set search_path = public
+as $$
+  insert into public.portfolio_daily_value_dirty as d (user_id, dirty_from, updated_at)
+  select p_user_id, p_from, now()
+  where p_user_id is not null and p_from is not null
+  on conflict (user_id)
+  do update set
+    dirty_from = least(d.dirty_from, excluded.dirty_from),
+    updated_at = now();
+$$;
+
+revoke all on function public.mark_portfolio_daily_value_dirty(uuid, date) from public, anon, authenticated;
+
+-- A transaction only affects valuations on or after its own date.
+create or replace function public.portfolio_daily_value_dirty_from_transactions()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  if tg_op in ('UPDATE', 'DELETE') then
+    perform public.mark_portfolio_daily_value_dirty(old.user_id, old.txn_date::date);
+  end if;
+  if tg_op in ('INSERT', 'UPDATE') then
+    perform public.mark_portfolio_daily_value_dirty(new.user_id, new.txn_date::date);
+  end if;
+  return null;
+end;
+$$;
+
+drop trigger if exists transactions_portfolio_daily_value_dirty_ins_del on public.transactions;
+create trigger transactions_portfolio_daily_value_dirty_ins_del
+  after insert or delete on public.transactions
+  for each row execute function public.portfolio_daily_value_dirty_from_transactions();
+
+-- Name/close-price refreshes from /api/isin_name do not change valuations.
+drop trigger if exists transactions_portfolio_daily_value_dirty_upd on public.transactions;
+create trigger transactions_portfolio_daily_value_dirty_upd
+  after update of user_id, symbol, side, quantity, txn_date on public.transactions
+  for each row execute function public.portfolio_daily_value_dirty_from_transactions();
+
+-- A changed close dirties every user who ever traded the symbol, from the
+-- earliest changed date (statement-level, so bulk upserts cost one pass).
+-- Updates only count rows whose close, currency or source actually changed,
+-- so re-upserting identical closes marks nothing.
+create or replace function public.portfolio_daily_value_dirty_from_prices()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_symbols text[];
+  v_dates date[];
+begin
+  if tg_op = 'INSERT' then
+    select array_agg(c.symbol_norm), array_agg(c.min_date) into v_symbols, v_dates
+    from (
+      select upper(btrim(symbol)) as symbol_norm, min(date) as min_date
+      from new_rows
+      where source is distinct from 'synthetic_anchor'
+      group by 1
+    ) c;
+  elsif tg_op = 'DELETE' then
+    select array_agg(c.symbol_norm), array_agg(c.min_date) into v_symbols, v_dates
+    from (
+      select upper(btrim(symbol)) as symbol_norm, min(date) as min_date
+      from old_rows
+      where source is distinct from 'synthetic_anchor'
+      group by 1
+    ) c;
+  else
+    -- Rows whose (symbol, date) changed show up on one side only.
+    select array_agg(c.symbol_norm), array_agg(c.min_date) into v_symbols, v_dates
+    from (
+      select upper(btrim(coalesce(n.symbol, o.symbol))) as symbol_norm, min(coalesce(n.date, o.date)) as min_date
+      from new_rows n
+      full join old_rows o
+        on o.symbol = n.symbol
+       and o.date = n.date
+      where (o.close_native, o.currency, o.source) is distinct from (n.close_native, n.currency, n.source)
+        and (
+          (n.symbol is not null and n.source is distinct from 'synthetic_anchor')
+          or (o.symbol is not null and o.source is distinct from 'synthetic_anchor')
+        )
+      group by 1
+    ) c;
+  end if;
+  if v_symbols is null then
+    return null;
+  end if;
+
+  insert into public.portfolio_daily_value_dirty as d (user_id, dirty_from, updated_at)
+  select t.user_id, min(c.min_date), now()
+  from unnest(v_symbols, v_dates) as c (symbol_norm, min_date)
+  join public.transactions t
+    on upper(btrim(t.symbol)) = c.symbol_norm
+  group by t.user_id
+  on conflict (user_id)
+  do update set dirty_from = least(d.dirty_from, excluded.dirty_from), updated_at = now();
+  return null;
+end;
+$$;
+
+drop trigger if exists prices_portfolio_daily_value_dirty_ins on public.prices;
+create trigger prices_portfolio_daily_value_dirty_ins
+  after insert on public.prices
+  referencing new table as new_rows
+  for each statement execute function public.portfolio_daily_value_dirty_from_prices();
+
+drop trigger if exists prices_portfolio_daily_value_dirty_upd on public.prices;
+create trigger prices_portfolio_daily_value_dirty_upd
+  after update on public.prices
+  referencing old table as old_rows new table as new_rows
+  for each statement execute function public.portfolio_daily_value_dirty_from_prices();
+
+drop trigger if exists prices_portfolio_daily_value_dirty_del on public.prices;
+create trigger prices_portfolio_daily_value_dirty_del
+  after delete on public.prices
+  referencing old table as old_rows
+  for each statement execute function public.portfolio_daily_value_dirty_from_prices();
+
+-- A changed rate dirties, from the earliest changed date, users with stored
+-- valuations from then on who traded a symbol priced in that currency.
+-- Updates only count rows whose rate actually changed.
+create or replace function public.portfolio_daily_value_dirty_from_fx()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_ccys text[];
+  v_dates date[];
+begin
+  if tg_op = 'INSERT' then
+    select array_agg(c.ccy), array_agg(c.min_date) into v_ccys, v_dates
+    from (select ccy, min(date) as min_date from new_rows group by ccy) c;
+  elsif tg_op = 'DELETE' then
+    select array_agg(c.ccy), array_agg(c.min_date) into v_ccys, v_dates
+    from (select ccy, min(date) as min_date from old_rows group by ccy) c;
+  else
+    select array_agg(c.ccy), array_agg(c.min_date) into v_ccys, v_dates
+    from (
+      select coalesce(n.ccy, o.ccy) as ccy, min(coalesce(n.date, o.date)) as min_date
+      from new_rows n
+      full join old_rows o
+        on o.ccy = n.ccy
+       and o.date = n.date
+      where o.eur_to_ccy is distinct from n.eur_to_ccy
+      group by 1
+    ) c;
+  end if;
+  if v_ccys is null then
+    return null;
+  end if;
+
+  insert into public.portfolio_daily_value_dirty as d (user_id, dirty_from, updated_at)
+  select t.user_id, min(c.min_date), now()
+  from unnest(v_ccys, v_dates) as c (ccy, min_date)
+  join public.transactions t
+    on exists (
+      select 1
+      from public.prices p
+      where p.symbol_norm = upper(btrim(t.symbol))
+        and p.source is distinct from 'synthetic_anchor'
+        and p.currency = c.ccy
+    )
+  where exists (
+    select 1
+    from public.portfolio_daily_value v
+    where v.user_id = t.user_id
+      and v.valuation_date >= c.min_date
+  )
+  group by t.user_id
+  on conflict (user_id)
+  do update set dirty_from = least(d.dirty_from, excluded.dirty_from), updated_at = now();
+  return null;
+end;
+$$;
+
+drop trigger if exists fx_daily_portfolio_daily_value_dirty_ins on public.fx_daily;
+create trigger fx_daily_portfolio_daily_value_dirty_ins
+  after insert on public.fx_daily
+  referencing new table as new_rows
+  for each statement execute function public.portfolio_daily_value_dirty_from_fx();
+
+drop trigger if exists fx_daily_portfolio_daily_value_dirty_upd on public.fx_daily;
+create trigger fx_daily_portfolio_daily_value_dirty_upd
+  after update on public.fx_daily
+  referencing old table as old_rows new table as new_rows
+  for each statement execute function public.portfolio_daily_value_dirty_from_fx();
+
+drop trigger if exists fx_daily_portfolio_daily_value_dirty_del on public.fx_daily;
+create trigger fx_daily_portfolio_daily_value_dirty_del
+  after delete on public.fx_daily
+  referencing old table as old_rows
+  for each statement execute function public.portfolio_daily_value_dirty_from_fx();
+
+-- Recompute valuations for a specific user (policy in portfolio_daily_value_rows).
+-- Incremental by default: only dates on or after the user's dirty_from, plus
+-- dates after the last stored row (new month-ends / trigger dates), are
+-- recomputed. p_rebuild => true rebuilds the full timeline, e.g. after a
+-- pricing/FX policy change.
+create or replace function public.refresh_portfolio_daily_value(
+  p_user_id uuid,
+  p_as_of date default current_date,
+  p_rebuild boolean default false
+)
+returns void
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+  v_dirty_from date;
+  v_last_date date;
+  v_from date;
+begin
+  if p_user_id is null then
+    raise exception 'p_user_id is required';
+  end if;
+
+  -- Consume the marker first: changes committed while this runs mark it again.
+  delete from public.portfolio_daily_value_dirty
+  where user_id = p_user_id
+  returning dirty_from into v_dirty_from;
+
+  select max(v.valuation_date)
+    into v_last_date
+  from public.portfolio_daily_value v
+  where v.user_id = p_user_id;
+
+  if p_rebuild or v_last_date is null then
+    v_from := null;
+  else
+    v_from := least(v_dirty_from, v_last_date + 1);
+    if v_from > p_as_of then
+      return;
+    end if;
+  end if;
+
+  -- No transactions -> no rows.
+  delete from public.portfolio_daily_value
+  where user_id = p_user_id
+    and (v_from is null or valuation_date >= v_from);
+
+  insert into public.portfolio_daily_value (user_id, valuation_date, portfolio_value_eur, refreshed_at)
+  select p_user_id, r.valuation_date, r.portfolio_value_eur, now()
+  from public.portfolio_daily_value_rows(p_user_id, p_as_of, v_from) r
   on conflict (user_id, valuation_date)
   do update set
     portfolio_value_eur = excluded.portfolio_value_eur,
@@ -247,3 +490,5 @@ grant execute on function public.add_business_days(date, int) to authenticated;
 -- One-time reset/rebuild (manual):
 -- truncate table public.portfolio_daily_value;
 -- select public.refresh_portfolio_daily_value('<user-uuid>', current_date, true);
+-- Force the next incremental refresh to start at a date:
+-- select public.mark_portfolio_daily_value_dirty('<user-uuid>', date '2024-01-01');
@@ -0,0 +1,225 @@
+-- EXPLAIN ANALYZE comparison for refresh_portfolio_daily_value on a synthetic
+-- 10-year, 100-symbol user. Paste this in Supabase SQL Editor after
+-- portfolio_daily_value.sql. Everything runs in one transaction and is rolled
+-- back, so no benchmark rows are kept.
+--
+-- pg_temp.portfolio_daily_value_rows_legacy is the previous query (every
+-- valuation date joined to every earlier transaction, prices matched on
+-- upper(trim(symbol))). Compare the two plans' execution times, the
+-- "Rows Removed by Join Filter" of the legacy holdings join and the index
+-- used for the price lookups.
+--
+-- Setup: auth.users rows are owned by Supabase Auth, so the script does not
+-- create one. It borrows an existing user that has no transactions (e.g. a
+-- throwaway account added under Authentication > Users) and stops with an
+-- error if there is none. That user's id is kept in the transaction-local
+-- setting portfolio_benchmark.user_id.
+
+begin;
+
+select set_config(
+  'portfolio_benchmark.user_id',
+  coalesce((
+    select u.id::text
+    from auth.users u
+    where not exists (select 1 from public.transactions t where t.user_id = u.id)
+    order by u.created_at
+    limit 1
+  ), ''),
+  true
+);
+
+do $$
+begin
+  if current_setting('portfolio_benchmark.user_id') = '' then
+    raise exception 'portfolio benchmark needs an auth.users row without transactions; add a throwaway user first';
+  end if;
+end
+$$;
+
+-- 100 symbols (half USD), a BUY every month for 10 years and a SELL every quarter.
+insert into public.transactions (user_id, symbol, side, quantity, price, txn_date, created_at)
+select
+  current_setting('portfolio_benchmark.user_id')::uuid,
+  format('bench%s', lpad(s::text, 3, '0')),
+  case when m % 3 = 2 then 'SELL' else 'BUY' end,
+  case when m % 3 = 2 then 1 else 2 end,
+  10 + s,
+  (current_date - interval '10 years' + make_interval(months => m, days => s % 28))::date,
+  now()
+from generate_series(0, 99) s
+cross join generate_series(0, 119) m;
+
+-- Weekly closes per symbol plus a synthetic anchor that must be ignored.
+insert into public.prices (symbol, date, close_native, currency, source, updated_at)
+select
+  format('BENCH%s', lpad(s::text, 3, '0')),
+  d::date,
+  10 + s + (extract(epoch from d) / 86400 / 365)::numeric,
+  case when s % 2 = 0 then 'EUR' else 'USD' end,
+  case when d = current_date - 7 then 'synthetic_anchor' else 'benchmark' end,
+  now()
+from generate_series(0, 99) s
+cross join generate_series(current_date - interval '10 years', current_date, interval '7 days') d
+on conflict (symbol, date) do nothing;
+
+insert into public.fx_daily (ccy, date, eur_to_ccy, updated_at)
+select 'USD', d::date, 1.1, now()
+from generate_series(current_date - interval '10 years', current_date, interval '1 day') d
+where extract(isodow from d) between 1 and 5
+on conflict (ccy, date) do nothing;
+
+analyze public.transactions;
+analyze public.prices;
+analyze public.fx_daily;
+
+create function pg_temp.portfolio_daily_value_rows_legacy(p_user_id uuid, p_as_of date)
+returns table (valuation_date date, portfolio_value_eur numeric)
+language sql
+stable
+as $$
+  with tx as (
+    select
+      t.user_id,
+      upper(trim(t.symbol)) as symbol,
+      t.side,
+      t.quantity::numeric as quantity,
+      t.txn_date::date as txn_date
+    from public.transactions t
+    where t.user_id = p_user_id
+      and t.txn_date::date between (select min(t0.txn_date)::date from public.transactions t0 where t0.user_id = p_user_id) and p_as_of
+  ),
+  qty_change_dates as (
+    -- Keep only days where net qty changes for at least one symbol.
+    select d.txn_date as change_date
+    from (
+      select
+        txn_date,
+        symbol,
+        sum(
+          case when side = 'BUY' then quantity
+               when side = 'SELL' then -quantity
+               else 0 end
+        ) as delta_qty
+      from tx
+      group by txn_date, symbol
+    ) d
+    group by d.txn_date
+    having bool_or(abs(d.delta_qty) > 0)
+  ),
+  trigger_dates as (
+    select public.add_business_days(q.change_date, 2) as valuation_date
+    from qty_change_dates q
+  ),
+  month_starts as (
+    select date_trunc('month', gs)::date as month_start
+    from generate_series(date_trunc('month', (select min(t0.txn_date)::date from public.transactions t0 where t0.user_id = p_user_id)), date_trunc('month', p_as_of), interval '1 month') gs
+  ),
+  month_end_business_dates as (
+    select max((ms.month_start + offs.day_offset)::date) as valuation_date
+    from month_starts ms
+    cross join lateral generate_series(0, 31) as offs(day_offset)
+    where (ms.month_start + offs.day_offset)::date >= ms.month_start
+      and (ms.month_start + offs.day_offset)::date < (ms.month_start + interval '1 month')::date
+      and extract(isodow from (ms.month_start + offs.day_offset)::date) between 1 and 5
+    group by ms.month_start
+  ),
+  valuation_dates as (
+    select distinct valuation_date
+    from (
+      select valuation_date from trigger_dates
+      union all
+      select valuation_date from month_end_business_dates
+    ) s
+    where valuation_date between (select min(t0.txn_date)::date from public.transactions t0 where t0.user_id = p_user_id) and p_as_of
+  ),
+  holdings as (
+    select
+      vd.valuation_date,
+      tx.symbol,
+      sum(
+        case when tx.side = 'BUY' then tx.quantity
+             when tx.side = 'SELL' then -tx.quantity
+             else 0 end
+      ) as qty
+    from valuation_dates vd
+    join tx
+      on tx.txn_date <= vd.valuation_date
+    group by vd.valuation_date, tx.symbol
+    having sum(
+      case when tx.side = 'BUY' then tx.quantity
+           when tx.side = 'SELL' then -tx.quantity
+           else 0 end
+    ) > 0
+  ),
+  priced_holdings as (
+    select
+      h.valuation_date,
+      h.symbol,
+      h.qty,
+      p.close_native,
+      p.currency
+    from holdings h
+    left join lateral (
+      select pd.close_native, pd.currency
+      from public.prices pd
+      where upper(trim(pd.symbol)) = h.symbol
+        and pd.date <= h.valuation_date
+        -- Never value historical rows with synthetic anchors copied from
+        -- a later date (can otherwise leak current prices into the past).
+        and coalesce(pd.source, '') <> 'synthetic_anchor'
+      order by pd.date desc
+      limit 1
+    ) p on true
+  ),
+  eur_valued as (
+    select
+      ph.valuation_date,
+      case
+        when ph.close_native is not null then
+          ph.qty * ph.close_native * (
+            case
+              when ph.currency = 'EUR' then 1
+              when fx.eur_to_ccy is not null and fx.eur_to_ccy <> 0 then 1 / fx.eur_to_ccy
+              else null
+            end
+          )
+        else null
+      end as value_eur
+    from priced_holdings ph
+    left join lateral (
+      select f.eur_to_ccy
+      from public.fx_daily f
+      where f.ccy = ph.currency
+        and f.date <= ph.valuation_date
+      order by f.date desc
+      limit 1
+    ) fx on ph.currency <> 'EUR'
+    where ph.close_native is not null
+  )
+  select
+    vd.valuation_date,
+    coalesce(sum(ev.value_eur), 0)::numeric(20, 6) as portfolio_value_eur
+  from valuation_dates vd
+  left join eur_valued ev
+    on ev.valuation_date = vd.valuation_date
+  group by vd.valuation_date
+;
+$$;
+
+-- current_setting() is stable, so portfolio_daily_value_rows is still inlined
+-- into these plans as it would be with a literal user id.
+explain (analyze, buffers)
+select * from pg_temp.portfolio_daily_value_rows_legacy(current_setting('portfolio_benchmark.user_id')::uuid, current_date);
+
+explain (analyze, buffers)
+select * from public.portfolio_daily_value_rows(current_setting('portfolio_benchmark.user_id')::uuid, current_date);
+
+-- Both versions must produce the same valuations (expect 0 rows).
+select coalesce(l.valuation_date, n.valuation_date) as valuation_date, l.portfolio_value_eur as legacy, n.portfolio_value_eur as new
+from pg_temp.portfolio_daily_value_rows_legacy(current_setting('portfolio_benchmark.user_id')::uuid, current_date) l
+full join public.portfolio_daily_value_rows(current_setting('portfolio_benchmark.user_id')::uuid, current_date) n
+  on n.valuation_date = l.valuation_date
+where l.portfolio_value_eur is distinct from n.portfolio_value_eur;
+
+rollback;
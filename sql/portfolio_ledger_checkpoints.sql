@@ -0,0 +1,70 @@
+-- Per-user ledger checkpoints for incremental /api/portfolio recomputation.
+-- Paste this in Supabase SQL Editor. Safe to run multiple times.
+--
+-- api/portfolio.py stores the average-cost ledger state (open qty, native
+-- cost basis, realized EUR, sold stats per symbol) together with the sort key
+-- (txn_date, created_at, symbol) of the last replayed transaction. Later
+-- requests only replay transactions after that watermark. tx_closes keeps the
+-- latest transaction close per symbol ({"SYM": [date, close, ccy]}), the
+-- fallback price for valuation events after the watermark.
+--
+-- Any insert/delete, or any ledger-relevant update, that sorts at or before
+-- the watermark deletes the checkpoint, so the next request rebuilds from day one.
+
+create table if not exists public.portfolio_ledger_checkpoints (
+  user_id uuid primary key references auth.users (id) on delete cascade,
+  version int not null,
+  state jsonb not null,
+  watermark_txn_date date not null,
+  watermark_created_at timestamptz,
+  watermark_symbol text not null default '',
+  as_of date not null,
+  pending_events jsonb not null default '[]'::jsonb,
+  tx_closes jsonb not null default '{}'::jsonb,
+  updated_at timestamptz not null default now()
+);
+
+alter table public.portfolio_ledger_checkpoints
+  add column if not exists tx_closes jsonb not null default '{}'::jsonb;
+
+alter table public.portfolio_ledger_checkpoints enable row level security;
+
+create or replace function public.invalidate_portfolio_ledger_checkpoint()
+returns trigger
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  if tg_op in ('UPDATE', 'DELETE') then
+    delete from public.portfolio_ledger_checkpoints c
+    where c.user_id = old.user_id
+      and (old.txn_date::date, coalesce(old.created_at, '-infinity'::timestamptz))
+          <= (c.watermark_txn_date, coalesce(c.watermark_created_at, 'infinity'::timestamptz));
+  end if;
+
+  if tg_op in ('INSERT', 'UPDATE') then
+    delete from public.portfolio_ledger_checkpoints c
+    where c.user_id = new.user_id
+      and (new.txn_date::date, coalesce(new.created_at, '-infinity'::timestamptz))
+          <= (c.watermark_txn_date, coalesce(c.watermark_created_at, 'infinity'::timestamptz));
+  end if;
+
+  return null;
+end;
+$$;
+
+drop trigger if exists transactions_ledger_checkpoint_ins_del on public.transactions;
+create trigger transactions_ledger_checkpoint_ins_del
+  after insert or delete on public.transactions
+  for each row execute function public.invalidate_portfolio_ledger_checkpoint();
+
+-- Name/close-price refreshes from /api/isin_name do not touch ledger columns,
+-- so they keep the checkpoint.
+drop trigger if exists transactions_ledger_checkpoint_upd on public.transactions;
+create trigger transactions_ledger_checkpoint_upd
+  after update of user_id, symbol, side, quantity, price, txn_date on public.transactions
+  for each row execute function public.invalidate_portfolio_ledger_checkpoint();
+
+-- Force a full rebuild for one user (or call /api/portfolio?full=1):
+-- delete from public.portfolio_ledger_checkpoints where user_id = '<user-uuid>';
@@ -0,0 +1,32 @@
+-- Durable key/value cache for upstream resolver lookups (EODHD listings, etc.).
+-- Paste this in Supabase SQL Editor. Safe to run multiple times.
+-- Only the service role (api/*) reads or writes this table.
+-- Namespaces in use: eodhd_listing, bnp_history, bnp_route, bnp_ajax_template
+-- and security_directory (one entry per "isin:<ISIN>" / "ticker:<SYMBOL>" with
+-- names, BNP URL, category, Yahoo/EODHD symbols and currency).
+-- fx_coverage (per currency) lists the date intervals already fetched into
+-- fx_daily; delete it together with fx_daily rows to force a refetch.
+
+create table if not exists public.resolver_cache (
+  namespace text not null,
+  cache_key text not null,
+  payload jsonb not null,
+  expires_at timestamptz,
+  updated_at timestamptz not null default now(),
+  primary key (namespace, cache_key)
+);
+
+create index if not exists resolver_cache_expires_idx
+  on public.resolver_cache (expires_at)
+  where expires_at is not null;
+
+alter table public.resolver_cache enable row level security;
+
+comment on table public.resolver_cache is
+  'Resolver cache keyed by (namespace, cache_key); expires_at null means the entry never expires';
+
+-- Manual invalidation examples:
+-- delete from public.resolver_cache where namespace = 'eodhd_listing' and cache_key = 'IE00B4L5Y983';
+-- delete from public.resolver_cache where namespace = 'eodhd_listing';
+-- Housekeeping:
+-- delete from public.resolver_cache where expires_at < now();
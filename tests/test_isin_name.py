@@ -0,0 +1,125 @@
+import os
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest import mock
+
+os.environ.setdefault("RESOLVER_CACHE_BACKEND", "off")
+os.environ.setdefault("HTTP_CACHE", "off")
+
+import api.isin_name as isin_name
+
+
+def days_ago(n):
+    return (datetime.now(timezone.utc) - timedelta(days=n)).strftime("%Y-%m-%d")
+
+
+# Page 0 holds the last ten days at 2.0, page 1 the ten days before at 0.0.
+HISTORY = {
+    0: [(days_ago(n), 2.0, "EUR") for n in range(10, 0, -1)],
+    1: [(days_ago(n), 0.0, "EUR") for n in range(20, 10, -1)],
+}
+
+
+class FlakyHistory:
+    """_marketdata_history_page stand-in: failing[page] calls fail before it answers."""
+
+    def __init__(self, failing):
+        self.failing = dict(failing)
+        self.calls = []
+
+    def __call__(self, market_type, instrument_id, page, headers):
+        self.calls.append(page)
+        if self.failing.get(page, 0) > 0:
+            self.failing[page] -= 1
+            return None
+        return list(HISTORY.get(page, []))
+
+
+class MarketdataHistoryTest(unittest.TestCase):
+    isin = "DE000TEST0001"
+    route = {"market_type": "funds", "instrument_ids": ["_123"]}
+
+    def setUp(self):
+        isin_name._CACHE_MEMO.clear()
+        self.addCleanup(isin_name._CACHE_MEMO.clear)
+        isin_name.cache_put(isin_name.BNP_ROUTE_CACHE_NAMESPACE, self.isin, self.route)
+        probe = mock.patch.object(isin_name, "bnp_fetch_json", side_effect=AssertionError("unexpected probe"))
+        probe.start()
+        self.addCleanup(probe.stop)
+
+    def lookup(self, history, txn_date):
+        with mock.patch.object(isin_name, "_marketdata_history_page", history):
+            return isin_name.bnp_marketdata_history_close_for_isin_date(self.isin, txn_date)
+
+    def test_transient_page_zero_failure_is_retried(self):
+        history = FlakyHistory({0: 1})
+        self.assertEqual(self.lookup(history, days_ago(3)), ("2.0000", "EUR"))
+        self.assertEqual(history.calls[:2], [0, 0])
+
+    def test_failing_first_pages_keep_the_route(self):
+        history = FlakyHistory({0: 99, 1: 99})
+        self.assertEqual(self.lookup(history, days_ago(3)), ("", ""))
+        self.assertEqual(isin_name.cache_get(isin_name.BNP_ROUTE_CACHE_NAMESPACE, self.isin), self.route)
+
+    def test_empty_page_zero_falls_through_to_page_one(self):
+        history = FlakyHistory({})
+        with mock.patch.dict(HISTORY, {0: []}):
+            self.assertEqual(self.lookup(history, days_ago(15)), ("0.0000", "EUR"))
+
+
+class SecurityDirectoryMissTest(unittest.TestCase):
+    isin = "DE000TEST0002"
+
+    def setUp(self):
+        isin_name._CACHE_MEMO.clear()
+        self.addCleanup(isin_name._CACHE_MEMO.clear)
+        for name, value in (
+            ("search_result_pages_for_isin", lambda isin: ["https://bnp.test/search"]),
+            ("search_json_endpoints_for_isin", lambda isin: []),
+            ("openfigi_name_for_isin", lambda isin: ""),
+        ):
+            patcher = mock.patch.object(isin_name, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def bnp_checked(self):
+        entry = isin_name.security_directory_get(self.isin)
+        return "bnp" in (entry.get("checked") or {})
+
+    def test_failed_search_is_not_recorded_as_a_miss(self):
+        with mock.patch.object(isin_name, "fetch_text", side_effect=TimeoutError("timed out")):
+            self.assertIsNone(isin_name.bnp_find_url_and_name_for_isin(self.isin))
+        self.assertFalse(self.bnp_checked())
+
+    def test_answered_search_without_a_hit_is_recorded_as_a_miss(self):
+        with mock.patch.object(isin_name, "fetch_text", return_value="<html>no results</html>"):
+            self.assertIsNone(isin_name.bnp_find_url_and_name_for_isin(self.isin))
+        self.assertTrue(self.bnp_checked())
+
+
+class HostSlotTimeoutTest(unittest.TestCase):
+    host = "slots.test"
+
+    def setUp(self):
+        # Hold every slot of the host so the next request has to wait.
+        sem = isin_name._http_host_semaphore(self.host)
+        held = 0
+        while sem.acquire(blocking=False):
+            held += 1
+        self.addCleanup(lambda: [sem.release() for _ in range(held)])
+        patcher = mock.patch.object(isin_name, "http_host_timeout", lambda host, timeout: 0.05)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_slot_wait_timeout_is_not_a_deadline(self):
+        with self.assertRaises(TimeoutError):
+            isin_name.http_request("GET", f"https://{self.host}/quote")
+
+    def test_slot_wait_cut_by_deadline_raises_deadline_exceeded(self):
+        with isin_name.deadline_scope(0.01):
+            with self.assertRaises(isin_name.DeadlineExceeded):
+                isin_name.http_request("GET", f"https://{self.host}/quote")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import io
+import json
+import os
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+from urllib.parse import parse_qs, unquote, urlparse
+
+os.environ.setdefault("SUPABASE_URL", "https://supabase.test")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "service-key")
+os.environ.setdefault("RESOLVER_CACHE_BACKEND", "off")
+os.environ.setdefault("HTTP_CACHE", "off")
+
+import api.isin_name as isin_name
+import api.portfolio as portfolio
+
+
+TRANSACTIONS = [
+    {"user_id": "u1", "symbol": "IE00B4L5Y983", "side": "BUY", "quantity": 10, "price": 50,
+     "txn_date": "2024-01-10", "created_at": "2024-01-10T10:00:00+00:00", "txn_close_price": ""},
+    {"user_id": "u1", "symbol": "US0378331005", "side": "BUY", "quantity": 5, "price": 100,
+     "txn_date": "2024-03-10", "created_at": "2024-03-10T10:00:00+00:00", "txn_close_price": "150.0 USD"},
+    {"user_id": "u1", "symbol": "IE00B4L5Y983", "side": "SELL", "quantity": 4, "price": 60,
+     "txn_date": "2024-06-10", "created_at": "2024-06-10T10:00:00+00:00", "txn_close_price": ""},
+]
+
+
+class FakeUpstream:
+    """In-memory Supabase REST tables plus canned Yahoo answers."""
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def _matches(self, row, query):
+        for key, values in query.items():
+            if key in ("select", "order", "limit", "on_conflict"):
+                continue
+            value = values[0]
+            if value.startswith("eq.") and str(row.get(key)) != value[3:]:
+                return False
+            if value.startswith("gte.") and str(row.get(key)) < value[4:]:
+                return False
+            if value.startswith("in.(") and str(row.get(key)) not in [v.strip('"') for v in value[4:-1].split(",")]:
+                return False
+        return True
+
+    def route(self, method, url, data):
+        parsed = urlparse(url)
+        query = parse_qs(parsed.query)
+        if "/auth/v1/user" in url:
+            return {"id": "u1", "email": "user@example.test"}
+        if "/rest/v1/" in url:
+            table = self.tables.setdefault(parsed.path.split("/rest/v1/")[1], [])
+            if method == "GET":
+                return [r for r in table if self._matches(r, query)]
+            if method == "POST":
+                keys = [k for k in (query.get("on_conflict") or [""])[0].split(",") if k]
+                for row in json.loads(data):
+                    table[:] = [r for r in table if not keys or not all(str(r.get(k)) == str(row.get(k)) for k in keys)]
+                    table.append(row)
+                return None
+            if method == "DELETE":
+                table[:] = [r for r in table if not self._matches(r, query)]
+                return None
+            return []
+        if "/v7/finance/quote" in url:
+            symbols = query["symbols"][0].split(",")
+            return {"quoteResponse": {"result": [
+                {"symbol": s, "regularMarketPrice": 1.1 if s.endswith("=X") else 123.0,
+                 "currency": "USD" if s.endswith("=X") else "EUR"}
+                for s in symbols
+            ]}}
+        if "finance/chart" in url:
+            symbol = unquote(parsed.path.rsplit("/", 1)[1])
+            if "period1" in query:
+                stamps = list(range(int(query["period1"][0]), int(query["period2"][0]), 86400))
+                return {"chart": {"result": [{
+                    "meta": {"currency": "USD"},
+                    "timestamp": stamps,
+                    "indicators": {"quote": [{"close": [1.1] * len(stamps)}]},
+                }]}}
+            return {"chart": {"result": [{"meta": {
+                "currency": "USD" if symbol.endswith("=X") else "EUR",
+                "regularMarketPrice": 1.1 if symbol.endswith("=X") else 123.0,
+            }}]}}
+        if "getcrumb" in url:
+            return "crumb"
+        return []
+
+    def http_request(self, method, url, headers=None, data=None, timeout=25, cookie_jar=None, **kwargs):
+        out = self.route(method, url, data)
+        body = out.encode() if isinstance(out, str) else json.dumps(out if out is not None else []).encode()
+        return isin_name.HttpResponse(200, {}, body, url)
+
+
+def call_portfolio(path="/api/portfolio"):
+    h = portfolio.handler.__new__(portfolio.handler)
+    h.headers = {"Authorization": "Bearer token"}
+    h.path = path
+    h.wfile = io.BytesIO()
+    status = []
+    h.send_response = status.append
+    h.send_header = lambda *args: None
+    h.end_headers = lambda: None
+    h.do_GET()
+    return status[0], json.loads(h.wfile.getvalue().decode())
+
+
+class LedgerCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tables = {
+            "transactions": [dict(t) for t in TRANSACTIONS],
+            "prices": [],
+            "fx_daily": [],
+            "portfolio_ledger_checkpoints": [],
+        }
+        upstream = FakeUpstream(self.tables)
+        for target in (isin_name, portfolio):
+            patcher = mock.patch.object(target, "http_request", upstream.http_request)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_checkpoint_skipped_when_event_closes_are_cut_short(self):
+        # Every close resolution hits the deadline inside the events rebuild.
+        def expired(symbol, dates):
+            raise isin_name.DeadlineExceeded("request deadline reached")
+
+        with mock.patch.object(portfolio, "resolve_metadata_for_dates", expired):
+            status, body = call_portfolio()
+
+        self.assertEqual(status, 200)
+        self.assertTrue(body["partial"])
+        self.assertTrue(any(u["stage"] == "prices_events" for u in body["unfinished"]))
+        self.assertEqual(self.tables["portfolio_ledger_checkpoints"], [])
+
+    def test_checkpoint_saved_when_event_closes_resolve(self):
+        def resolved(symbol, dates):
+            return {d: {"txn_close_price": "100.0 EUR"} for d in dates}
+
+        with mock.patch.object(portfolio, "resolve_metadata_for_dates", resolved):
+            status, body = call_portfolio()
+
+        self.assertEqual(status, 200)
+        self.assertEqual(len(self.tables["portfolio_ledger_checkpoints"]), 1)
+        self.assertEqual(
+            self.tables["portfolio_ledger_checkpoints"][0]["as_of"],
+            datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+        )
+
+
+class YahooCrumbTest(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(portfolio, "_YAHOO_CRUMB", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_failed_handshake_is_retried_on_the_next_batch(self):
+        crumbs = iter([b"<html>error</html>", b"", b"abc123"])
+        quote_urls = []
+
+        def fake_request(method, url, headers=None, timeout=25, cookie_jar=None, **kwargs):
+            if url == portfolio.YAHOO_CRUMB_URL:
+                return isin_name.HttpResponse(200, {}, next(crumbs), url)
+            if url.startswith(portfolio.YAHOO_QUOTE_URL):
+                quote_urls.append(url)
+                payload = {"quoteResponse": {"result": [{"symbol": "AAPL", "regularMarketPrice": 1.0}]}}
+                return isin_name.HttpResponse(200, {}, json.dumps(payload).encode(), url)
+            return isin_name.HttpResponse(404, {}, b"", url)
+
+        with mock.patch.object(portfolio, "http_request", fake_request):
+            # Both handshake attempts of the first batch fail...
+            self.assertEqual(portfolio.yahoo_quote_batch(["AAPL"]), {})
+            # ...which must not disable quotes for the rest of the process.
+            data = portfolio.yahoo_quote_batch(["AAPL"])
+
+        self.assertEqual(data["quoteResponse"]["result"][0]["symbol"], "AAPL")
+        self.assertEqual(len(quote_urls), 1)
+        self.assertIn("crumb=abc123", quote_urls[0])
+
+
+if __name__ == "__main__":
+    unittest.main()